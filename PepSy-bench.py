@@ -0,0 +1,173 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Benchmark suite
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script measures how fast PepSy plans a synthesis and how efficient the protocol is, using simulated runs (see simulate() in PepSy.py).
+# Scenarios:
+# templete  - the example sequence configuration file templete.txt
+# 40mer     - a 40-mer of L amino acids
+# 100mer    - a 100-mer of L and D amino acids that needs more than two sets of ports, so the amino acid lines are reloaded several times
+# library   - a library of 500 sequences (8 to 20-mers)
+# Measurements:
+# planning time     - real time spent in positions() (port assignment) and split() (split search)
+# run time          - simulated run time per residue
+# device commands   - serial writes to the Arduino and the stream selector per coupling cycle, pump strokes included, and redundant commands skipped
+# solvent           - DMF and DCM pumped per residue
+# N2                - minutes of N2 bubbling saved per residue by pulsed agitation
+# Results are written as JSON (output/bench-<date>.json by default) and can be compared with an earlier result file.
+
+# python PepSy-bench.py
+# python PepSy-bench.py --compare output/bench-2020-11-05-1200.json
+# python PepSy-bench.py --scenario templete --scenario 40mer
+# python PepSy-bench.py --drainsensor (drains end on the simulated drain sensor)
+# python PepSy-bench.py --uvdetector (fmoc deprotection ends on the synthetic UV signal)
+# python PepSy-bench.py --heat "75/10, C:50/10, H:50/10" (heated couplings on the simulated reactor block)
+# python PepSy-bench.py --agitation "coupling:10/60, deprotection:10/60" (pulsed N2 agitation)
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import json
+import random
+import argparse
+from os import path, mkdir, remove, close
+from time import perf_counter
+from datetime import datetime
+from tempfile import mkstemp
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+planning = {'positions': 0.0, 'split': 0.0} # real time in seconds spent in the planning functions
+calls = {'positions': 0, 'split': 0}
+
+def timed(name, function): # wraps a planning function of PepSy.py to add up its real time
+    def wrapper(*args):
+        start = perf_counter()
+        result = function(*args)
+        planning[name] += perf_counter() - start
+        calls[name] += 1
+        return result
+    return wrapper
+
+def seqfile(seq): # temporary sequence configuration file with the parameters of templete.txt and the given sequence
+    handle, name = mkstemp(suffix='.txt')
+    close(handle)
+    with open('templete.txt') as template, open(name, 'w') as file:
+        for line in template:
+            if line.startswith('seq ='):
+                line = 'seq = ' + seq + '\n'
+            file.write(line)
+    return name
+
+def scenarios(librarysize):
+    rnd = random.Random(2020)
+    laa = 'ACDEFGHIKLMNPQRSTVWY'
+    daa = laa.lower()
+    return {
+        'templete': ['templete.txt'],
+        '40mer': [''.join(rnd.choice(laa) for n in range(40))],
+        '100mer': [''.join(rnd.choice(laa + daa) for n in range(100))],
+        'library': [''.join(rnd.choice(laa) for n in range(rnd.randint(8, 20))) for m in range(librarysize)],
+    }
+
+def measure(sequences, drainsensor=None, uvdetector=None, heating=None, pulsing=None): # simulates every sequence of a scenario and returns the measurements
+    for key in planning:
+        planning[key] = 0.0
+        calls[key] = 0
+    residues = 0
+    cycles = 0
+    runtime = 0.0
+    commands = 0
+    valvecommands = 0
+    strokes = 0
+    skipped = 0
+    dmf = 0
+    dcm = 0
+    n2saved = 0.0
+    start = perf_counter()
+    for s in sequences:
+        if s.endswith('.txt'):
+            name1 = s
+        else:
+            name1 = seqfile(s)
+        runtime += PepSy.simulate(name1, drainsensor=drainsensor, uvdetector=uvdetector, heating=heating, pulsing=pulsing)
+        if name1 != s:
+            remove(name1)
+        residues += len(PepSy.seq)
+        cycles += len([x for x in PepSy.seq if x != '*'])
+        pins = [PepSy.n2, PepSy.vent, PepSy.reagent, PepSy.waste, PepSy.prime, PepSy.pump]
+        valvecommands += sum(p.pin.writes for p in pins[:-1]) + PepSy.ps.writes
+        strokes += PepSy.pump.pin.writes // 2
+        skipped += PepSy.skipped['pin'] + PepSy.skipped['ps']
+        commands += sum(p.pin.writes for p in pins) + PepSy.ps.writes
+        dmf += PepSy.pump.pin.volumes.get(2, 0)
+        dcm += PepSy.pump.pin.volumes.get(3, 0)
+        n2saved += PepSy.agitator.saved
+    return {
+        'sequences': len(sequences),
+        'residues': residues,
+        'parts': calls['positions'], # positions() is called once for every set of ports loaded
+        'planning_positions_s': planning['positions'],
+        'planning_split_s': planning['split'],
+        'planning_s_per_sequence': (planning['positions'] + planning['split'])/len(sequences),
+        'simulation_s': perf_counter() - start,
+        'run_h': runtime/3600,
+        'run_min_per_residue': runtime/60/residues,
+        'commands_per_cycle': commands/cycles,
+        'valve_selector_commands_per_cycle': valvecommands/cycles,
+        'pump_strokes_per_cycle': strokes/cycles,
+        'skipped_commands_per_cycle': skipped/cycles, # redundant commands dropped by the shadow state in PepSy.py
+        'dmf_ml_per_residue': dmf/1000/residues,
+        'dcm_ml_per_residue': dcm/1000/residues,
+        'n2_min_saved_per_residue': n2saved/60/residues,
+    }
+
+def compare(old, new): # prints the change of every measurement against an earlier result file
+    print(' ')
+    print('Compared with ' + old['label'])
+    for name in new['scenarios']:
+        if name not in old['scenarios']:
+            continue
+        print(name)
+        for key, value in new['scenarios'][name].items():
+            value0 = old['scenarios'][name].get(key)
+            if isinstance(value0, (int, float)) and value0 != 0:
+                print('    ' + key.ljust(36) + str("{:.4g}".format(value0)).rjust(10) + ' -> ' + str("{:.4g}".format(value)).ljust(10) + str("{:+.1f}".format(100*(value - value0)/value0)) + ' %')
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PepSy planning and simulated execution benchmark')
+    parser.add_argument('--scenario', action='append', choices=['templete', '40mer', '100mer', 'library'], help='scenario to run (default all)')
+    parser.add_argument('--library', type=int, default=500, help='number of sequences in the library scenario')
+    parser.add_argument('--label', default=datetime.now().strftime('%Y-%m-%d-%H%M'), help='name of this result, e.g. a version')
+    parser.add_argument('--out', help='result file (default output/bench-<label>.json)')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    parser.add_argument('--drainsensor', action='store_true', help='simulate a drain sensor even if none is configured')
+    parser.add_argument('--uvdetector', action='store_true', help='simulate a UV detector even if none is configured')
+    parser.add_argument('--heat', help='simulate heated couplings with this heat profile, e.g., 75/10')
+    parser.add_argument('--agitation', help='simulate pulsed N2 agitation, e.g., "coupling:10/60, deprotection:10/60"')
+    args = parser.parse_args()
+
+    PepSy.positions = timed('positions', PepSy.positions)
+    PepSy.split = timed('split', PepSy.split)
+    results = {'label': args.label, 'scenarios': {}}
+    for name, sequences in scenarios(args.library).items():
+        if args.scenario and name not in args.scenario:
+            continue
+        results['scenarios'][name] = measure(sequences, True if args.drainsensor else None, True if args.uvdetector else None, args.heat, args.agitation)
+        r = results['scenarios'][name]
+        print(name.ljust(10) + str(r['sequences']).rjust(4) + ' seq' + str(r['residues']).rjust(6) + ' res' + str(r['parts']).rjust(5) + ' parts   planning ' + str("{:.2f}".format(1000*r['planning_s_per_sequence'])) + ' ms/seq   ' + str("{:.1f}".format(r['run_min_per_residue'])) + ' min/res   ' + str("{:.0f}".format(r['commands_per_cycle'])) + ' cmd/cycle   ' + str("{:.1f}".format(r['dmf_ml_per_residue'] + r['dcm_ml_per_residue'])) + ' ml solvent/res')
+
+    out = args.out
+    if out is None:
+        if not path.exists('output'):
+            mkdir('output')
+        out = 'output/bench-' + args.label + '.json'
+    with open(out, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('Results written to ' + out)
+    if args.compare:
+        compare(json.load(open(args.compare)), results)
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
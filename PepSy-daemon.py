@@ -0,0 +1,276 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Device daemon
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script opens the VICI stream selector and the Arduino once and keeps them open, so PepSy.py and PepSy-manual.py start without resetting
+# the board and can share one instrument. Start it once (python PepSy-daemon.py) and leave it running, both scripts use it when it is running
+# and open the devices themselves when it is not. PepSy.py starts it for the run when it is not running (deviceprocess in the device
+# configuration file), with the device configuration file of the run (python PepSy-daemon.py config2.txt).
+# The daemon is the real-time device process of a run: it times the pump strokes itself, at high priority when the operating system lets it,
+# so the logging, printing and run history writing of PepSy.py and the answers of the operator never delay or stretch a stroke.
+# A pump train is one request, its strokes are timed against deadlines from its start, the last milliseconds before every edge are spun
+# because the timer of the operating system is coarser, and the lateness of every edge is measured and returned to PepSy.py.
+
+# Clients connect to localhost on the daemonport of the device configuration file (default 6001). Every request and every answer is one line
+# of JSON (an array), nothing received is executed or unpickled, and requests that are not in the table below or have arguments the device
+# does not take (e.g., a pin that does not exist, a stream selector command other than GOn and HM) are answered with ('error', reason).
+# The first request of a client is ('key', secret) with the secret of the key file (daemonkey in the device configuration file, default
+# daemon.key in the PepSy folder), the connection is closed when it does not match. The daemon writes a random secret to the key file when it
+# does not exist, readable only by the account creating it, so only the instrument account can drive the device. Start the daemon once
+# as the instrument account before starting it as administrator, so the key file belongs to the instrument account.
+# Requests and answers:
+# ('key', secret)      - first request of a client, the secret of the key file               -> ('ok', None) or ('error', 'wrong key')
+# ('pin', name, value)  - write to the pin n2, vent, reagent, waste, prime, pump or heater    -> ('ok', None)
+# ('ps', command)       - stream selector command, e.g. 'GO5\r' or 'HM\r'                     -> ('ok', None)
+# ('pump', strokes)     - starts a pump train, 0.25 s on and 0.25 s off per stroke             -> ('ok', None)
+# ('pumped',)           - waits for the end of the pump train                                 -> ('ok', (strokes, [seconds late of every edge]))
+# ('halt',)             - emergency stop, ends the pump train and sets the device safe         -> ('ok', None)
+# ('acquire', who)      - exclusive use of the device (PepSy.py during a run)                 -> ('ok', None) or ('busy', owner)
+# ('release',)          - ends exclusive use                                                  -> ('ok', None)
+# ('sensor', name)      - reading (0 to 1) of a sensor (drain, uv or probe)                   -> ('ok', value), None when it is not connected
+# ('status',)           - owner, last pin values and stream selector command                  -> ('ok', {...})
+# While a client holds the device, pin and stream selector requests of the other clients are answered with ('busy', owner), the sensors can
+# be read by every client, and every client can halt the device.
+# If the owner disconnects without releasing (e.g., PepSy.py was killed), the pump and the heater are stopped, all valves are switched off and
+# the stream selector is sent home.
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import os
+import re
+import sys
+import hmac
+import json
+import socket
+import serial
+import secrets
+import threading
+from time import perf_counter
+from datetime import datetime
+from configparser import ConfigParser
+from pyfirmata import Arduino, util
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+def timestamp():
+    return datetime.now().strftime('%m-%d-%Y %I:%M:%S %p')
+
+def raisepriority(): # True when the daemon runs above normal priority, it needs administrator (root) rights on Linux
+    try:
+        if hasattr(os, 'nice'):
+            os.nice(-10)
+            return True
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        return bool(kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), 0x80)) # HIGH_PRIORITY_CLASS
+    except (OSError, AttributeError):
+        return False
+
+def readkey(name): # secret of the key file, a new random one is written when it does not exist
+    try:
+        fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600) # readable only by this account
+        with os.fdopen(fd, 'w') as file:
+            file.write(secrets.token_hex(32) + '\n')
+    except FileExistsError:
+        pass
+    if hasattr(os, 'getuid') and os.stat(name).st_mode & 0o077:
+        print('Warning: ' + name + ' can be read by other accounts, set it readable only by the instrument account (chmod 600)')
+    return open(name).read().strip()
+
+class Connection: # one JSON array per line each way, see the requests above
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rw', encoding='utf-8', newline='\n')
+
+    def send(self, message):
+        self.file.write(json.dumps(message) + '\n')
+        self.file.flush()
+
+    def recv(self):
+        line = self.file.readline(4096)
+        if not line.endswith('\n'): # disconnected or not a request
+            raise EOFError
+        return json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def number(x):
+    return type(x) in (int, float)
+
+def valid(message): # True for a request of the table above with arguments the device takes
+    if not isinstance(message, list) or not message:
+        return False
+    kind, args = message[0], message[1:]
+    if kind == 'pin':
+        return len(args) == 2 and args[0] in pins and number(args[1]) and 0 <= args[1] <= 1 # 0 or 1, or the duty cycle of the heater
+    if kind == 'ps':
+        return len(args) == 1 and isinstance(args[0], str) and re.fullmatch('(GO[0-9]{1,2}|HM)\r', args[0]) is not None
+    if kind == 'pump':
+        return len(args) == 1 and type(args[0]) is int and 0 <= args[0] <= 10000 # 200 ml with a 20 microliter pump
+    if kind in ('acquire', 'sensor'):
+        return len(args) == 1 and isinstance(args[0], str) and len(args[0]) <= 100
+    return kind in ('pumped', 'halt', 'release', 'status') and not args
+
+def train(strokes): # pump train, every edge timed against its deadline from the start so that a late edge does not delay the next ones
+    late = []
+    done = 0
+    start = perf_counter()
+    for k in range(2*strokes + 1):
+        deadline = start + 0.25*k
+        if halt.wait(max(0, deadline - perf_counter() - spin)):
+            break
+        while perf_counter() < deadline:
+            pass
+        if k == 2*strokes: # end of the last stroke
+            break
+        with iolock:
+            if halt.is_set():
+                break
+            late.append(perf_counter() - deadline)
+            pins['pump'].write(1 if k % 2 == 0 else 0)
+            state['pump'] = 1 if k % 2 == 0 else 0
+        done += k % 2
+    trained[:] = [done, late]
+
+def safe(): # pump and heater stopped, valves switched off, stream selector home
+    halt.set() # a pump train ends at its next edge
+    with iolock:
+        for name in ('pump', 'heater', 'prime', 'reagent', 'n2', 'waste', 'vent'):
+            if name in pins:
+                pins[name].write(0)
+                state[name] = 0
+        ps.write('HM\r'.encode())
+        state['ps'] = 'HM'
+
+def handle(sock, who): # answers the requests of one client until it disconnects
+    global owner
+    conn = Connection(sock)
+    try:
+        message = conn.recv()
+        if not (isinstance(message, list) and len(message) == 2 and message[0] == 'key' and isinstance(message[1], str)
+                and hmac.compare_digest(message[1].encode(), key.encode())):
+            print('Client ' + str(who) + ' refused at ' + timestamp() + ', wrong key')
+            conn.send(('error', 'wrong key'))
+            return
+        conn.send(('ok', None))
+        while True:
+            message = conn.recv()
+            if not valid(message):
+                conn.send(('error', 'invalid request ' + json.dumps(message)[:200]))
+            elif message[0] == 'acquire':
+                with ownerlock:
+                    if owner is not None and owner[0] != who:
+                        conn.send(('busy', owner[1]))
+                        continue
+                    owner = (who, message[1])
+                print(message[1] + ' (client ' + str(who) + ') acquired the device at ' + timestamp())
+                conn.send(('ok', None))
+            elif message[0] == 'release':
+                with ownerlock:
+                    if owner is not None and owner[0] == who:
+                        owner = None
+                        print('Client ' + str(who) + ' released the device at ' + timestamp())
+                conn.send(('ok', None))
+            elif message[0] == 'sensor':
+                conn.send(('ok', sensors[message[1]].read() if message[1] in sensors else None))
+            elif message[0] == 'halt':
+                print('Client ' + str(who) + ' halted the device at ' + timestamp())
+                safe()
+                conn.send(('ok', None))
+            elif message[0] == 'status':
+                current = owner
+                conn.send(('ok', {'owner': current[1] if current else None, 'state': dict(state)}))
+            elif message[0] in ('pin', 'ps', 'pump', 'pumped'):
+                current = owner
+                if current is not None and current[0] != who:
+                    conn.send(('busy', current[1]))
+                    continue
+                if message[0] == 'pump':
+                    halt.clear()
+                    pumping[:] = [threading.Thread(target=train, args=(message[1],), daemon=True)]
+                    pumping[0].start()
+                    conn.send(('ok', None))
+                    continue
+                if message[0] == 'pumped':
+                    if pumping:
+                        pumping.pop().join()
+                    conn.send(('ok', tuple(trained)))
+                    continue
+                with iolock:
+                    if message[0] == 'pin':
+                        pins[message[1]].write(message[2])
+                        state[message[1]] = message[2]
+                    else:
+                        ps.write(message[1].encode())
+                        state['ps'] = message[1].strip()
+                conn.send(('ok', None))
+    except (EOFError, OSError, ValueError): # ValueError: not JSON
+        pass
+    finally:
+        conn.close()
+        with ownerlock:
+            lost = owner is not None and owner[0] == who
+            if lost:
+                owner = None
+        if lost:
+            print('Client ' + str(who) + ' disconnected while holding the device at ' + timestamp() + ', device set to a safe state')
+            safe()
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+config = ConfigParser()
+config.readfp(open(sys.argv[1] if len(sys.argv) > 1 else 'config.txt'))
+pscom = config.get('Parameters', 'pscom')
+arduinocom = config.get('Parameters', 'arduinocom')
+daemonport = config.getint('Parameters', 'daemonport', fallback=6001)
+keyname = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.get('Parameters', 'daemonkey', fallback='daemon.key'))
+drainpin = config.getint('Parameters', 'drainpin', fallback=None)
+uvpin = config.getint('Parameters', 'uvpin', fallback=None)
+heaterpin = config.getint('Parameters', 'heaterpin', fallback=None)
+probepin = config.getint('Parameters', 'probepin', fallback=None)
+
+ps = serial.Serial(port=pscom, baudrate=9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS) # VICI port selector
+board = Arduino(arduinocom) # Arduino Uno
+pins = {
+    'n2': board.get_pin('d:2:o'), # Solenoid valve normally closed, connected to digital pin 2
+    'vent': board.get_pin('d:3:o'), # Solenoid valve normally open, connected to digital pin 3
+    'reagent': board.get_pin('d:4:o'), # Solenoid valve normally closed, connected to digital pin 4
+    'waste': board.get_pin('d:5:o'), # Solenoid valve normally closed, connected to digital pin 5
+    'prime': board.get_pin('d:6:o'), # Solenoid valve normally closed, connected to digital pin 6
+    'pump': board.get_pin('d:7:o'), # Solenoid micro pump, connected to digital pin 7
+}
+if heaterpin is not None:
+    pins['heater'] = board.get_pin('d:%d:p' % (heaterpin)) # Reactor heater through a MOSFET, connected to a PWM digital pin
+sensors = {}
+if drainpin is not None:
+    sensors['drain'] = board.get_pin('a:%d:i' % (drainpin)) # Pressure or liquid sensor below the reactor frit, connected to an analog pin
+if uvpin is not None:
+    sensors['uv'] = board.get_pin('a:%d:i' % (uvpin)) # UV detector in the waste line below the reactor frit, connected to an analog pin
+if probepin is not None:
+    sensors['probe'] = board.get_pin('a:%d:i' % (probepin)) # Temperature probe of the reactor, connected to an analog pin
+if sensors:
+    util.Iterator(board).start() # reads the analog values reported by the board
+    for sensor in sensors.values():
+        sensor.enable_reporting()
+state = {} # last value written to every pin and last stream selector command
+iolock = threading.Lock() # one device command at a time
+ownerlock = threading.Lock()
+owner = None # (client number, name) of the client holding the device
+halt = threading.Event() # set by safe(), ends the pump train
+pumping = [] # thread of the pump train in progress
+trained = [0, []] # strokes and lateness of the edges of the last pump train
+spin = 0.002 # seconds spun before every edge of a pump train
+safe()
+
+key = readkey(keyname)
+listener = socket.create_server(('localhost', daemonport))
+print('PepSy device daemon ready on port ' + str(daemonport) + ' at ' + timestamp() + (', high priority' if raisepriority() else ', normal priority (start it as administrator for high priority)'))
+clients = 0
+while True:
+    sock, address = listener.accept()
+    clients += 1
+    threading.Thread(target=handle, args=(sock, clients), daemon=True).start()
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,206 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Fleet controller
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script drives several PepSy instruments from one host. Every instrument has its own device configuration file (COM ports, daemonport,
+# sensors, ...) and runs in its own thread on its own copy of PepSy.py (see simcopy()), so their run states never mix.
+# The queued sequence configuration files are started in order on the first free instrument. The events of all instruments go to one log
+# (output/fleet-<date>.txt and the console), a status table is printed every --status seconds, and the operator questions of every instrument
+# are asked on this console, prefixed with the instrument name.
+# An instrument that fails (e.g., its Arduino is disconnected) is set to a safe state and takes no more sequences, the others go on.
+# Ctrl-C stops every instrument at once (see stop() in PepSy.py), each one writes the resume file of its run.
+# Simulated instruments (--simulated) run on virtual clocks, a queue is simulated in seconds.
+
+# python PepSy-fleet.py --instrument unit1=config.txt --instrument unit2=config-unit2.txt seq1 seq2 seq3
+# python PepSy-fleet.py --simulated sim1=config.txt --simulated sim2=config.txt --simulated sim3=config.txt templete.txt templete.txt templete.txt templete.txt
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import argparse
+import threading
+from os import path, mkdir
+from queue import Queue, Empty
+from datetime import datetime
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+def seqpath(name): # sequence configuration file given as a path or as a name in the sequence folder
+    if path.exists(name):
+        return name
+    return 'sequence/' + name + '.txt'
+
+def timestamp():
+    return datetime.now().strftime('%m-%d-%Y %I:%M:%S %p')
+
+def log(unit, line): # writes an event of an instrument to the fleet log
+    with loglock:
+        logfile.write(timestamp() + '\t' + unit + '\t' + line + '\n')
+        logfile.flush()
+        print(unit.ljust(12) + line)
+        status[unit]['last'] = line
+
+def console(unit): # print() of the copy of PepSy.py of an instrument, its lines go to the fleet log
+    def write(*args, **kwargs):
+        line = ' '.join(str(x) for x in args).strip()
+        if line != '':
+            log(unit, line)
+    return write
+
+def operator(unit, m): # input() of the copy of PepSy.py of an instrument, the question is asked on the fleet console by the main thread
+    answers = Queue()
+    def ask(prompt=''):
+        status[unit]['state'] = 'waiting for the operator'
+        questions.put((unit, prompt, answers))
+        while True:
+            try:
+                answer = answers.get(timeout=0.1)
+                break
+            except Empty:
+                if m.abort.is_set(): # stopped while waiting for the answer
+                    raise m.Stopped()
+        status[unit]['state'] = 'running'
+        return answer
+    return ask
+
+def failed(unit, m, error): # the instrument takes no more sequences and is set to a safe state, the other instruments go on
+    status[unit]['state'] = 'failed'
+    log(unit, 'Failed: ' + repr(error) + ', no more sequences are started on this instrument')
+    try:
+        m.safe()
+        log(unit, 'Device set to a safe state')
+        m.disconnect()
+    except Exception as error2:
+        log(unit, 'Device could not be set to a safe state: ' + repr(error2))
+
+def instrument(unit, configname, simulated): # synthesizes the queued sequences on one instrument until the queue is empty or the instrument fails
+    m = PepSy.simcopy()
+    m.print = console(unit)
+    copies[unit] = m
+    try:
+        m.loaddevice(configname)
+        if not simulated:
+            m.connect()
+            m.history = m.openhistory(m.historyname)
+            m.overheads = m.stepoverheads(m.history)
+    except Exception as error:
+        failed(unit, m, error)
+        return
+    while True:
+        try:
+            seqfile = jobs.get_nowait()
+        except Empty:
+            break
+        status[unit].update(state='running', sequence=seqfile, started=datetime.now())
+        try:
+            m.loadsequence(seqpath(seqfile))
+        except Exception as error:
+            log(unit, 'Sequence configuration file ' + seqfile + ' could not be read: ' + repr(error))
+            results.append((unit, seqfile, 'not started'))
+            continue
+        name = path.join(outdir, unit + '-' + m.seqname + datetime.now().strftime('-%Y-%m-%d-'))
+        if simulated:
+            m.simdevices()
+        else:
+            m.input = operator(unit, m)
+            m.tracefile = open(name + 'trace.txt', 'w')
+            m.tracefile.write('# PepSy trace of ' + seqfile + ' on ' + unit + '\n')
+            m.uvname = name + 'uv.txt'
+        m.filename = name + 'out.txt'
+        open(m.filename, 'w').close()
+        try:
+            m.run()
+        except m.Stopped:
+            m.aborted()
+            results.append((unit, seqfile, 'stopped'))
+            status[unit]['state'] = 'stopped'
+            m.disconnect()
+            return
+        except Exception as error:
+            results.append((unit, seqfile, 'failed'))
+            failed(unit, m, error)
+            return
+        finally:
+            if m.tracefile is not None:
+                m.tracefile.close()
+                m.tracefile = None
+        results.append((unit, seqfile, 'done'))
+        status[unit].update(state='idle', sequence='')
+    if m.heater is not None:
+        m.heater.set(None)
+        m.stopped.set()
+    if m.history is not None:
+        m.history.close()
+    m.disconnect()
+    status[unit]['state'] = 'finished'
+
+def showstatus(): # status table of the fleet
+    print(' ')
+    print('Instrument'.ljust(12) + 'State'.ljust(26) + 'Sequence'.ljust(16) + 'Running (h)'.rjust(12) + '   Last event')
+    for unit in units:
+        x = status[unit]
+        running = (datetime.now() - x['started']).total_seconds()/3600 if x['state'] in ('running', 'waiting for the operator') else 0
+        print(unit.ljust(12) + x['state'].ljust(26) + x['sequence'][:15].ljust(16) + str("{:.1f}".format(running)).rjust(12) + '   ' + x['last'][:60])
+    print(str(jobs.qsize()) + ' sequences queued')
+    print(' ')
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive several PepSy instruments from one host')
+    parser.add_argument('seqfiles', nargs='+', help='sequence configuration files to synthesize in order, paths or names in the sequence folder')
+    parser.add_argument('--instrument', action='append', default=[], help='NAME=CONFIG, an instrument and its device configuration file, can be given more than once')
+    parser.add_argument('--simulated', action='append', default=[], help='NAME=CONFIG, a simulated instrument, can be given more than once')
+    parser.add_argument('--status', type=float, default=300, help='seconds between the status tables (default 300)')
+    args = parser.parse_args()
+
+    instruments = [x.split('=', 1) + [False] for x in args.instrument] + [x.split('=', 1) + [True] for x in args.simulated]
+    if not instruments:
+        instruments = [['PepSy', 'config.txt', False]]
+    units = [unit for unit, configname, simulated in instruments]
+    if len(set(units)) < len(units):
+        parser.error('every instrument needs its own name')
+    outdir = path.join(path.dirname(path.abspath(PepSy.__file__)), 'output')
+    if not path.exists(outdir):
+        mkdir(outdir)
+    logfile = open(path.join(outdir, 'fleet-' + datetime.now().strftime('%Y-%m-%d-%H%M') + '.txt'), 'a')
+    loglock = threading.Lock()
+    status = {unit: {'state': 'idle', 'sequence': '', 'started': datetime.now(), 'last': ''} for unit in units}
+    jobs = Queue() # sequence configuration files not started yet
+    for seqfile in args.seqfiles:
+        jobs.put(seqfile)
+    questions = Queue() # operator questions of the instruments, (instrument, question, answer queue)
+    results = [] # (instrument, sequence configuration file, done, stopped, failed or not started)
+    copies = {} # instrument: its copy of PepSy.py
+
+    threads = [threading.Thread(target=instrument, args=(unit, configname, simulated), daemon=True) for unit, configname, simulated in instruments]
+    for thread in threads:
+        thread.start()
+    shown = datetime.now()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            if (datetime.now() - shown).total_seconds() >= args.status:
+                showstatus()
+                shown = datetime.now()
+            try:
+                unit, prompt, answers = questions.get(timeout=1)
+            except Empty:
+                continue
+            answers.put(input(unit + ': ' + prompt))
+    except KeyboardInterrupt: # every instrument is stopped and set to a safe state
+        for unit, m in copies.items():
+            if status[unit]['state'] in ('running', 'waiting for the operator'):
+                try:
+                    m.stop('Ctrl-C on the fleet console')
+                except Exception as error:
+                    log(unit, 'Device could not be set to a safe state: ' + repr(error))
+        for thread in threads:
+            thread.join(5)
+    showstatus()
+    for unit, seqfile, result in results:
+        log(unit, seqfile + ' ' + result)
+    if jobs.qsize():
+        print(str(jobs.qsize()) + ' sequences were not started, no instrument was left')
+    logfile.close()
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,200 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Run timeline
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script draws the timeline of a run as a self-contained HTML page (inline SVG, no scripts or downloads needed to view it).
+# The plan is the trace of a simulated run of the sequence configuration file (see simulate() in PepSy.py), the actual run is the trace
+# written by PepSy.py during the run (output/<name>-<date>-trace.txt). Both are drawn on the same lanes, the plan as a light bar above the
+# actual run: stream selector position, pump, every valve, heater setpoint, and the operator questions (from the question to the answer).
+# Windows of more than --idle minutes without pumping are shaded on the pump lane, and the drift lane shows how far the actual run is behind
+# (up) or ahead (down) of the plan, command by command.
+# Bars shorter than a pixel apart are merged, so runs of thousands of commands (100-mers) stay small and quick to open.
+
+# python PepSy-gantt.py templete.txt                                                   (plan only)
+# python PepSy-gantt.py templete.txt --trace output/templete-2020-11-05-trace.txt --out output/templete-2020-11-05-timeline.html
+# python PepSy-gantt.py templete.txt --trace output/templete-2020-11-05-trace.txt --scale 30 --idle 20
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import argparse
+from os import path, mkdir, remove, close
+from difflib import SequenceMatcher
+from tempfile import mkstemp
+from xml.sax.saxutils import escape
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+lanes = ['ps', 'pump', 'n2', 'vent', 'reagent', 'waste', 'prime', 'heater', 'operator'] # from top to bottom
+colors = {'ps': '#7b68ee', 'pump': '#d2691e', 'n2': '#4682b4', 'vent': '#708090', 'reagent': '#2e8b57', 'waste': '#8b4513', 'prime': '#daa520',
+          'heater': '#dc143c', 'operator': '#ff8c00'}
+
+def seqpath(name): # sequence configuration file given as a path or as a name in the sequence folder
+    if path.exists(name):
+        return name
+    return 'sequence/' + name + '.txt'
+
+def readtrace(tracename): # list of (time, command) from a trace file
+    events = []
+    for line in open(tracename):
+        line = line.rstrip('\n')
+        if line == '' or line.startswith('#'):
+            continue
+        t, command = line.split('\t', 1)
+        events.append((float(t), command))
+    return events
+
+def bars(events): # {lane: [(start, end, label)]} of a trace, a pump command lasts 0.5 s per stroke
+    found = {lane: [] for lane in lanes}
+    opened = {} # lane: (start, label) of the bar not ended yet
+    def end(lane, t):
+        if lane in opened:
+            start, label = opened.pop(lane)
+            found[lane].append((start, t, label))
+    for t, command in events:
+        fields = command.split('\t')
+        if fields[0] == 'ps':
+            end('ps', t)
+            opened['ps'] = (t, 'position ' + ('1' if fields[1] == 'HM' else fields[1][2:]))
+        elif fields[0] == 'pump':
+            found['pump'].append((t, t + -(-int(fields[1])//PepSy.piv)*0.5, fields[1] + ' ul'))
+        elif fields[0] == 'pin' and fields[1] in lanes and fields[1] != 'pump':
+            if fields[2] == '0':
+                end(fields[1], t)
+            elif fields[1] not in opened:
+                opened[fields[1]] = (t, fields[1])
+        elif fields[0] == 'heat':
+            end('heater', t)
+            if fields[1] != 'off':
+                opened['heater'] = (t, fields[1] + ' C')
+        elif fields[0] == 'ask':
+            opened['operator'] = (t, fields[1] if len(fields) > 1 else '')
+        elif fields[0] == 'answered':
+            end('operator', t)
+    last = events[-1][0] if events else 0
+    for lane in list(opened):
+        end(lane, last)
+    return found
+
+def merged(found, gap): # bars less than gap seconds apart joined in to one, with the number of bars joined
+    joined = []
+    for start, end, label in sorted(found):
+        if joined and start - joined[-1][1] < gap:
+            start0, end0, label0, n = joined[-1]
+            joined[-1] = (start0, max(end, end0), label0, n + 1)
+        else:
+            joined.append((start, end, label, 1))
+    return joined
+
+def idlewindows(pumping, end, minimum): # (start, end) of the windows of more than minimum seconds without pumping
+    windows = []
+    t = 0
+    for start, stop, label in sorted(pumping):
+        if start - t > minimum:
+            windows.append((t, start))
+        t = max(t, stop)
+    if end - t > minimum:
+        windows.append((t, end))
+    return windows
+
+def drift(planned, actual): # (actual time, seconds behind the plan) of every command found in both traces, matched in order
+    commands1 = [c for t, c in planned]
+    commands2 = [c for t, c in actual]
+    first = 0 # the commands before the first difference and after the last one are matched without difflib
+    while first < min(len(commands1), len(commands2)) and commands1[first] == commands2[first]:
+        first += 1
+    last = 0
+    while last < min(len(commands1), len(commands2)) - first and commands1[-1-last] == commands2[-1-last]:
+        last += 1
+    blocks = [(0, 0, first)]
+    if first < min(len(commands1), len(commands2)) - last:
+        matcher = SequenceMatcher(None, commands1[first:len(commands1)-last], commands2[first:len(commands2)-last], autojunk=False)
+        blocks += [(first + i, first + j, n) for i, j, n in matcher.get_matching_blocks()]
+    blocks.append((len(commands1) - last, len(commands2) - last, last))
+    points = []
+    for i, j, n in blocks:
+        for k in range(n):
+            points.append((actual[j+k][0], actual[j+k][0] - planned[i+k][0]))
+    return points
+
+def hours(s):
+    return str("{:.1f}".format(s/3600)) + ' h'
+
+def clock(s): # seconds since the start as h:mm:ss
+    s = int(s)
+    return '%d:%02d:%02d' % (s//3600, s%3600//60, s%60)
+
+def render(title, planned, actual, scale, idle): # the timeline as an HTML page, scale in pixels per hour, idle in minutes
+    left = 90
+    row = 10
+    lane = 2*row + 8
+    runs = [('planned', planned, 0.35)] + ([('actual', actual, 1.0)] if actual else [])
+    end = max(events[-1][0] for name, events, opacity in runs if events)
+    width = left + int(end/3600*scale) + 40
+    x = lambda t: left + t/3600*scale
+    gap = 3600/scale # one pixel
+    driftheight = 80
+    height = 30 + lane*len(lanes) + driftheight + 30
+    svg = []
+    for h in range(0, int(end/3600) + 1): # hour grid
+        svg.append('<line x1="%.1f" y1="20" x2="%.1f" y2="%d" stroke="#e0e0e0"/><text x="%.1f" y="14" font-size="10" text-anchor="middle">%d h</text>' % (x(h*3600), x(h*3600), height - 10, x(h*3600), h))
+    found = {name: bars(events) for name, events, opacity in runs}
+    reference = actual if actual else planned
+    for k, name in enumerate(lanes):
+        y = 30 + k*lane
+        svg.append('<text x="4" y="%d" font-size="11">%s</text>' % (y + row + 4, name))
+        if name == 'pump':
+            for start, stop in idlewindows(found['actual' if actual else 'planned']['pump'], reference[-1][0], idle*60):
+                svg.append('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="#ffdddd"><title>pump idle %s to %s (%.0f min)</title></rect>' % (x(start), y - 2, max(1, x(stop) - x(start)), 2*row + 4, clock(start), clock(stop), (stop - start)/60))
+        for r, (run, events, opacity) in enumerate(runs):
+            for start, stop, label, n in merged(found[run][name], gap):
+                svg.append('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s" fill-opacity="%.2f"><title>%s %s %s to %s%s</title></rect>' % (x(start), y + r*row, max(1, x(stop) - x(start)), row - 1, colors[name], opacity, run, escape(label), clock(start), clock(stop), (' (' + str(n) + ' bars)') if n > 1 else ''))
+    y = 30 + len(lanes)*lane + driftheight//2 # drift lane, zero in the middle
+    svg.append('<text x="4" y="%d" font-size="11">drift</text><line x1="%d" y1="%d" x2="%d" y2="%d" stroke="#999"/>' % (y + 4, left, y, width, y))
+    summary = 'Planned ' + hours(planned[-1][0]) + ', ' + str(len(planned)) + ' commands'
+    if actual:
+        points = drift(planned, actual)
+        top = max([abs(d) for t, d in points] + [60])
+        line = []
+        for t, d in points:
+            px = round(x(t), 1)
+            if line and px - line[-1][0] < 1: # one point per pixel
+                continue
+            line.append((px, round(y - d/top*(driftheight//2 - 4), 1)))
+        svg.append('<polyline fill="none" stroke="#b22222" points="%s"/><text x="%d" y="%d" font-size="10">+%.0f min</text>' % (' '.join('%s,%s' % p for p in line), left + 4, y - driftheight//2 + 10, top/60))
+        summary += ', actual ' + hours(actual[-1][0]) + ', ' + str(len(actual)) + ' commands, drift at the end ' + str("{:+.0f}".format(points[-1][1]/60 if points else 0)) + ' min'
+    windows = idlewindows(found['actual' if actual else 'planned']['pump'], reference[-1][0], idle*60)
+    summary += ', ' + str(len(windows)) + ' pump idle windows of more than ' + str(idle) + ' min (' + hours(sum(stop - start for start, stop in windows)) + ')'
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>' + escape(title) + '</title></head>\n'
+            '<body style="font-family: sans-serif">\n<h3>' + escape(title) + '</h3>\n<p>' + summary + '</p>\n'
+            '<p>Light bars: plan (simulated), dark bars: actual run. Shaded: pump idle. Drift: actual minus planned time of the same command.</p>\n'
+            '<div style="overflow-x: auto"><svg xmlns="http://www.w3.org/2000/svg" width="' + str(width) + '" height="' + str(height) + '">\n'
+            + '\n'.join(svg) + '\n</svg></div>\n</body></html>\n')
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Draw the timeline of a PepSy run as HTML')
+    parser.add_argument('seqfile', help='sequence configuration file of the run, a path or a name in the sequence folder')
+    parser.add_argument('--trace', help='trace of the actual run (default plan only)')
+    parser.add_argument('--out', help='HTML file (default output/<name>-timeline.html)')
+    parser.add_argument('--scale', type=float, default=100, help='pixels per hour (default 100)')
+    parser.add_argument('--idle', type=float, default=10, help='shortest pump idle window shown in minutes (default 10)')
+    args = parser.parse_args()
+
+    handle, tracename = mkstemp(suffix='-trace.txt')
+    close(handle)
+    PepSy.simulate(seqpath(args.seqfile), tracename)
+    planned = readtrace(tracename)
+    remove(tracename)
+    actual = readtrace(args.trace) if args.trace else None
+    out = args.out
+    if out is None:
+        if not path.exists('output'):
+            mkdir('output')
+        out = path.join('output', PepSy.seqname + '-timeline.html')
+    with open(out, 'w') as file:
+        file.write(render(PepSy.seqname + ' (' + PepSy.seq + ')', planned, actual, args.scale, args.idle))
+    print('Timeline written to ' + out)
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,108 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Run history queries
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script queries the run history database (output/history.db) written by PepSy.py during every run.
+# Tables:
+# runs          - one row per run: sequence configuration file name, sequence, scale, start and end, planned and actual seconds
+# steps         - one row per step: run, residue, step type (single, double, manual, fmoc, ivdde, oxidation, pause, initialization, priming,
+#                 swelling, finalwashing, cleaning), start, planned seconds (simulated), actual seconds, and seconds waited for the operator
+# interventions - one row per operator question: run, step, question, start, and seconds waited
+# volumes       - microliters pumped in a run from every position, with the content of the position
+# The overhead of a step is its actual time minus its planned time and the operator waits. The mean overhead of every step type over the last
+# 90 days is added to the estimated synthesis time by PepSy.py.
+
+# python PepSy-history.py runs --days 30
+# python PepSy-history.py runs --sequence ZXQWAVGHLM
+# python PepSy-history.py steps 12
+# python PepSy-history.py overhead --step single --step double --by residue --days 90     (mean coupling overhead per residue type)
+# python PepSy-history.py interventions
+# python PepSy-history.py volumes --days 365
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import sys
+import argparse
+from os import path
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+def since(days): # modifier of the sqlite date functions for the last days
+    return '-' + str(days) + ' days'
+
+def runs(db, days, sequence=None):
+    query = "select id, name, sequence, started, planned, actual from runs where started >= datetime('now', 'localtime', ?)"
+    args = [since(days)]
+    if sequence is not None:
+        query += ' and sequence = ?'
+        args.append(sequence)
+    print('Run'.ljust(6) + 'Name'.ljust(20) + 'Started'.ljust(21) + 'Residues'.rjust(9) + 'Planned (h)'.rjust(13) + 'Actual (h)'.rjust(12))
+    for runid, name, seq, started, planned, actual in db.execute(query + ' order by started', args):
+        print(str(runid).ljust(6) + name[:19].ljust(20) + started.ljust(21) + str(len(seq)).rjust(9) + hours(planned).rjust(13) + hours(actual).rjust(12))
+
+def hours(s): # seconds as hours, '-' for a run that did not finish
+    if s is None:
+        return '-'
+    return str("{:.2f}".format(s/3600))
+
+def steps(db, runid):
+    print('Step'.ljust(16) + 'Residue'.ljust(9) + 'Started'.ljust(21) + 'Planned (min)'.rjust(14) + 'Actual (min)'.rjust(14) + 'Waited (min)'.rjust(14))
+    for step, residue, started, planned, actual, waited in db.execute('select step, residue, started, planned, actual, waited from steps where run = ? order by id', (runid,)):
+        print(step.ljust(16) + residue.ljust(9) + started.ljust(21) + (str("{:.1f}".format(planned/60)) if planned is not None else '-').rjust(14) + str("{:.1f}".format(actual/60)).rjust(14) + str("{:.1f}".format(waited/60)).rjust(14))
+
+def overhead(db, days, stepnames=None, by='step'): # mean overhead of the steps grouped by step type or by residue
+    query = "select " + ('residue' if by == 'residue' else 'step') + ", count(*), avg(actual - planned - waited), min(actual - planned - waited), max(actual - planned - waited) from steps where planned is not null and started >= datetime('now', 'localtime', ?)"
+    args = [since(days)]
+    if stepnames:
+        query += ' and step in (' + ', '.join('?' for x in stepnames) + ')'
+        args += stepnames
+    query += ' group by 1 order by 3 desc'
+    print(('Residue' if by == 'residue' else 'Step').ljust(16) + 'Steps'.rjust(7) + 'Mean (min)'.rjust(12) + 'Min (min)'.rjust(12) + 'Max (min)'.rjust(12))
+    for key, count, mean, low, high in db.execute(query, args):
+        print(key.ljust(16) + str(count).rjust(7) + str("{:.2f}".format(mean/60)).rjust(12) + str("{:.2f}".format(low/60)).rjust(12) + str("{:.2f}".format(high/60)).rjust(12))
+
+def interventions(db, days): # operator questions, how often they were asked and how long the operator took to answer
+    query = "select prompt, count(*), avg(waited), max(waited) from interventions where started >= datetime('now', 'localtime', ?) group by prompt order by 3 desc"
+    print('Waits'.rjust(6) + 'Mean (min)'.rjust(12) + 'Max (min)'.rjust(12) + '   Question')
+    for prompt, count, mean, high in db.execute(query, (since(days),)):
+        print(str(count).rjust(6) + str("{:.1f}".format(mean/60)).rjust(12) + str("{:.1f}".format(high/60)).rjust(12) + '   ' + prompt)
+
+def volumes(db, days): # volumes pumped by content
+    query = "select content, count(distinct run), sum(ul) from volumes where run in (select id from runs where started >= datetime('now', 'localtime', ?)) group by content order by 3 desc"
+    print('Content'.ljust(16) + 'Runs'.rjust(6) + 'Volume (ml)'.rjust(13))
+    for content, count, ul in db.execute(query, (since(days),)):
+        print(content.ljust(16) + str(count).rjust(6) + str("{:.1f}".format(ul/1000)).rjust(13))
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the PepSy run history')
+    parser.add_argument('action', choices=['runs', 'steps', 'overhead', 'interventions', 'volumes'])
+    parser.add_argument('run', nargs='?', type=int, help='run id (steps)')
+    parser.add_argument('--days', type=int, default=90, help='only the runs of the last days (default 90)')
+    parser.add_argument('--sequence', help='only the runs of this sequence (runs)')
+    parser.add_argument('--step', action='append', help='only this step type (overhead), can be given more than once')
+    parser.add_argument('--by', choices=['step', 'residue'], default='step', help='group the overheads by step type or by residue (overhead)')
+    parser.add_argument('--db', default=PepSy.historyname, help='run history database (default output/history.db)')
+    args = parser.parse_args()
+
+    if not path.exists(args.db):
+        print('No run history in ' + args.db)
+        sys.exit(1)
+    db = PepSy.openhistory(args.db)
+    if args.action == 'runs':
+        runs(db, args.days, args.sequence)
+    elif args.action == 'steps':
+        if args.run is None:
+            parser.error('steps needs a run id')
+        steps(db, args.run)
+    elif args.action == 'overhead':
+        overhead(db, args.days, args.step, args.by)
+    elif args.action == 'interventions':
+        interventions(db, args.days)
+    else:
+        volumes(db, args.days)
+    db.close()
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,307 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Peptide library campaign planner
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script plans a campaign of many PepSy runs at once without asking anything or touching the device.
+# The library file lists one peptide per line, either the sequence alone or a name and the sequence separated by a tab or spaces.
+# Sequences are written N to C as in the sequence configuration file, lines starting with '#' are ignored.
+# The device configuration file (config.txt) is read for the number of ports and the tubing volumes, the amino acid/reagent table (residues.txt)
+# for the molecular weights, couplings and deprotections.
+
+# batch - NumPy planning of the whole library in one pass, with the same rules as plan() in PepSy.py:
+#         per-residue counts, amino acid weights and DMF volumes (0.33 M solutions), DMF/DCM/HBTU/HOBt/DIPEA/piperidine volumes and run times.
+#         Writes the per-run table and the campaign totals per amino acid as tab separated files.
+#         python PepSy-library.py batch library.txt --ss 1 --out campaign
+# tree  - split-and-continue schedule for libraries of variants that share C-terminal segments. PepSy synthesizes C to N, so the sequences are
+#         reversed and put in a trie. A segment shared by several peptides is synthesized once on the resin for all of them (ss = number of
+#         peptides x ss, up to --maxss), then the resin is dried, divided by weight and each portion continues with its own branch (saa set to
+#         the first residue of the branch). Prints the schedule and the cycles, reagents and instrument time saved against one run per peptide.
+#         --write writes a sequence configuration file for every stage, based on --template.
+#         python PepSy-library.py tree library.txt --ss 1 --maxss 2 --minshared 3 --write sequence
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import argparse
+from time import perf_counter
+import numpy as np
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+reagents = [('dmfvol', 'DMF'), ('dcmvol', 'DCM'), ('hbtvol', 'HBTU solution'), ('hobvol', 'HOBt solution'), ('dipvol', 'DIPEA solution'), ('pipvol', 'Piperidine solution')]
+
+def readlibrary(libfile): # names and sequences of the library file
+    names = []
+    seqs = []
+    for line in open(libfile):
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        if len(fields) == 1:
+            names.append('run' + str(len(names)+1))
+        else:
+            names.append(fields[0])
+        seqs.append(fields[-1])
+    return names, seqs
+
+def table(chars, value, default=0.0): # lookup table indexed by character code
+    t = np.full(256, default)
+    for ch in chars:
+        t[ord(ch)] = value
+    return t
+
+def prop(name, value=None): # lookup table indexed by character code of a property of the amino acid/reagent table, or True where it has the value
+    values = [PepSy.residue(chr(ch))[name] for ch in range(256)]
+    if value is None:
+        return np.array(values, dtype=float)
+    return np.array([x == value for x in values])
+
+def batch(seqs, ss): # plans all the sequences at once, returns a dictionary of arrays (one row per run)
+    runs = len(seqs)
+    length = max(len(p) for p in seqs)
+    m = np.frombuffer(''.join(p.ljust(length) for p in seqs).encode('ascii'), dtype=np.uint8).reshape(runs, length).astype(np.int64) # character codes, padded with spaces at the C-terminal end (sequences are written N to C)
+    rows = np.repeat(np.arange(runs), length).reshape(runs, length)
+    raw = np.bincount((rows*256 + m).ravel(), minlength=runs*256).reshape(runs, 256) # residues of each run by character code
+    raw[:, ord(' ')] = 0
+    pad = table(' ', 1) == 1
+    ignored = table(PepSy.ignore, 1) == 1
+    doubled = prop('next', 'double') & ~pad
+    single = prop('coupling', 'single') & ~pad
+    # a single coupling is done twice when the residue before it in the synthesis (its C-terminal neighbour) is P or an N-methyl amino acid
+    again = doubled[m[:, 1:]] & single[m[:, :-1]]
+    counts = raw.copy()
+    counts[:, ignored] = 0
+    counts += np.bincount((rows[:, :-1]*256 + m[:, :-1])[again], minlength=runs*256).reshape(runs, 256) # couplings per amino acid/reagent
+    # solutions
+    vol = ((PepSy.len1+PepSy.len2)/1000 + ss*prop('ml'))*counts # ml
+    wt = vol*prop('mw')*0.33 # mg, conc of aa solution is 0.33M
+    dmf = vol*1000 - wt # ul
+    # reagents
+    residues = raw.sum(axis=1)
+    twice = prop('coupling', 'double')[m] # couplings of two rounds
+    twice[:, :-1] |= again
+    once = (single | prop('coupling', 'manual'))[m]
+    once[:, :-1] &= ~again
+    fmoc = (prop('deprotection', 'fmoc') & ~pad)[m]
+    cn = once.sum(axis=1) + 2*twice.sum(axis=1)
+    dn = fmoc.sum(axis=1)
+    dmfn = PepSy.washes*(residues - (prop('coupling', 'pause')[m] & ~pad[m]).sum(axis=1) + dn)
+    # run times
+    times = PepSy.steptimes(ss)
+    ccode = np.array([times.get(PepSy.residue(chr(ch))['coupling'], 0) for ch in range(256)])
+    ccode[ord(' ')] = 0
+    ctime = ccode[m]
+    ctime[:, :-1] = np.where(again, times['double'], ctime[:, :-1])
+    fixed = times['initialization'] + times['priming'] + times['swelling'] + times['fmoc'] + times['finalwashing']
+    result = {
+        'residues': residues,
+        'couplings': cn,
+        'deprotections': dn,
+        'types': (counts > 0).sum(axis=1),
+        'counts': counts, 'vol': vol, 'wt': wt, 'dmf': dmf,
+        'dmfvol': 5+11.5+dmfn*PepSy.washvol/1000,
+        'dcmvol': np.full(runs, 10+11.5),
+        'hbtvol': 2+0.5+((PepSy.len2/1000)+0.5)*cn,
+        'hobvol': 2+0.5+((PepSy.len2/1000)+0.26)*cn,
+        'dipvol': 2+0.5+((PepSy.len2/1000)+0.26)*cn,
+        'pipvol': 2+0.5+((PepSy.len2+PepSy.len3)/1000+2)*dn,
+        'time': fixed + ctime.sum(axis=1) + fmoc.sum(axis=1)*times['fmoc'],
+        'parts': np.ones(runs, dtype=np.int64),
+    }
+    # sequences with more amino acids/reagents than ports are synthesized in parts, each part is planned on its own
+    for r in np.nonzero((raw[:, ~ignored] > 0).sum(axis=1) > PepSy.ports - 7)[0]:
+        parts = [PepSy.plan(p, ss) for p in PepSy.split(seqs[r])]
+        result['parts'][r] = len(parts)
+        for key in ('dmfvol', 'dcmvol', 'hbtvol', 'hobvol', 'dipvol', 'pipvol'):
+            result[key][r] = sum(pl[key] for pl in parts)
+        result['time'][r] = sum(pl['time'] for pl in parts) - (len(parts)-1)*fixed
+    return result
+
+def writebatch(names, seqs, result, out): # per-run table and campaign totals per amino acid
+    with open(out + '-runs.txt', 'w') as file:
+        file.write('Run\tSequence\tResidues\tParts\tDMF (ml)\tDCM (ml)\tHBTU (ml)\tHOBt (ml)\tDIPEA (ml)\tPiperidine (ml)\tTime (h)\n')
+        for r in range(len(seqs)):
+            file.write(names[r] + '\t' + seqs[r] + '\t' + str(result['residues'][r]) + '\t' + str(result['parts'][r]) + '\t' + '\t'.join(str("{:.1f}".format(result[key][r])) for key, name in reagents) + '\t' + str("{:.1f}".format(result['time'][r]/3600)) + '\n')
+    with open(out + '-totals.txt', 'w') as file:
+        file.write('Amino acid\tCouplings\tSolution volume (ml)\tAmino acid weight (mg)\tDMF volume (ul)\n')
+        counts = result['counts'].sum(axis=0)
+        for ch in np.nonzero(counts)[0]:
+            file.write(chr(ch) + '\t' + str(counts[ch]) + '\t' + str("{:.1f}".format(result['vol'][:, ch].sum())) + '\t' + str("{:.0f}".format(result['wt'][:, ch].sum())) + '\t' + str("{:.0f}".format(result['dmf'][:, ch].sum())) + '\n')
+        file.write('\n')
+        for key, name in reagents:
+            file.write('Volume of ' + name + ' = ' + str("{:.1f}".format(result[key].sum())) + ' ml\n')
+        file.write('Instrument time = ' + str("{:.1f}".format(result['time'].sum()/3600)) + ' h\n')
+
+def trie(group, depth): # children of a trie node, the peptides of the group grouped by their residue at depth (None for the peptides ending there)
+    children = {}
+    for name, rev in group:
+        key = rev[depth] if len(rev) > depth else None
+        children.setdefault(key, []).append((name, rev))
+    return list(children.values())
+
+def common(group, depth): # depth of the deepest trie node shared by all the peptides of the group
+    end = min(len(rev) for name, rev in group)
+    first = group[0][1]
+    while depth < end and all(rev[depth] == first[depth] for name, rev in group):
+        depth += 1
+    return depth
+
+def separate(group, depth, ss, parent, schedule): # one stage per peptide of the group, each continuing from depth up to its end
+    for name, rev in group:
+        schedule.append({'id': len(schedule)+1, 'parent': parent, 'segment': rev[depth:][::-1], 'seq': rev[::-1], 'saa': depth+1,
+                         'ss': ss, 'peptides': 1, 'done': [name]})
+    return schedule
+
+def price(stages, runcost): # instrument time of the stages plus runcost hours for each run (loading, dividing and drying the resin), in hours
+    return sum(cost(stage['segment'], stage['ss'], [0] if carried(stage) else [])['time']/3600 + runcost for stage in stages)
+
+def tree(group, depth, ss, maxss, minshared, runcost=0, parent=None, schedule=None): # split-and-continue schedule for a group of (name, reversed sequence) already synthesized together up to depth
+    if schedule is None:
+        schedule = []
+    start = len(schedule)
+    shared(group, depth, ss, maxss, minshared, runcost, parent, schedule)
+    if len(group) > 1:
+        # the subtree is only kept when it costs less than running its peptides separately from depth, e.g., chunks of a large group that all synthesize the shared segment again
+        flat = separate(group, depth, ss, parent, [{}]*start)[start:]
+        if price(flat, runcost) < price(schedule[start:], runcost):
+            schedule[start:] = flat
+    return schedule
+
+def shared(group, depth, ss, maxss, minshared, runcost, parent, schedule): # stages of tree() sharing the segments of the group
+    cap = maxss // ss # peptides that fit on one resin portion
+    if len(group) > cap:
+        # too much resin for one run, the branches are packed in to runs of at most cap peptides
+        chunks = []
+        for child in sorted(trie(group, common(group, depth)), key=len, reverse=True):
+            for n in range(0, len(child), cap):
+                piece = child[n:n+cap]
+                for chunk in chunks:
+                    if len(chunk) + len(piece) <= cap:
+                        chunk.extend(piece)
+                        break
+                else:
+                    chunks.append(list(piece))
+        for chunk in chunks:
+            tree(chunk, depth, ss, maxss, minshared, runcost, parent, schedule)
+        return
+    end = common(group, depth)
+    if len(group) == 1 or end - depth >= minshared or (end > depth and all(len(rev) == end for name, rev in group)):
+        # one run synthesizes the segment from depth to end for the whole group
+        rev = group[0][1]
+        stage = {'id': len(schedule)+1, 'parent': parent, 'segment': rev[depth:end][::-1], 'seq': rev[:end][::-1], 'saa': depth+1,
+                 'ss': len(group)*ss, 'peptides': len(group), 'done': [name for name, rev1 in group if len(rev1) == end]}
+        schedule.append(stage)
+        for child in trie(group, end):
+            if len(child[0][1]) > end:
+                tree(child, end, ss, maxss, minshared, runcost, stage['id'], schedule)
+        return
+    # the shared segment is too short to pay for an extra run, the branches continue separately
+    for child in trie(group, end):
+        tree(child, depth, ss, maxss, minshared, runcost, parent, schedule)
+
+costs = {} # cost() of the runs already planned
+
+def cost(segment, ss, double=()): # volumes and time of a run, double as in plan()
+    key = (segment, ss, tuple(double))
+    if key in costs:
+        return costs[key]
+    pl = PepSy.plan(segment, ss, None, double)
+    cost = {key: pl[key] for key, name in reagents}
+    cost['aa'] = sum(pl['vol'])
+    cost['cycles'] = len([x for x in segment if x != '*'])
+    cost['time'] = pl['time']
+    costs[key] = cost
+    return cost
+
+def carried(stage): # True when the last residue of the parent stage (P or an N-methyl amino acid) makes the first coupling of the stage a double coupling
+    return stage['parent'] is not None and PepSy.residue(stage['seq'][-(stage['saa']-1)])['next'] == 'double'
+
+def writestages(schedule, template, folder, prefix): # sequence configuration file for every stage
+    for stage in schedule:
+        name = folder + '/' + prefix + '-stage' + str(stage['id']) + '.txt'
+        lines = open(template).readlines()
+        double = carried(stage) and not any(line.split('=')[0].strip() == 'double' for line in lines) # no double key in the template to add it to
+        with open(name, 'w') as file:
+            for line in lines:
+                key = line.split('=')[0].strip()
+                if key == 'ss':
+                    line = 'ss = ' + str(stage['ss']) + '\n'
+                elif key == 'seq':
+                    line = 'seq = ' + stage['seq'] + '\n'
+                elif key == 'saa':
+                    line = 'saa = ' + str(stage['saa']) + '\n'
+                    if double:
+                        line += 'double = ' + str(stage['saa']) + '\n' # the parent stage ends with the residue before it, which is not in the part of the sequence synthesized
+                elif key == 'double' and carried(stage):
+                    numbers = PepSy.residuenumbers(line.split('=', 1)[1]) | {stage['saa']}
+                    line = 'double = ' + ', '.join(str(x) for x in sorted(numbers)) + '\n'
+                elif key == 'pa':
+                    line = 'pa = y\n'
+                elif key == 'dp' and stage['parent'] is not None:
+                    line = 'dp = n\n' # the last residue of the parent stage was deprotected
+                elif key == 'fw':
+                    line = 'fw = y\n' # the resin is dried before it is divided
+                file.write(line)
+        stage['file'] = name
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PepSy peptide library campaign planner')
+    parser.add_argument('action', choices=['batch', 'tree'])
+    parser.add_argument('library', help='library file, one sequence per line')
+    parser.add_argument('--ss', type=int, default=1, help='synthesis scale, 1 for 50 micromol and 2 for 100 micromol')
+    parser.add_argument('--out', default='campaign', help='prefix of the output files')
+    parser.add_argument('--maxss', type=int, default=2, help='largest synthesis scale of a shared run (tree)')
+    parser.add_argument('--minshared', type=int, default=3, help='shortest segment worth an extra shared run (tree)')
+    parser.add_argument('--runcost', type=float, default=0, help='hours of work counted for each run besides the instrument time, weighs the extra runs of a shared schedule (tree)')
+    parser.add_argument('--write', help='folder for the sequence configuration files of the stages (tree)')
+    parser.add_argument('--template', default='templete.txt', help='sequence configuration file with the other parameters (tree)')
+    args = parser.parse_args()
+
+    PepSy.loaddevice()
+    names, seqs = readlibrary(args.library)
+    if args.action == 'tree':
+        schedule = tree([(names[n], seqs[n][::-1]) for n in range(len(seqs))], 0, args.ss, args.maxss, args.minshared, args.runcost)
+        flat = separate([(names[n], seqs[n][::-1]) for n in range(len(seqs))], 0, args.ss, None, [])
+        if price(schedule, args.runcost) > price(flat, args.runcost):
+            print('The shared schedule costs more than one run per peptide, no stages written')
+            raise SystemExit(1)
+        if args.write:
+            writestages(schedule, args.template, args.write, args.out)
+        print('Stage\tFrom\tss\tsaa\tResidues\tSegment\tFinished peptides')
+        for stage in schedule:
+            print(str(stage['id']) + '\t' + (str(stage['parent']) if stage['parent'] else '-') + '\t' + str(stage['ss']) + '\t' + str(stage['saa']) + '\t' + str(len(stage['segment'])) + '\t' + stage['segment'] + '\t' + ', '.join(stage['done']))
+        for stage in schedule:
+            if stage['parent'] is not None:
+                parent = schedule[stage['parent']-1]
+                stage['share'] = stage['peptides']/parent['peptides']
+        print(' ')
+        print('Divide the dried resin of a stage by weight between the stages continuing from it:')
+        for stage in schedule:
+            if stage['parent'] is not None:
+                print('Stage ' + str(stage['id']) + ' gets ' + str("{:.0f}".format(100*stage['share'])) + ' % of the resin of stage ' + str(stage['parent']) + (' (' + stage['file'] + ')' if 'file' in stage else ''))
+        single = [cost(p, args.ss) for p in seqs]
+        shared = [cost(stage['segment'], stage['ss'], [0] if carried(stage) else []) for stage in schedule]
+        print(' ')
+        print('\t\t\tOne run per peptide\tShared schedule\tSaved')
+        for key, name in [('runs', 'Runs'), ('cycles', 'Coupling cycles'), ('time', 'Instrument time (h)'), ('aa', 'Amino acid solutions (ml)')] + reagents:
+            if key == 'runs':
+                v1, v2 = len(single), len(shared)
+            else:
+                v1, v2 = sum(c[key] for c in single), sum(c[key] for c in shared)
+            if key == 'time':
+                v1, v2 = v1/3600, v2/3600
+            print(name.ljust(28) + '\t' + str("{:.1f}".format(v1)) + '\t\t\t' + str("{:.1f}".format(v2)) + '\t\t' + str("{:.1f}".format(v1 - v2)))
+        raise SystemExit
+    start = perf_counter()
+    result = batch(seqs, args.ss)
+    elapsed = perf_counter() - start
+    writebatch(names, seqs, result, args.out)
+    print(str(len(seqs)) + ' runs, ' + str(result['residues'].sum()) + ' residues, ' + str(result['parts'].sum() - len(seqs)) + ' extra parts for sequences longer than the ports allow, planned in ' + str("{:.3f}".format(elapsed)) + ' s')
+    print('Instrument time = ' + str("{:.1f}".format(result['time'].sum()/3600)) + ' h')
+    for key, name in reagents:
+        print('Volume of ' + name + ' = ' + str("{:.1f}".format(result[key].sum())) + ' ml')
+    print('Per-run table written to ' + args.out + '-runs.txt and amino acid totals to ' + args.out + '-totals.txt')
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
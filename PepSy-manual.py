@@ -33,138 +33,224 @@ Position 8 to 24 - Amino acid solutions or other reagent solutions
 '''
 
 import time
-import serial
-import _thread
+import queue
+import threading
 import configparser
 from tkinter import *
-from pyfirmata import Arduino, util
+import PepSy
+
+# Long operations (pumping, line cleaning, resin washing) run one at a time on a worker thread fed by the jobs queue, so the window and the
+# valve buttons stay responsive. The worker never touches Tk widgets, it puts updates on the updates queue, which the Tk thread reads in poll().
+# Pin and stream selector writes from both threads are serialized by iolock.
+# When PepSy-daemon.py is running the device is operated through it, and commands are refused while a PepSy.py run holds the device.
+# The lines cleaned here are noted in the port map (see saveportmap() in PepSy.py) as out of their bottles, and a line pumped from as unknown,
+# so the next run primes them again.
 
 # Functions
+def refused(owner): # a command refused by PepSy-daemon.py, a running operation is cancelled
+    updates.put(('status', devstatus, 'Device in use by ' + str(owner) + ', command refused'))
+    if threading.current_thread() is not threading.main_thread():
+        cancel.set()
+
+def write(pin, value): # pin write from any thread, False if it was refused
+    try:
+        with iolock:
+            pin.write(value)
+        return True
+    except PepSy.Busy as owner:
+        refused(owner)
+        return False
+
+def pswrite(command): # stream selector command from any thread
+    try:
+        with iolock:
+            ps.write(command.encode())
+    except PepSy.Busy as owner:
+        refused(owner)
+
+def showvalve(name, value): # button states of a valve, Tk thread only
+    onBtn, offBtn = valveBtns[name]
+    if value == 1:
+        onBtn.config(state=DISABLED)
+        offBtn.config(state=NORMAL)
+    else:
+        offBtn.config(state=DISABLED)
+        onBtn.config(state=NORMAL)
+
 def n2On():
-    n2OnBtn.config(state=DISABLED)
-    n2OffBtn.config(state=NORMAL)
-    n2.write(1)
+    if write(n2, 1):
+        showvalve('n2', 1)
 
 def n2Off():
-    n2OffBtn.config(state=DISABLED)
-    n2OnBtn.config(state=NORMAL)
-    n2.write(0)
+    if write(n2, 0):
+        showvalve('n2', 0)
 
 def ventOn():
-    ventOnBtn.config(state=DISABLED)
-    ventOffBtn.config(state=NORMAL)
-    vent.write(1)
+    if write(vent, 1):
+        showvalve('vent', 1)
 
 def ventOff():
-    ventOffBtn.config(state=DISABLED)
-    ventOnBtn.config(state=NORMAL)
-    vent.write(0)
+    if write(vent, 0):
+        showvalve('vent', 0)
 
 def reagentOn():
-    reagentOnBtn.config(state=DISABLED)
-    reagentOffBtn.config(state=NORMAL)
-    reagent.write(1)
+    if write(reagent, 1):
+        showvalve('reagent', 1)
 
 def reagentOff():
-    reagentOffBtn.config(state=DISABLED)
-    reagentOnBtn.config(state=NORMAL)
-    reagent.write(0)
+    if write(reagent, 0):
+        showvalve('reagent', 0)
 
 def wasteOn():
-    wasteOnBtn.config(state=DISABLED)
-    wasteOffBtn.config(state=NORMAL)
-    waste.write(1)
+    if write(waste, 1):
+        showvalve('waste', 1)
 
 def wasteOff():
-    wasteOffBtn.config(state=DISABLED)
-    wasteOnBtn.config(state=NORMAL)
-    waste.write(0)
+    if write(waste, 0):
+        showvalve('waste', 0)
 
 def primeOn():
-    primeOnBtn.config(state=DISABLED)
-    primeOffBtn.config(state=NORMAL)
-    prime.write(1)
+    if write(prime, 1):
+        showvalve('prime', 1)
 
 def primeOff():
-    primeOffBtn.config(state=DISABLED)
-    primeOnBtn.config(state=NORMAL)
-    prime.write(0)
-
-def pumpon(v): # v is volume (integer) to be pumped in microliters, pumping rate is 1.2 ml/min, this function is required as a solenoid valve based micro pump is being used
-    pumpOnBtn.config(state=DISABLED)
+    if write(prime, 0):
+        showvalve('prime', 0)
+
+def setbusy(busy): # buttons of the long operations, Tk thread only
+    for btn in (pumpOnBtn, psGoBtn, cleanBtn, washBtn, resetBtn):
+        btn.config(state=DISABLED if busy else NORMAL)
+    cancelBtn.config(state=NORMAL if busy else DISABLED)
+
+def poll(): # applies the updates posted by the worker, runs on the Tk thread every 100 ms
+    while True:
+        try:
+            update = updates.get_nowait()
+        except queue.Empty:
+            break
+        if update[0] == 'valve':
+            showvalve(update[1], update[2])
+        elif update[0] == 'status':
+            update[1].set(update[2])
+        elif update[0] == 'busy':
+            setbusy(update[1])
+    root.after(100, poll)
+
+class Cancelled(Exception):
+    pass
+
+def valve(name, pin, value): # pin write from the worker, the button states follow on the Tk thread
+    if write(pin, value):
+        updates.put(('valve', name, value))
+
+def status(var, info): # status label text from the worker
+    updates.put(('status', var, info))
+
+def wait(t, var=None, info=''): # sleep of the worker that ends early on cancel, counts down on the status label
+    end = time.monotonic() + t
+    while True:
+        left = end - time.monotonic()
+        if left <= 0:
+            return
+        if var is not None:
+            status(var, info + ' (' + str(int(left + 0.99)) + ' s)')
+        if cancel.wait(min(left, 1)):
+            raise Cancelled()
+
+def pumpon(v, var=None, info=''): # v is volume (integer) to be pumped in microliters, pumping rate is 1.2 ml/min, this function is required as a solenoid valve based micro pump is being used
     for p in range(0,v,piv):
-        pump.write(1)
+        if cancel.is_set():
+            raise Cancelled()
+        if var is not None and (p // piv) % 10 == 0:
+            status(var, info + ' (' + str(p) + ' of ' + str(v) + ' ul)')
+        write(pump, 1)
         time.sleep(0.25)
-        pump.write(0)
+        write(pump, 0)
         time.sleep(0.25)
-    pumpOnBtn.config(state=NORMAL)
-
-def pumponvol():
-    psGoBtn.config(state=DISABLED)
-    cleanBtn.config(state=DISABLED)
-    washBtn.config(state=DISABLED)
-    resetBtn.config(state=DISABLED)
-    vol = int(pumpvol.get())
+
+def pumponvol(vol, pos):
     pumpon(vol)
-    psGoBtn.config(state=NORMAL)
-    cleanBtn.config(state=NORMAL)
-    washBtn.config(state=NORMAL)
-    resetBtn.config(state=NORMAL)
+    PepSy.marklines(portmapname, [pos], 'unknown')
 
-def go():
-    pos = int(pspos.get())
-    position = 'GO%d\r' % (pos)
-    ps.write(position.encode())
-
-def clean():
-    pos1 = int(ps1pos.get())
-    pos2 = int(ps2pos.get())
-    psGoBtn.config(state=DISABLED)
-    cleanBtn.config(state=DISABLED)
-    washBtn.config(state=DISABLED)
-    resetBtn.config(state=DISABLED)
+def clean(pos1, pos2):
     for n in range(pos1, pos2+1):
         cleaninfo = 'Cleaning port ' + str(n)
-        cleanstatus.set(cleaninfo)
-        position = 'GO%d\r' % (n)
-        ps.write(position.encode())
-        primeOn()
-        pumpon(500+len1+len2)
-        primeOff()
-    ps.write('HM\r'.encode())
-    cleanstatus.set('Cleaning completed')
-    psGoBtn.config(state=NORMAL)
-    cleanBtn.config(state=NORMAL)
-    washBtn.config(state=NORMAL)
-    resetBtn.config(state=NORMAL)
-
-def wash():
-    x = int(washTimes.get())
-    psGoBtn.config(state=DISABLED)
-    cleanBtn.config(state=DISABLED)
-    washBtn.config(state=DISABLED)
-    resetBtn.config(state=DISABLED)
+        status(cleanstatus, cleaninfo)
+        pswrite('GO%d\r' % (n))
+        valve('prime', prime, 1)
+        pumpon(500+len1+len2, cleanstatus, cleaninfo)
+        valve('prime', prime, 0)
+        PepSy.marklines(portmapname, [n], 'DMF')
+    pswrite('HM\r')
+    status(cleanstatus, 'Cleaning completed')
+
+def wash(x):
     for n in range(1, x+1):
-        washinfo = 'Resin washing ' + str(n)
-        washstatus.set(washinfo)
-        reagentOn()
-        ps.write('GO2\r'.encode())
-        pumpon(2000)
-        ps.write('HM\r'.encode())
-        time.sleep(1)
-        reagentOff()
-        n2On()
-        wasteOn()
-        ventOn()
-        time.sleep(60)
-        ventOff()
-        wasteOff()
-        n2Off()
-    washstatus.set('Resin washing completed')
-    psGoBtn.config(state=NORMAL)
-    cleanBtn.config(state=NORMAL)
-    washBtn.config(state=NORMAL)
-    resetBtn.config(state=NORMAL)
+        washinfo = 'Resin washing ' + str(n) + ' of ' + str(x)
+        status(washstatus, washinfo)
+        valve('reagent', reagent, 1)
+        pswrite('GO2\r')
+        pumpon(2000, washstatus, washinfo)
+        pswrite('HM\r')
+        wait(1)
+        valve('reagent', reagent, 0)
+        valve('n2', n2, 1)
+        valve('waste', waste, 1)
+        valve('vent', vent, 1)
+        wait(60, washstatus, washinfo + ' - draining')
+        valve('vent', vent, 0)
+        valve('waste', waste, 0)
+        valve('n2', n2, 0)
+    status(washstatus, 'Resin washing completed')
+
+def stop(var): # leaves the device safe after a cancelled operation, the pump is stopped and all valves are switched off
+    write(pump, 0)
+    valve('prime', prime, 0)
+    valve('reagent', reagent, 0)
+    valve('n2', n2, 0)
+    valve('waste', waste, 0)
+    valve('vent', vent, 0)
+    pswrite('HM\r')
+    if var is not None:
+        status(var, 'Cancelled')
+
+def worker(): # runs the long operations from the jobs queue one after another
+    while True:
+        function, args, var = jobs.get()
+        cancel.clear()
+        updates.put(('busy', True))
+        try:
+            function(*args)
+        except Cancelled:
+            stop(var)
+        except Exception as error: # e.g., the serial link or PepSy-daemon.py failed, the next jobs still run
+            try:
+                stop(var)
+            except Exception:
+                pass # the device may not answer, the error is shown below
+            status(var if var is not None else devstatus, 'Failed: ' + repr(error))
+        finally:
+            updates.put(('busy', False))
+
+def submit(function, args, var=None): # queues a long operation, Tk thread only
+    setbusy(True)
+    jobs.put((function, args, var))
+
+def pumpStart():
+    submit(pumponvol, (int(pumpvol.get()), psat))
+
+def cleanStart():
+    submit(clean, (int(ps1pos.get()), int(ps2pos.get())), cleanstatus)
+
+def washStart():
+    submit(wash, (int(washTimes.get()),), washstatus)
+
+def go():
+    global psat
+    pos = int(pspos.get())
+    position = 'GO%d\r' % (pos)
+    pswrite(position)
+    psat = pos
 
 def reset():
     volvar.set('0')
@@ -180,10 +266,7 @@ def reset():
     wasteOff()
     primeOff()
     go()
-    psGoBtn.config(state=NORMAL)
-    cleanBtn.config(state=NORMAL)
-    washBtn.config(state=NORMAL)
-    resetBtn.config(state=NORMAL)
+    setbusy(False)
         
 # Main
 config = configparser.ConfigParser()
@@ -194,15 +277,31 @@ tubevol = float(config.get('Parameters', 'tubevol'))
 length1 = float(config.get('Parameters', 'length1'))
 length2 = float(config.get('Parameters', 'length2'))
 piv = int(config.get('Parameters', 'piv'))
-
-ps = serial.Serial(port=pscom, baudrate=9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS) # VICI port selector
-board = Arduino(arduinocom) # Arduino Uno
-n2 = board.get_pin('d:2:o') # Solenoid valve normally closed, connected to digital pin 2
-vent = board.get_pin('d:3:o') # Solenoid valve normally open, connected to digital pin 3
-reagent = board.get_pin('d:4:o') # Solenoid valve normally closed, connected to digital pin 4
-waste = board.get_pin('d:5:o') # Solenoid valve normally closed, connected to digital pin 5
-prime = board.get_pin('d:6:o') # Solenoid valve normally closed, connected to digital pin 6
-pump = board.get_pin('d:7:o') # Solenoid micro pump with an internal volume of 20 microliter and maximum pumping speed 2.4 ml/min or 40 microliter/sec, connected to digital pin 7 
+daemonport = config.getint('Parameters', 'daemonport', fallback=6001)
+daemonkey = config.get('Parameters', 'daemonkey', fallback='daemon.key')
+portmapname = PepSy.portmapfile('config.txt') # bottles and line states kept between runs
+psat = 1 # stream selector position set with GO
+
+daemon = PepSy.opendaemon(daemonport, daemonkey)
+if daemon is not None: # devices held open by PepSy-daemon.py
+    ps = PepSy.RemoteSelector(daemon)
+    n2 = PepSy.RemotePin(daemon, 'n2')
+    vent = PepSy.RemotePin(daemon, 'vent')
+    reagent = PepSy.RemotePin(daemon, 'reagent')
+    waste = PepSy.RemotePin(daemon, 'waste')
+    prime = PepSy.RemotePin(daemon, 'prime')
+    pump = PepSy.RemotePin(daemon, 'pump')
+else:
+    import serial
+    from pyfirmata import Arduino
+    ps = serial.Serial(port=pscom, baudrate=9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS) # VICI port selector
+    board = Arduino(arduinocom) # Arduino Uno
+    n2 = board.get_pin('d:2:o') # Solenoid valve normally closed, connected to digital pin 2
+    vent = board.get_pin('d:3:o') # Solenoid valve normally open, connected to digital pin 3
+    reagent = board.get_pin('d:4:o') # Solenoid valve normally closed, connected to digital pin 4
+    waste = board.get_pin('d:5:o') # Solenoid valve normally closed, connected to digital pin 5
+    prime = board.get_pin('d:6:o') # Solenoid valve normally closed, connected to digital pin 6
+    pump = board.get_pin('d:7:o') # Solenoid micro pump with an internal volume of 20 microliter and maximum pumping speed 2.4 ml/min or 40 microliter/sec, connected to digital pin 7 
 
 font16 = ('Helvetica', 16, 'bold')
 font12 = ('Helvetica', 12, 'bold')
@@ -222,6 +321,7 @@ ps2var = StringVar()
 washvar = StringVar()
 cleanstatus = StringVar()
 washstatus = StringVar()
+devstatus = StringVar()
 
 line1Lbl = Label(frame, text = '-----------------------------------------------------------------')
 line1Lbl.grid(row = 1, column = 1, columnspan = 3)
@@ -274,7 +374,7 @@ pumpLbl = Label(frame, text = 'Pump Volume')
 pumpLbl.grid(row = 10, column = 1, pady = 5, sticky = E)
 pumpvol = Entry(frame, textvariable = volvar, width = 5)
 pumpvol.grid(row = 10, column = 2, pady = 5, sticky = E)
-pumpOnBtn = Button(frame, text = ' ON ', command = lambda:_thread.start_new(pumponvol, ()))
+pumpOnBtn = Button(frame, text = ' ON ', command = lambda:pumpStart())
 pumpOnBtn.grid(row = 10, column = 3, pady = 5, sticky = W)
 
 psLbl = Label(frame, text = 'Port')
@@ -303,7 +403,7 @@ ps2Lbl.grid(row = 16, column = 1, sticky = E)
 ps2pos = Entry(frame, textvariable = ps2var, width = 5)
 ps2pos.grid(row = 16, column = 2, sticky = E)
 
-cleanBtn = Button(frame, text = '          CLEAN          ', command = lambda:_thread.start_new(clean, ()))
+cleanBtn = Button(frame, text = '          CLEAN          ', command = lambda:cleanStart())
 cleanBtn.grid(row = 17, column = 1, pady = 5, columnspan = 3)
 
 cleanstatusLbl = Label(frame, textvariable = cleanstatus)
@@ -323,7 +423,7 @@ washLbl.grid(row = 22, column = 1, sticky = E)
 washTimes = Entry(frame, textvariable = washvar, width = 5)
 washTimes.grid(row = 22, column = 2, sticky = E)
 
-washBtn = Button(frame, text = '          WASH          ', command = lambda:_thread.start_new(wash, ()))
+washBtn = Button(frame, text = '          WASH          ', command = lambda:washStart())
 washBtn.grid(row = 23, column = 1, pady = 5, columnspan = 3)
 
 washstatusLbl = Label(frame, textvariable = washstatus)
@@ -335,6 +435,23 @@ line5Lbl.grid(row = 25, column = 1, columnspan = 3)
 resetBtn = Button(frame, text = '       RESET          ', command = lambda:reset())
 resetBtn.grid(row = 26, column = 1, pady = 5, columnspan = 3)
 
+cancelBtn = Button(frame, text = '       CANCEL         ', command = lambda:cancel.set())
+cancelBtn.grid(row = 27, column = 1, pady = 5, columnspan = 3)
+
+devstatusLbl = Label(frame, textvariable = devstatus)
+devstatusLbl.grid(row = 28, column = 1, pady = 5, columnspan = 3)
+if daemon is not None:
+    devstatus.set('Connected to PepSy-daemon.py')
+
+valveBtns = {'n2': (n2OnBtn, n2OffBtn), 'vent': (ventOnBtn, ventOffBtn), 'reagent': (reagentOnBtn, reagentOffBtn), 'waste': (wasteOnBtn, wasteOffBtn), 'prime': (primeOnBtn, primeOffBtn)}
+
+iolock = threading.Lock()
+jobs = queue.Queue() # long operations for the worker
+updates = queue.Queue() # button states and status texts from the worker
+cancel = threading.Event() # set by the CANCEL button, ends the running operation
+threading.Thread(target=worker, daemon=True).start()
+
 reset()
+root.after(100, poll)
 
 root.mainloop()
@@ -0,0 +1,143 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Solution preparation sheet for a queue of runs
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script plans the amino acid/reagent solutions of several queued runs together, so one 0.33 M solution of a residue is made for all the
+# runs it lasts for instead of one small solution per run (see positions() in PepSy.py for a single run).
+# The runs are synthesized one after the other in the order given, from --start, with --gap hours between them to change the resin and the lines.
+# A solution is used for the runs from the first one that needs it until the stability window of the residue would end before a run finishes,
+# then a fresh solution is made. Every solution has one dead volume (len1 + len2, the line from the bottle to the pump that cannot be emptied)
+# on top of what the runs take, each run's volume includes the line priming of its couplings as in positions().
+# One weighing sheet is printed per solution, with the volume to carry over to each run and its position.
+# The positions are planned as PepSy.py places them with the port map of the instrument (see placement() in PepSy.py): the bottles on the
+# ports now stay where they are, and every run leaves its bottles in place for the next one (answer n to the line cleaning between the runs).
+# Stability windows are in hours, 72 h by default and 24 h for His, set them for your own residues and storage with --stability.
+
+# python PepSy-prep.py seq1 seq2 seq3
+# python PepSy-prep.py seq1 seq2 seq3 --start "2020-11-09 08:00" --gap 2 --stability 48 --stability H:12 --out output/prep.txt
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import argparse
+from os import path
+from datetime import datetime, timedelta
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+stability = {'': 72, 'H': 24} # hours a 0.33 M solution can be used, '' for the residues without their own
+
+def seqpath(name): # sequence configuration file given as a path or as a name in the sequence folder
+    if path.exists(name):
+        return name
+    return 'sequence/' + name + '.txt'
+
+def queue(seqfiles, start, gap): # every run with its start, end, and the volume and position of every amino acid/reagent per part
+    runs = []
+    t = start
+    PepSy.bottles = {}
+    PepSy.seedlines() # the bottles on the ports now, from the port map of the instrument
+    for seqfile in seqfiles:
+        PepSy.loadsequence(seqpath(seqfile))
+        if len(set(x for x in PepSy.seq if x not in PepSy.ignore)) <= PepSy.ports - 7:
+            parts = [PepSy.seq]
+        else:
+            parts = PepSy.split(PepSy.seq)
+        needs = [] # (residue, part, position, ml)
+        c = []
+        d = []
+        for k in range(len(parts)):
+            PepSy.residuesdone = sum(len(x) for x in parts[:k]) # the double couplings of the sequence configuration file, numbered as in run()
+            if PepSy.pa.upper() == 'Y':
+                pl = PepSy.plan(parts[k], PepSy.ss, None, PepSy.doubled(parts[k]))
+                pl = PepSy.plan(parts[k], PepSy.ss, PepSy.placement(pl['paak']), PepSy.doubled(parts[k])) # as positions() in PepSy.py
+            else:
+                pl = PepSy.plan(parts[k], PepSy.ss, PepSy.synconfig['Positions'], PepSy.doubled(parts[k]))
+            PepSy.bottles.update(zip(pl['paap'], pl['paak'])) # left on their ports for the next part or run
+            for n in range(len(pl['paak'])):
+                needs.append((pl['paak'][n], k+1, pl['paap'][n], pl['vol'][n]))
+            c.extend(pl['c'])
+            d.extend(pl['d'])
+        end = t + timedelta(seconds=PepSy.estimate(c, d, PepSy.ss))
+        runs.append({'name': PepSy.seqname, 'start': t, 'end': end, 'parts': len(parts), 'needs': needs})
+        t = end + timedelta(hours=gap)
+    return runs
+
+def solutions(runs): # solutions to make in order of use, each {'residue', 'made', 'uses': [(run, part, position, ml)]}
+    made = []
+    current = {} # residue: solution in use
+    for run in runs:
+        for residue, part, position, ml in run['needs']:
+            window = timedelta(hours=stability.get(residue.upper(), stability['']))
+            solution = current.get(residue)
+            if solution is None or run['end'] > solution['made'] + window:
+                solution = {'residue': residue, 'made': run['start'], 'uses': []}
+                made.append(solution)
+                current[residue] = solution
+            solution['uses'].append((run, part, position, ml))
+    return made
+
+def weighing(residue, ml): # amino acid weight in mg and DMF in microliters of a 0.33 M solution, as in plan()
+    wt = ml*PepSy.residue(residue)['mw']*0.33
+    return wt, ml*1000 - wt
+
+def sheet(runs, made, dead): # the weighing sheets and the saving against one solution per run, as lines
+    text = []
+    text.append('Runs')
+    for run in runs:
+        text.append(run['name'].ljust(20) + run['start'].strftime('%a %m-%d-%Y %I:%M %p') + ' to ' + run['end'].strftime('%a %m-%d-%Y %I:%M %p') + ('' if run['parts'] == 1 else '   ' + str(run['parts']) + ' parts'))
+    text.append(' ')
+    for k, solution in enumerate(made):
+        residue = solution['residue']
+        ml = sum(x[3] for x in solution['uses']) + dead/1000
+        wt, dmf = weighing(residue, ml)
+        last = solution['uses'][-1][0]
+        text.append('-----------------------------------------------------------------------------')
+        text.append('Solution ' + str(k+1) + ': ' + residue + ', make before ' + solution['made'].strftime('%a %m-%d-%Y %I:%M %p') + ', use until ' + last['end'].strftime('%a %m-%d-%Y %I:%M %p'))
+        if PepSy.residue(residue)['mw']:
+            text.append(str("{:.1f}".format(ml)) + ' ml: ' + str("{:.0f}".format(wt)) + ' mg amino acid in ' + str("{:.0f}".format(dmf)) + ' ul DMF (0.33 M)')
+        else:
+            text.append(str("{:.1f}".format(ml)) + ' ml (no molecular weight for ' + residue + ', weigh as for a single run)')
+        for run, part, position, ml1 in solution['uses']:
+            text.append('    ' + run['name'].ljust(20) + ('part ' + str(part) if run['parts'] > 1 else '').ljust(8) + 'position ' + str(position).ljust(4) + str("{:.1f}".format(ml1)).rjust(6) + ' ml')
+    text.append('-----------------------------------------------------------------------------')
+    single = sum(len(set(x[0] for x in run['needs'])) for run in runs) # one solution per residue and run
+    wt1 = sum(weighing(residue, ml + dead/1000)[0] for residue, ml in perrun(runs))
+    wt2 = sum(weighing(s['residue'], sum(x[3] for x in s['uses']) + dead/1000)[0] for s in made)
+    text.append(str(len(made)) + ' solutions instead of ' + str(single) + ' (one per residue and run), ' + str("{:.0f}".format(wt1 - wt2)) + ' mg amino acid saved')
+    return text
+
+def perrun(runs): # (residue, ml) of every residue of every run
+    totals = []
+    for run in runs:
+        ml = {}
+        for residue, part, position, ml1 in run['needs']:
+            ml[residue] = ml.get(residue, 0) + ml1
+        totals.extend(ml.items())
+    return totals
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solution preparation sheet for a queue of PepSy runs')
+    parser.add_argument('seqfiles', nargs='+', help='sequence configuration files in the order they are run, paths or names in the sequence folder')
+    parser.add_argument('--start', help='start of the first run, e.g., "2020-11-09 08:00" (default now)')
+    parser.add_argument('--gap', type=float, default=1, help='hours between two runs (default 1)')
+    parser.add_argument('--stability', action='append', default=[], help='hours a solution can be used, for all residues (72) or one (H:24), can be given more than once')
+    parser.add_argument('--out', help='also write the sheet to this file')
+    args = parser.parse_args()
+
+    for entry in args.stability:
+        residue, hours = entry.split(':') if ':' in entry else ('', entry)
+        stability[residue.strip().upper()] = float(hours)
+    PepSy.loaddevice()
+    start = datetime.strptime(args.start, '%Y-%m-%d %H:%M') if args.start else datetime.now()
+    runs = queue(args.seqfiles, start, args.gap)
+    text = sheet(runs, solutions(runs), PepSy.len1 + PepSy.len2)
+    for line in text:
+        print(line)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write('\n'.join(text) + '\n')
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
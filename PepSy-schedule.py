@@ -0,0 +1,69 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Operator schedule
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script predicts when a run of a sequence configuration file needs the operator, from the simulated step times (see steptimes() in
+# PepSy.py) and the staffed hours of the lab (staffed in the device configuration file, or --staffed).
+# Interventions: the manual couplings ('#'), the pauses ('*'), the two additions of an on-resin oxidation ('@'), the line reloading of a split
+# sequence, and the line cleaning during drying (put off until after drying when nobody is expected, it holds up nothing).
+# The synthesis waits (idle) from a manual step outside the staffed hours until the next staffed hour, with the resin held in DMF. The start time
+# within the next days with the least idle time is suggested.
+
+# python PepSy-schedule.py templete.txt
+# python PepSy-schedule.py templete.txt --start "2020-11-06 16:00"
+# python PepSy-schedule.py templete.txt --staffed "mon-fri 08:00-18:00, sat 09:00-12:00" --days 3
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import sys
+import argparse
+from os import path
+from datetime import datetime
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+def seqpath(name): # sequence configuration file given as a path or as a name in the sequence folder
+    if path.exists(name):
+        return name
+    return 'sequence/' + name + '.txt'
+
+def show(events, start): # prints the interventions of a run started at start and returns its idle seconds
+    times, idle = PepSy.schedule(events, start)
+    print('Start'.ljust(14) + start.strftime('%a %m-%d-%Y %I:%M %p'))
+    for due, answered, step, residue in times[1:]:
+        print((step + ' ' + residue).strip().ljust(14) + due.strftime('%a %m-%d-%Y %I:%M %p') + ('' if answered == due else '   no operator until ' + answered.strftime('%a %m-%d-%Y %I:%M %p')))
+    print('Idle time waiting for the operator = ' + str("{:.1f}".format(idle/3600)) + ' h')
+    return idle
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict when a PepSy run needs the operator')
+    parser.add_argument('seqfile', help='sequence configuration file, a path or a name in the sequence folder')
+    parser.add_argument('--start', help='start of the run, e.g., "2020-11-06 16:00" (default now)')
+    parser.add_argument('--staffed', help='staffed hours, e.g., "mon-fri 08:00-18:00" (default staffed in config.txt)')
+    parser.add_argument('--days', type=int, default=7, help='days searched for the start time with the least idle time (default 7)')
+    args = parser.parse_args()
+
+    PepSy.loaddevice()
+    if args.staffed is not None:
+        PepSy.staffed = PepSy.staffedhours(args.staffed)
+    if not PepSy.staffed:
+        print('No staffed hours, set staffed in config.txt or use --staffed')
+        sys.exit(1)
+    if path.exists(PepSy.historyname):
+        history = PepSy.openhistory(PepSy.historyname)
+        PepSy.overheads = PepSy.stepoverheads(history) # as in a run
+        history.close()
+    PepSy.loadsequence(seqpath(args.seqfile))
+    events = PepSy.interventions(PepSy.runparts(PepSy.seq), PepSy.ss)
+    start = datetime.strptime(args.start, '%Y-%m-%d %H:%M') if args.start else datetime.now()
+    idle = show(events, start)
+    when, idle1 = PepSy.beststart(events, start, args.days)
+    if idle1 < idle:
+        print(' ')
+        print('Suggested start')
+        show(events, when)
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
@@ -0,0 +1,109 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Golden trace recording and comparison
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script records the device command trace of a simulated run and compares it with a stored golden trace.
+# A trace lists every stream selector command, pin write, pump volume, heater setpoint and operator question (asked and answered) of a run in
+# order, one per line (see record() in PepSy.py).
+# Runs are simulated on a virtual clock, so a full synthesis is traced in seconds without the stream selector and the Arduino.
+# Traces written by PepSy.py during a real run (output/<name>-<date>-trace.txt) can be compared in the same way.
+
+# Record a golden trace:                  python PepSy-trace.py record templete.txt golden/templete.txt
+# Check the current build against it:     python PepSy-trace.py check templete.txt golden/templete.txt
+# Compare two stored traces:              python PepSy-trace.py diff golden/templete.txt output/templete-2020-11-05-trace.txt
+# Add --timing to also compare the times of the commands.
+# The exit status is 1 when the traces differ.
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import sys
+import argparse
+from os import path, remove, close
+from difflib import unified_diff
+from tempfile import mkstemp
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+def seqpath(name): # sequence configuration file given as a path or as a name in the sequence folder
+    if path.exists(name):
+        return name
+    return 'sequence/' + name + '.txt'
+
+def readtrace(tracename): # list of (time, command) from a trace file
+    events = []
+    for line in open(tracename):
+        line = line.rstrip('\n')
+        if line == '' or line.startswith('#'):
+            continue
+        t, command = line.split('\t', 1)
+        events.append((float(t), command))
+    return events
+
+def summary(events): # run time, number of commands and pumped volume per stream selector position
+    volumes = {}
+    position = 'HM'
+    for t, command in events:
+        fields = command.split('\t')
+        if fields[0] == 'ps':
+            position = fields[1]
+        elif fields[0] == 'pump':
+            volumes[position] = volumes.get(position, 0) + int(fields[1])
+    runtime = events[-1][0] if events else 0
+    return runtime, len(events), volumes
+
+def compare(golden, new, timing=False, tolerance=0.01): # prints the differences between two traces and returns True if they match
+    if timing:
+        lines1 = ['{:.2f}'.format(t) + '\t' + command for t, command in golden]
+        lines2 = ['{:.2f}'.format(t) + '\t' + command for t, command in new]
+        same = len(golden) == len(new) and all(c1 == c2 and abs(t1 - t2) <= tolerance for (t1, c1), (t2, c2) in zip(golden, new))
+    else:
+        lines1 = [command for t, command in golden]
+        lines2 = [command for t, command in new]
+        same = lines1 == lines2
+    runtime1, count1, volumes1 = summary(golden)
+    runtime2, count2, volumes2 = summary(new)
+    print('Golden trace: ' + str(count1) + ' commands, ' + str("{:.1f}".format(runtime1/3600)) + ' h')
+    print('New trace:    ' + str(count2) + ' commands, ' + str("{:.1f}".format(runtime2/3600)) + ' h')
+    for position in sorted(set(volumes1) | set(volumes2)):
+        if volumes1.get(position, 0) != volumes2.get(position, 0):
+            print('Pumped volume at ' + position + ' changed from ' + str(volumes1.get(position, 0)) + ' ul to ' + str(volumes2.get(position, 0)) + ' ul')
+    if same:
+        print('Traces match')
+        return True
+    print(' ')
+    for line in unified_diff(lines1, lines2, 'golden', 'new', n=5, lineterm=''):
+        print(line)
+    print(' ')
+    print('Traces differ')
+    return False
+
+def record(seqfile, tracename): # simulates a run and writes its trace
+    runtime = PepSy.simulate(seqfile, tracename)
+    print('Trace of ' + seqfile + ' written to ' + tracename + ' (' + str("{:.1f}".format(runtime/3600)) + ' h simulated)')
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record and compare PepSy device command traces')
+    parser.add_argument('action', choices=['record', 'check', 'diff'])
+    parser.add_argument('first', help='sequence configuration file (record, check) or golden trace (diff)')
+    parser.add_argument('second', help='trace file to write (record), golden trace (check) or new trace (diff)')
+    parser.add_argument('--timing', action='store_true', help='also compare the times of the commands')
+    args = parser.parse_args()
+
+    if args.action == 'record':
+        record(seqpath(args.first), args.second)
+        sys.exit(0)
+    if args.action == 'check':
+        handle, tracename = mkstemp(suffix='-trace.txt')
+        close(handle)
+        PepSy.simulate(seqpath(args.first), tracename)
+        new = readtrace(tracename)
+        remove(tracename)
+        same = compare(readtrace(args.second), new, args.timing)
+    else:
+        same = compare(readtrace(args.first), readtrace(args.second), args.timing)
+    sys.exit(0 if same else 1)
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
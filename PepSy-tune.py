@@ -0,0 +1,116 @@
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# PepSy - Protocol autotuner
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# This script searches the protocol parameters of a sequence configuration file against the simulator (see simulate() in PepSy.py) and prints
+# the Pareto set of run time against solvent (DMF and DCM) use: no other protocol in the search is both faster and uses less solvent.
+# Protocol parameters (optional in the sequence configuration file, the defaults are the protocol optimized for 50 or 100 umol scale):
+# washes           - DMF washes after every coupling, deprotection and reagent step, default 5
+# washvol          - microliters of DMF per wash, default 2000
+# washdrain        - seconds of draining after a wash (the upper limit with a drain sensor), default 60
+# couplingtime     - minutes of a coupling at room temperature, default 60 (heat profiles set their own)
+# deprotectiontime - minutes of the first/second round of fmoc deprotection, default 10/20 (the second round ends on the UV plateau with a detector)
+# Protocols outside the safety constraints (--minwashes, --minwashvolume, --mincoupling, --mindeprotection, --mindrain) are not simulated.
+# A protocol is only as good as the simulated reactor, check a new protocol on a short test sequence before using it for a long one.
+
+# python PepSy-tune.py templete.txt
+# python PepSy-tune.py templete.txt --grid washes=3,4,5,6 --grid couplingtime=20,30,45,60 --mincoupling 20
+# python PepSy-tune.py templete.txt --drainsensor --minwashvolume 8
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Imports
+import sys
+import argparse
+import itertools
+from os import path
+import PepSy
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Functions
+grids = { # values searched by default
+    'washes': ['3', '4', '5'],
+    'washvol': ['1000', '1500', '2000'],
+    'washdrain': ['30', '45', '60'],
+    'couplingtime': ['30', '45', '60'],
+    'deprotectiontime': ['5/10', '5/15', '10/20'],
+}
+
+def seqpath(name): # sequence configuration file given as a path or as a name in the sequence folder
+    if path.exists(name):
+        return name
+    return 'sequence/' + name + '.txt'
+
+def protocol(setting): # sequence configuration file values of a protocol as the PepSy.py parameters
+    return {
+        'washes': int(setting['washes']),
+        'washvol': int(setting['washvol']),
+        'washdrain': float(setting['washdrain']),
+        'couplingtime': float(setting['couplingtime'])*60,
+        'deprotectiontime': tuple(float(x)*60 for x in setting['deprotectiontime'].split('/')),
+    }
+
+def safe(p, args): # True when a protocol is within the safety constraints
+    return (p['washes'] >= args.minwashes and p['washes']*p['washvol'] >= args.minwashvolume*1000 and p['couplingtime'] >= args.mincoupling*60
+            and sum(p['deprotectiontime']) >= args.mindeprotection*60 and p['washdrain'] >= args.mindrain)
+
+def evaluate(seqfile, setting, drainsensor): # simulated run time in seconds and solvent in ml of a protocol
+    runtime = PepSy.simulate(seqfile, drainsensor=drainsensor, protocol=protocol(setting))
+    return runtime, (PepSy.pump.pin.volumes.get(2, 0) + PepSy.pump.pin.volumes.get(3, 0))/1000
+
+def pareto(results): # (run time, solvent, setting) not beaten in both by another result, fastest first
+    front = []
+    for runtime, solvent, setting in sorted(results, key=lambda x: (x[0], x[1])):
+        if not front or solvent < front[-1][1]:
+            front.append((runtime, solvent, setting))
+    return front
+
+def lines(setting): # the protocol as sequence configuration file lines
+    return ', '.join(x + ' = ' + setting[x] for x in grids)
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the PepSy protocol parameters for the Pareto set of run time against solvent use')
+    parser.add_argument('seqfile', help='sequence configuration file, a path or a name in the sequence folder')
+    parser.add_argument('--grid', action='append', default=[], help='NAME=V1,V2,... values searched for a protocol parameter, e.g., washes=3,4,5,6')
+    parser.add_argument('--drainsensor', action='store_true', help='simulate a drain sensor even if none is configured')
+    parser.add_argument('--minwashes', type=int, default=3, help='fewest washes after a step (default 3)')
+    parser.add_argument('--minwashvolume', type=float, default=5, help='least DMF in ml used to wash after a step (default 5)')
+    parser.add_argument('--mincoupling', type=float, default=30, help='shortest coupling in minutes (default 30)')
+    parser.add_argument('--mindeprotection', type=float, default=15, help='shortest fmoc deprotection (both rounds) in minutes (default 15)')
+    parser.add_argument('--mindrain', type=float, default=30, help='shortest wash draining in seconds (default 30)')
+    args = parser.parse_args()
+
+    for entry in args.grid:
+        name, values = entry.split('=', 1)
+        if name not in grids:
+            parser.error('unknown protocol parameter ' + name + ', use ' + ', '.join(grids))
+        grids[name] = [x.strip() for x in values.split(',')]
+    seqfile = seqpath(args.seqfile)
+    drainsensor = True if args.drainsensor else None
+
+    PepSy.loadsequence(seqfile) # the protocol of the sequence configuration file
+    current = {'washes': str(PepSy.washes), 'washvol': str(PepSy.washvol), 'washdrain': str("{:g}".format(PepSy.washdrain)),
+               'couplingtime': str("{:g}".format(PepSy.couplingtime/60)), 'deprotectiontime': '/'.join(str("{:g}".format(x/60)) for x in PepSy.deprotectiontime)}
+    runtime0, solvent0 = evaluate(seqfile, current, drainsensor)
+    print('Current protocol: ' + str("{:.1f}".format(runtime0/3600)) + ' h, ' + str("{:.0f}".format(solvent0)) + ' ml solvent (' + lines(current) + ')')
+
+    settings = [dict(zip(grids, values)) for values in itertools.product(*grids.values())]
+    settings = [x for x in settings if safe(protocol(x), args)]
+    if not settings:
+        print('No protocol of the search is within the safety constraints')
+        sys.exit(1)
+    print('Simulating ' + str(len(settings)) + ' protocols within the safety constraints')
+    results = []
+    for k, setting in enumerate(settings):
+        runtime, solvent = evaluate(seqfile, setting, drainsensor)
+        results.append((runtime, solvent, setting))
+        if (k + 1) % 25 == 0:
+            print(str(k + 1) + ' of ' + str(len(settings)))
+    print(' ')
+    print('Pareto set, run time against solvent')
+    print('Run time (h)'.rjust(12) + 'Change'.rjust(9) + 'Solvent (ml)'.rjust(14) + 'Change'.rjust(9) + '   Sequence configuration file')
+    for runtime, solvent, setting in pareto(results):
+        print(str("{:.1f}".format(runtime/3600)).rjust(12) + str("{:+.0f}".format(100*(runtime - runtime0)/runtime0)).rjust(8) + '%' + str("{:.0f}".format(solvent)).rjust(14) + str("{:+.0f}".format(100*(solvent - solvent0)/solvent0)).rjust(8) + '%   ' + lines(setting))
+# -------------------------------------------------------------------------------------------------------------------------------------------
+# END
+# -------------------------------------------------------------------------------------------------------------------------------------------
@@ -50,16 +50,71 @@
 # '@' is used for onresin oxidation and add the thallium solution manually.
 # '$' is used for endcapping and place the acetic anhydride solution in the position assigned to '$'.
 # '^' and '&' are used for any unusual amino acid or molecule that needs double coupling.
+# The symbols and their molecular weights, couplings, deprotections and ports are read from residues.txt, add a row there for a new building block.
+
+# A UV detector in the waste line below the reactor frit (uvpin in the device configuration file) monitors the dibenzofulvene-piperidine adduct
+# released by fmoc deprotection. The second round of deprotection then ends when the release has plateaued, or is extended until it does.
+# The release curves are saved in the output folder (<name>-<date>-uv.txt).
+
+# Couplings can be heated with a heater and a temperature probe on spare Arduino pins (heaterpin and probepin in the device configuration file).
+# The temperature is held by a PID loop on its own thread, and the temperature and time of every coupling are set per residue in the sequence
+# configuration file (heat = 75/10, C:50/10, H:50/10, in degree C/min). A coupling is timed from when the reactor reaches its temperature.
+
+# The N2 bubbling that agitates the resin during swelling, couplings, deprotections, oxidation, end capping and drying can be pulsed to save gas
+# and DMF evaporation (agitation in the device configuration file, e.g., coupling:10/60 for 10 s on in every 60 s). The bubbling saved is
+# reported at the end of the run, in liters with the N2 flow rate (n2flow).
+
+# Every run is recorded in the run history database (output/history.db): the steps with their planned and actual durations, the operator
+# waits, and the volumes pumped from every position. PepSy-history.py queries it, and the mean overhead of every step type over the last
+# 90 days is added to the estimated synthesis time.
+
+# With the staffed hours of the lab in the device configuration file (staffed = mon-fri 08:00-18:00), the times at which the manual steps of a
+# run ('#', '*', '@' and the line cleaning) need the operator are predicted before the run starts, with the expected idle time and the start
+# time that keeps them in staffed hours (also PepSy-schedule.py). Outside the staffed hours the resin waits for the operator in DMF, and the
+# lines are cleaned after drying, so that the final washing and drying need nobody.
+
+# The rest of a run can be changed while it runs: save the sequence configuration file with a new sequence (the amino acids already coupled
+# unchanged, e.g., a pause added, or the N-terminal amino acids removed to stop after an amino acid) or new double couplings (double = 12, 15),
+# or call edit() from another script. The edit is checked before the next amino acid against the loaded ports and the solutions left, and the
+# rest of the run and its estimated end are planned again. Amino acids that are not on the loaded lines are synthesized in new parts.
+
+# A run can be stopped at any time with Ctrl-C, a kill signal, or stop() from another script (e.g., PepSy-fleet.py). The wait or pump train
+# in progress ends within 0.1 s, the pump and the heater are stopped, all valves are switched off and the stream selector is sent home.
+# A resume file is then written next to the sequence configuration file (<name>-resume.txt), it starts the synthesis again from the first
+# coupling or deprotection that was not finished.
+
+# The pump strokes are timed by PepSy-daemon.py in its own process, at high priority when the operating system lets it, so writing the output
+# file, printing and the run history never stretch a stroke. PepSy.py starts the daemon for the run when it is not running (deviceprocess = n
+# in the device configuration file opens the devices in this process instead). How late the pump edges were is reported at the end of the run.
+
+# The bottle on every port and whether its line is primed are kept between runs in the port map of the instrument (output/config-portmap.txt
+# for config.txt). A run places its amino acids/reagents on the ports whose bottles they already are, lists only the bottles to place, and
+# does not prime again a line primed with the same solution less than primedhours ago (device configuration file, default 24). The lines
+# cleaned at the end of a run are taken out of their bottles, the next run places them again.
+
+# Steps that follow each other repeat some work at their boundary. Unless the run is strict (strict = y in the sequence configuration file),
+# these boundary operations are left out under the chemistry rules in fusions: the DMF chase before the washes of a deprotection, oxidation
+# or end capping (the first wash pushes the reagent left in the tubing to the resin), and the 10 s drain after the line priming of a coupling,
+# deprotection or end capping (the line is primed during the last wash of the step before). The time and DMF saved are reported.
 # -------------------------------------------------------------------------------------------------------------------------------------------
 
 # Imports
-from os import path, mkdir, chdir
-from time import sleep
-from datetime import datetime
-from configparser import ConfigParser
-from pyfirmata import Arduino, util
+from os import path, mkdir, chdir, devnull
+from time import monotonic
+from datetime import datetime, timedelta
+from configparser import ConfigParser, Error
 from collections import Counter
-import serial
+from contextlib import redirect_stdout
+from math import exp, log
+import importlib.util
+import json
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
 # -------------------------------------------------------------------------------------------------------------------------------------------
 
 # Functions
@@ -72,116 +127,540 @@ def filewrite(info):
     file.write(info + '\n')
     print(info)
     file.close()
+
+def ask(prompt=''): # question to the operator, the time waited for the answer is recorded in the run history
+    global asking
+    start = now()
+    record('ask', prompt.strip())
+    asking = True # a Ctrl-C ends the question, see interrupted()
+    try:
+        answer = input(prompt)
+    finally:
+        asking = False
+    record('answered')
+    waits.append((prompt, started(start), now() - start))
+    return answer
+
+def started(start): # local date and time of a moment of the run clock
+    return (datetime.now() - timedelta(seconds=now() - start)).strftime('%Y-%m-%d %H:%M:%S')
+
+def openhistory(name): # run history database, the tables are created when it is new
+    db = sqlite3.connect(name, timeout=60) # several instruments of PepSy-fleet.py write to it, a write waits up to 60 s for the others
+    db.execute('pragma journal_mode=wal') # readers (e.g., PepSy-history.py) do not block the writers
+    db.executescript('''
+        create table if not exists runs (id integer primary key, name text, sequence text, ss integer, started text, ended text, planned real, actual real);
+        create table if not exists steps (id integer primary key, run integer, residue text, step text, started text, planned real, actual real, waited real);
+        create table if not exists interventions (id integer primary key, run integer, step integer, prompt text, started text, waited real);
+        create table if not exists volumes (run integer, position integer, content text, ul integer);
+        create index if not exists runsbysequence on runs (sequence);
+        create index if not exists stepsbyrun on steps (run);
+        create index if not exists stepsbystep on steps (step, started);
+        create index if not exists stepsbyresidue on steps (residue, step);
+    ''')
+    return db
+
+def stepoverheads(db, days=90): # mean seconds by which every step type overran its simulated time in the last days, operator waits not included
+    overheads = {}
+    query = "select step, avg(actual - planned - waited) from steps where planned is not null and started >= datetime('now', 'localtime', ?) group by step"
+    for step, overhead in db.execute(query, ('-' + str(days) + ' days',)):
+        overheads[step] = overhead
+    return overheads
+
+def historyfailed(error): # a run history write failed (e.g., the database stayed locked by another instrument), the synthesis goes on without it
+    try:
+        history.rollback()
+    except sqlite3.Error:
+        pass
+    filewrite('Warning: the run history could not be written (' + str(error) + '), the synthesis goes on')
+
+def logstep(kind, residue, start): # records a finished step in the run history with its planned and actual seconds and the operator waits during it
+    global waits
+    if history is not None:
+        try:
+            cur = history.execute('insert into steps (run, residue, step, started, planned, actual, waited) values (?, ?, ?, ?, ?, ?, ?)',
+                                  (runid, residue, kind, started(start), steptimes(ss).get(kind), now() - start, sum(w for p, t, w in waits)))
+            for prompt, t, w in waits:
+                history.execute('insert into interventions (run, step, prompt, started, waited) values (?, ?, ?, ?, ?)', (runid, cur.lastrowid, prompt, t, w))
+            history.commit()
+        except sqlite3.Error as error:
+            historyfailed(error)
+    waits = []
+
+def record(*event): # writes a device command to the trace file, one line per command with the seconds since the run started
+    if tracefile is not None:
+        tracefile.write(str("{:.2f}".format(now() - t0)) + '\t' + '\t'.join(str(x) for x in event) + '\n')
+
+class Pin: # Arduino output pin, every valve and pump write goes through here so that it can be traced
+    def __init__(self, pin, name):
+        self.pin = pin
+        self.name = name
+        self.state = None # shadow of the value on the pin, None when it is not known
+
+    def write(self, value): # writes that would not change the pin are skipped, each one saves a serial round-trip
+        if value == self.state:
+            skipped['pin'] += 1
+            return
+        with iolock:
+            if abort.is_set() and value != 0: # nothing is switched on after a stop, switching off still works (e.g., the N2 pulsing)
+                raise Stopped()
+            record('pin', self.name, value)
+            self.pin.write(value)
+        self.state = value
+
+class Busy(Exception): # the device is owned by another client of PepSy-daemon.py
+    pass
+
+class Stopped(Exception): # the run was stopped, see stop()
+    pass
+
+def request(conn, message): # sends a request to PepSy-daemon.py and returns its answer
+    with iolock: # the heater thread shares the connection
+        conn.send(message)
+        reply = conn.recv()
+    if reply[0] == 'busy':
+        raise Busy(reply[1])
+    if reply[0] == 'error':
+        raise RuntimeError('PepSy-daemon.py refused the request: ' + reply[1])
+    return reply[1]
+
+class DaemonConnection: # connection to PepSy-daemon.py, one JSON array per line each way (see the requests there)
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rw', encoding='utf-8', newline='\n')
+
+    def send(self, message):
+        self.file.write(json.dumps(message) + '\n')
+        self.file.flush()
+
+    def recv(self):
+        line = self.file.readline()
+        if not line:
+            raise EOFError
+        return json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def opendaemon(port, keyname='daemon.key'): # connection to PepSy-daemon.py, None when it is not running, keyname is its key file in the PepSy folder
+    keyname = path.join(path.dirname(path.abspath(__file__)), keyname)
+    try:
+        key = open(keyname).read().strip()
+    except FileNotFoundError: # written by the daemon when it starts
+        return None
+    except OSError:
+        print(keyname + ' cannot be read, PepSy-daemon.py is not used (start it once as the instrument account, see PepSy-daemon.py)')
+        return None
+    try:
+        conn = DaemonConnection(socket.create_connection(('localhost', port)))
+        conn.send(('key', key))
+        reply = conn.recv()
+    except (OSError, EOFError, ValueError):
+        return None
+    if reply[0] != 'ok':
+        print('PepSy-daemon.py refused the key of ' + keyname)
+        conn.close()
+        return None
+    return conn
+
+class RemotePin: # output pin of the Arduino held open by PepSy-daemon.py
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+
+    def write(self, value):
+        request(self.conn, ('pin', self.name, value))
+
+class RemoteSelector: # stream selector held open by PepSy-daemon.py, it stays open between commands
+    def __init__(self, conn):
+        self.conn = conn
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        request(self.conn, ('ps', data.decode()))
+
+class RemoteSensor: # drain sensor or UV detector on an analog pin of the Arduino held open by PepSy-daemon.py, it can be read by any client
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+
+    def read(self):
+        return request(self.conn, ('sensor', self.name))
+
+class PID: # PID controller, output 0 to 1
+    def __init__(self, kp, ki, kd):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.error = None
+
+    def update(self, error, dt):
+        derivative = 0.0 if self.error is None else (error - self.error)/dt
+        self.error = error
+        output = self.kp*error + self.ki*(self.integral + error*dt) + self.kd*derivative
+        if 0 < output < 1: # no integration while the heater is saturated (anti-windup)
+            self.integral += error*dt
+        return min(1.0, max(0.0, output))
+
+class Heater: # reactor heater (PWM pin) and temperature probe (analog pin) held at a setpoint by a PID loop, on its own thread or stepped by the simulation clock
+    def __init__(self, pin, probe):
+        self.pin = pin
+        self.probe = probe
+        self.pid = PID(*pidgains)
+        self.setpoint = None # degree C, None when the heater is off
+        self.duty = 0.0
+
+    def temperature(self): # degree C, None until the board has reported a value
+        value = self.probe.read()
+        if value is None:
+            return None
+        return value*probescale
+
+    def set(self, setpoint):
+        if setpoint != self.setpoint:
+            record('heat', setpoint if setpoint is not None else 'off')
+            self.pid.reset()
+            self.setpoint = setpoint
+            if setpoint is None:
+                self.control(1.0) # heater off now, not on the next step of the loop
+
+    def control(self, dt): # one step of the control loop
+        temperature = self.temperature()
+        if self.setpoint is None or temperature is None or abort.is_set(): # off at once after a stop
+            duty = 0.0
+        else:
+            duty = self.pid.update(self.setpoint - temperature, dt)
+        if duty != self.duty:
+            with iolock:
+                self.pin.write(duty)
+            self.duty = duty
+
+    def loop(self):
+        while True:
+            self.control(1.0)
+            stopped.wait(1.0)
+
+    def start(self):
+        threading.Thread(target=self.loop, daemon=True).start()
+
+class Agitator: # pulses the N2 bubbling of an incubation, on for the first seconds of every period, on its own thread or stepped by the simulation clock
+    def __init__(self, pin):
+        self.pin = pin
+        self.pulse = None # (seconds on, period in seconds) of the current incubation, None when the N2 is not pulsed
+        self.start = 0
+        self.saved = 0.0 # seconds the N2 was off during the pulsed incubations of the run
+
+    def set(self, pulse): # pulse None ends the pulsing, the N2 is left on
+        with iolock:
+            self.pulse = pulse
+            self.start = now()
+            if self.pin.state != 1:
+                self.pin.write(1)
+
+    def control(self, dt): # one step of the pulsing
+        with iolock:
+            if self.pulse is None or abort.is_set(): # the N2 is switched off by safe() after a stop
+                return
+            if self.pin.state == 0:
+                self.saved += dt
+            on, period = self.pulse
+            self.pin.write(1 if (now() - self.start) % period < on else 0)
+
+    def loop(self):
+        while True:
+            self.control(1.0)
+            stopped.wait(1.0)
+
+    def start(self):
+        threading.Thread(target=self.loop, daemon=True).start()
+
+def release(): # lets other clients of PepSy-daemon.py (e.g., PepSy-manual.py) operate the device, while the run waits for the operator
+    if daemon is not None:
+        request(daemon, ('release',))
+
+def acquire(): # takes the device back, PepSy-manual.py commands are refused until the next release()
+    if daemon is not None:
+        while True:
+            try:
+                request(daemon, ('acquire', 'PepSy.py'))
+                return
+            except Busy as owner:
+                ask('The device is in use by ' + str(owner) + ', finish there and press ENTER to continue')
+
+def resync(): # forgets the shadow state of the pins and the stream selector, the next command to each of them is sent even if it changes nothing
+    global psposition
+    for p in (n2, vent, reagent, waste, prime, pump):
+        p.state = None
+    psposition = None
+    tubing.forget()
     
-def positions(p):
-    mwdict = {'A':329.36, 'C':585.72, 'D':411.45, 'E':425.48, 'F':387.44, 'G':297.31, 'H':619.72, 'I':353.42, 'K':468.2, 'L':353.42, 'M':371.45, 'N':596.68, 'P':337.38, 'Q':610.71, 'R':648.78, 'S':383.44,
-              'T':379.48, 'V':339.39, 'W':526.59, 'Y':459.54, '3':311.3, '4':325.4, '5':339.4, '6':353.3, '8':381.5, 'X':385.42, 'B':429.47, 'Z':572.74} # molecular weight of standard fmoc-protected amino acids
-    paap = [] # positions for different amino acids and reagents
+def safe(): # pump and heater stopped, valves switched off and stream selector home, e.g., after an error or a stop, whatever the shadow state says
+    global psposition
+    with iolock:
+        if daemon is not None:
+            request(daemon, ('halt',)) # ends the pump train in the device process
+        if agitator is not None:
+            agitator.pulse = None
+        if heater is not None:
+            heater.set(None)
+        for p in (pump, prime, reagent, n2, waste, vent):
+            record('pin', p.name, 0)
+            p.pin.write(0)
+            p.state = 0
+        record('ps', 'HM')
+        ps.open()
+        ps.write('HM\r'.encode())
+        ps.close()
+        psposition = 1
+
+def wait(t): # sleep of the run that ends within 0.1 s of a stop
+    end = monotonic() + t
+    while not abort.wait(min(max(0, end - monotonic()), 0.1)):
+        if monotonic() >= end:
+            return
+    raise Stopped()
+
+def stop(reason='stop()'): # emergency stop from any thread, the run ends at its next wait, pump stroke or device command and the device is set to a safe state at once
+    global stopinfo
+    start = monotonic()
+    abort.set()
+    record('stop', reason)
+    safe()
+    stopinfo = (reason, monotonic() - start)
+
+def interrupted(signum, frame): # Ctrl-C or a kill signal during a run, the main thread may be in the middle of a device command so nothing is sent from here: the run ends at its next wait, pump stroke or device command and unwound() sets the device safe
+    global stopinfo, stopat
+    if not abort.is_set():
+        stopat = monotonic()
+        stopinfo = ('Ctrl-C' if signum == signal.SIGINT else 'signal ' + str(signum), None)
+        abort.set()
+        if asking: # input() goes on waiting after a signal, no device command is in progress
+            raise Stopped()
+
+def unwound(): # sets the device safe after a stop of interrupted(), once the run has unwound
+    global stopinfo
+    reason, latency = stopinfo
+    if latency is None:
+        record('stop', reason)
+        safe()
+        stopinfo = (reason, monotonic() - stopat)
+
+def checkpoint(): # writes the sequence configuration file that resumes a stopped run from the first coupling or deprotection not finished, returns its name, None when nothing is left to couple
+    k = residuesdone
+    dp1 = 'n' if k > 0 or 'fmoc' in finished else dp
+    if coupled and k + 1 < len(seq): # its deprotection is the initial fmoc deprotection of the resumed run
+        k += 1
+        dp1 = 'y'
+    if k >= len(seq):
+        return None
+    config = ConfigParser()
+    config.read(seqfilename)
+    config.set('Parameters', 'seq', seqfull) # as edited during the run
+    config.set('Parameters', 'saa', str(saa + k))
+    config.set('Parameters', 'pr', 'n' if 'priming' in finished else pr)
+    config.set('Parameters', 'sw', 'n' if 'swelling' in finished else sw)
+    config.set('Parameters', 'dp', dp1)
+    name = path.join(path.dirname(seqfilename), seqname.replace('-resume', '') + '-resume.txt')
+    with open(name, 'w') as file:
+        file.write('# Resumes ' + seqname + ' stopped at ' + timestamp() + ', from amino acid ' + str(saa + k) + '\n')
+        config.write(file)
+    return name
+
+def aborted(): # reports a stop, records the run in the run history and writes the resume file
+    unwound()
+    reason, latency = stopinfo
+    print(' ')
+    filewrite('Run stopped (' + reason + ') at ' + timestamp() + ', device set to a safe state in ' + str("{:.0f}".format(latency*1000)) + ' ms')
+    name = checkpoint()
+    if name is None:
+        filewrite('All amino acids were coupled, only the final deprotection, washing, drying or line cleaning were left (see PepSy-manual.py)')
+    else:
+        filewrite('To resume the run, start PepSy.py with ' + path.splitext(path.basename(name))[0] + ' (' + name + ')')
+    if history is not None:
+        try:
+            history.execute('update runs set ended = ?, actual = ? where id = ?', (started(now()), now() - t0, runid))
+            history.commit()
+        except sqlite3.Error as error:
+            historyfailed(error)
+    if portmapname is not None:
+        saveportmap()
+    
+
+def loadresidues(name): # amino acid/reagent table, {symbol: {'mw', 'coupling', 'deprotection', 'port', 'next', 'ml', 'name'}}, see residues.txt
+    table = {}
+    for line in open(name):
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith(';'):
+            continue
+        table[fields[0]] = {'mw': float(fields[1]) if fields[1] != '-' else 0, 'coupling': fields[2], 'deprotection': fields[3], 'port': fields[4],
+                            'next': fields[5], 'ml': float(fields[6]) if fields[6] != '-' else 0, 'name': ' '.join(fields[7:])}
+    return table
+
+def residue(x): # properties of an amino acid/reagent symbol, a D amino acid (lowercase) has those of its L form, a symbol not in the table those of an amino acid without molecular weight
+    return residues.get(x) or residues.get(x.upper()) or unknown
+
+def plan(p, ss=1, positionmap=None, double=()): # plans the synthesis of a sequence (or a part of it) without printing or asking anything, returns a dictionary
+    # positionmap maps each amino acid/reagent to its position on the ps, None for the positions assigned by the script
+    # double lists the residues (0 for the first one coupled) to be double coupled, see doubled()
+    aa = [] # p reversed for synthesis
+    for n in range (1, len(p)+1):
+        aa.append(p[len(p)-n])
     pseq = Counter(x for x in p if x not in ignore) # amino acids and reagents sorting
-    paan1 = len(pseq) # number of different amino acids and reagents
-    for n in range (2, paan+1):
-        if aa[n-2] == 'P' or aa[n-2] in ('P', '<', '>', '+', '-', '='):
-            pseq[aa[n-1]] += 1               
-    paak = list(pseq.keys())
-    paav = list(pseq.values())  
+    twice = set(k for k in range(len(aa)) if residue(aa[k])['coupling'] == 'single' and (k in double or (k > 0 and residue(aa[k-1])['next'] == 'double')))
+    for k in twice:
+        pseq[aa[k]] += 1 # solution for double coupling
+    paak = list(pseq.keys()) # amino acids and reagents
+    paav = list(pseq.values()) # number of couplings of each
+    paap = [] # positions for different amino acids and reagents
+    vols = [] # solution volumes in ml
+    wts = [] # amino acid weights in mg
+    dmfs = [] # DMF volumes in microliters
+    for n in range (1, len(paak)+1):
+        if positionmap is None:
+            at = n % (ports - 7)
+            if at == 0:
+                pos = ports
+            else:
+                pos = 7 + at
+        else:
+            pos = int(positionmap[paak[n-1]])
+        paap.append(pos)
+        vol = ((len1+len2)/1000+ss*residue(paak[n-1])['ml'])*paav[n-1]
+        wt = vol*residue(paak[n-1])['mw']*0.33 # conc of aa solution is 0.33M
+        vols.append(vol)
+        wts.append(wt)
+        dmfs.append(vol*1000-wt)
+    a = [] # position
+    c = [] # coupling
+    d = [] # deprotection
+    for n in range (1, len(aa)+1):
+        if aa[n-1] in ignore:
+            a.append(1)
+        for m in range (1, len(paak)+1):
+            if aa[n-1] == paak[m-1]:
+                a.append(paap[m-1])
+        if n-1 in twice:
+            c.append('double') # double coupling if previous aa is P or an N-methyl amino acid, or set in the sequence configuration file
+        else:
+            c.append(residue(aa[n-1])['coupling'])
+        d.append(residue(aa[n-1])['deprotection'])
+    dmfn = 0 # number of dmf washings
+    cn = 0 # number of couplings, HBTU/HOBT/DIPEA deliveries
+    dn = 0 # number of fmoc deprotections
+    for n in range (1, len(aa)+1):
+        if c[n-1] != 'pause':
+            dmfn += washes # after the coupling
+        if d[n-1] == 'fmoc':
+            dmfn += washes # after the deprotection
+            dn += 1
+        if c[n-1] in ('single', 'manual'):
+            cn += 1
+        elif c[n-1] == 'double':
+            cn += 2 # both rounds
+    return {
+        'aa': aa, 'a': a, 'c': c, 'd': d,
+        'paak': paak, 'paav': paav, 'paap': paap, 'vol': vols, 'wt': wts, 'dmf': dmfs,
+        'dmfvol': 5+11.5+(dmfn*washvol/1000), # 5 ml for extra, 0.5 ml for initial priming/swelling/fmocdeprotection and washvol (2 ml) for each washing
+        'dcmvol': 10+11.5, # 10 ml for extra, 11.5 ml for initial priming, swelling, and final washing    
+        'hbtvol': 2+0.5+((len2/1000)+0.5)*cn, # 2 ml for extra, 0.5 ml for initial priming, and (len2 + 0.5) for each coupling    
+        'hobvol': 2+0.5+((len2/1000)+0.26)*cn, # 2 ml for extra, 0.5 ml for initial priming, and (len2 + 0.26) for each coupling    
+        'dipvol': 2+0.5+((len2/1000)+0.26)*cn, # 2 ml for extra, 0.5 ml for initial priming, and (len2 + 0.26) for each coupling    
+        'pipvol': 2+0.5+((len2+len3)/1000+2)*dn, # 2 ml for extra, 0.5 ml for initial priming, and (len2 + len3 + 2) for each fmoc deprotection    
+        'time': estimate(c, d, ss), # seconds
+    }
+
+def placement(paak): # positions of the amino acids/reagents of a part, a bottle already on a port stays there, the others take the ports without a bottle first, from 8
+    placed = {}
+    for pos in sorted(bottles):
+        if bottles[pos] in paak and bottles[pos] not in placed:
+            placed[bottles[pos]] = pos
+    free = [pos for pos in range(8, ports+1) if pos not in placed.values()]
+    free.sort(key=lambda pos: pos in bottles)
+    for x in paak:
+        if x not in placed:
+            placed[x] = free.pop(0)
+    return placed
+
+def swaps(assigned): # lists the bottles to place for a part and those already on their ports, {amino acid/reagent: position}
+    change = []
+    keep = []
+    for x, pos in sorted(assigned.items(), key=lambda x: x[1]):
+        if bottles.get(pos) == x:
+            keep.append(str(pos) + ' (' + x + ')')
+        else:
+            change.append(str(pos) + ' (' + x + ', ' + ('replaces ' + bottles[pos] if pos in bottles else 'empty port') + ')')
+        bottles[pos] = x
+    filewrite('Bottles to place: ' + (', '.join(change) if change else 'none'))
+    if keep:
+        filewrite('Bottles already in place, check their volumes: ' + ', '.join(keep))
+    print(' ')
+
+def doubled(p): # residues of p (0 for the first one coupled) set to double coupling in the sequence configuration file, p starting at the next residue of the run
+    first = saa + residuesdone
+    return [k for k in range(len(p)) if first + k in doubles]
+
+def usedvol(p): # microliters pumped from position p in this run
+    return sum(v for (q, content), v in pumped.items() if q == p)
+
+def positions(p):
+    global assignment, loaded, loadedat
+    if pa.upper() == 'Y':
+        pl = plan(p, ss, None, doubled(p))
+        if portmapname is not None: # the bottles already on the ports stay there
+            pl = plan(p, ss, placement(pl['paak']), doubled(p))
+    else:
+        pl = plan(p, ss, synconfig['Positions'], doubled(p))
+    paak = pl['paak']
+    paav = pl['paav']
+    paap = pl['paap']
+    assignment = dict(zip(paak, paap)) # amino acid/reagent: position, of the part being synthesized
+    loaded = dict(zip(paap, (v*1000 for v in pl['vol']))) # microliters placed in every position
+    loaded.update({2: pl['dmfvol']*1000, 4: pl['pipvol']*1000, 5: pl['dipvol']*1000, 6: pl['hobvol']*1000, 7: pl['hbtvol']*1000})
+    loadedat = dict((x, usedvol(x)) for x in loaded) # microliters pumped from every position before it was loaded
     if pa.upper() == 'Y':
         filewrite('Place amino acid/reagent solutions with required volumes in the positions shown below')
         print(' ')
         filewrite('---------------------------------------------------------------------------------------------------')
         filewrite('S. No.' + '\t' + 'Amino acid' + '\t' + 'Position' + '\t' + 'Solution volume' + '\t\t' + 'Amino acid weight' + '\t' + 'DMF volume')
         filewrite('---------------------------------------------------------------------------------------------------')
-        for n in range (1, paan1+1):
-            at = n % (ports - 7)
-            if at == 0:
-                pos = ports
-            else:
-                pos = 7 + at
-            paap.append(pos)
-            if paak[n-1] == '!':
-                vol = ((len1+len2)/1000+ss*2)*paav[n-1]
-            elif paak[n-1] == '@':
-                vol = ((len1+len2)/1000+ss*4)*paav[n-1]
-            elif paak[n-1] == '$':
-                vol = ((len1+len2)/1000+ss*1)*paav[n-1]
-            else:
-                vol = ((len1+len2)/1000+ss*0.5)*paav[n-1]  
-            try:
-                mw = mwdict[paak[n-1].upper()]
-            except:
-                mw = 0
-            wt = vol*mw*0.33 # conc of aa solution is 0.33M
-            dmf = vol*1000-wt
-            filewrite(str(n) + '\t' + paak[n-1] + '(' + str(paav[n-1]) + ')' + '\t\t' + str(paap[n-1]) + '\t\t' + str("{:.1f}".format(vol)) + ' ml' + '\t\t\t' + str("{:.0f}".format(wt)) + ' mg' + '\t\t\t' + str("{:.0f}".format(dmf)) + ' ul')
+        for n in range (1, len(paak)+1):
+            filewrite(str(n) + '\t' + paak[n-1] + '(' + str(paav[n-1]) + ')' + '\t\t' + str(paap[n-1]) + '\t\t' + str("{:.1f}".format(pl['vol'][n-1])) + ' ml' + '\t\t\t' + str("{:.0f}".format(pl['wt'][n-1])) + ' mg' + '\t\t\t' + str("{:.0f}".format(pl['dmf'][n-1])) + ' ul')
         filewrite('---------------------------------------------------------------------------------------------------')
         print(' ')
-    else:
-        for n in range (1, paan1+1):
-            pos = synconfig.getint('Positions', paak[n-1])
-            paap.append(pos)
+    if portmapname is not None:
+        swaps(assignment)
+    for n in range (1, len(paak)+1):
+        lines[paap[n-1]] = paak[n-1] # line contents for cleaning
+    a.extend(pl['a'])
+    c.extend(pl['c'])
+    d.extend(pl['d'])
     filewrite('-----------------------------------------------------------------------------')
     filewrite('S. No.' + '\t' + 'Amino acid' + '\t' + 'Position' + '\t' + 'Coupling' + '\t\t' + 'Deprotection')
     filewrite('-----------------------------------------------------------------------------')
     for n in range (1, paan+1):
-        if aa[n-1] in ('*', '@', '#'):
-            a.append(1)
-        for m in range (1, paan1+1):
-            if aa[n-1] == paak[m-1]:
-                a.append(paap[m-1])
-        if aa[n-1] == '!':
-            c.append('ivdde')
-        elif aa[n-1] == '@':
-            c.append('oxidation')
-        elif aa[n-1] == '$':
-            c.append('encapping')
-        elif aa[n-1] == '*':
-            c.append('pause')
-        elif aa[n-1] == '#':
-            c.append('manual')
-        elif aa[n-1] in ('^', '&'):
-            c.append('double')
-        else:
-            c.append('single') # default coupling
-        if n > 1:
-            if aa[n-2] in ('P', '<', '>', '+', '-', '='):
-                c.pop() # deletes the last element from the list
-                c.append('double') # double coupling if previous aa is P or any aa represented by <, >, +, -, or =
-        if aa[n-1] in ('*', '!', '@', '$', 'Z', 'U', 'O'):
-            d.append('none')
-        else:
-            d.append('fmoc') # default deprotection
         if saa > 1:
             n1 = n + saa - 1
         else:
             n1 = n
         filewrite(str(n1) + '\t' + aa[n-1] + '\t\t' + str(a[n-1]) + '\t\t' + c[n-1] + '\t\t\t' + d[n-1])
     filewrite('-----------------------------------------------------------------------------')
-    dmfn = 0 # number of dmf washings
-    cn = 0 # number of couplings
-    dn = 0 # number of fmoc deprotections
-    for n in range (1, paan+1):
-        if aa[n-1] != '*':
-            dmfn += 10 # 5 for coupling and 5 for deprotection
-        if aa[n-1] in ('@', '!', '$', 'Z', 'U', 'O'):
-            dmfn -= 5 # 5 for deprotection removed
-        if aa[n-1] not in ('*', '@', '!', '$'):
-            cn += 1
-        if aa[n-1] in ('p', 'P', '<', '>', '-', '+', '='):
-            cn += 2 # double coupling
-        if aa[n-1] not in ('*', '@', '!', '$', 'Z', 'U', 'O'):
-            dn += 1
-    dmfvol = 5+11.5+(dmfn*2) # 5 ml for extra, 0.5 ml for initial priming/swelling/fmocdeprotection and 2 ml for each washing
-    dcmvol = 10+11.5 # 10 ml for extra, 11.5 ml for initial priming, swelling, and final washing    
-    hbtvol = 2+0.5+((len2/1000)+0.5)*cn # 2 ml for extra, 0.5 ml for initial priming, and (len2 + 0.5) for each coupling    
-    hobvol = 2+0.5+((len2/1000)+0.26)*cn # 2 ml for extra, 0.5 ml for initial priming, and (len2 + 0.26) for each coupling    
-    dipvol = 2+0.5+((len2/1000)+0.26)*cn # 2 ml for extra, 0.5 ml for initial priming, and (len2 + 0.26) for each coupling    
-    pipvol = 2+0.5+((len2+len3)/1000+2)*dn # 2 ml for extra, 0.5 ml for initial priming, and (len2 + len3 + 2) for each fmoc deprotection    
-    print(' ')
-    filewrite('Volume of DMF = ' + str("{:.1f}".format(dmfvol)) + ' ml')
-    filewrite('Volume of DCM = ' + str("{:.1f}".format(dcmvol)) + ' ml')
-    filewrite('Volume of HBTU solution = ' + str("{:.1f}".format(hbtvol)) + ' ml')
-    filewrite('Volume of HOBt solution = ' + str("{:.1f}".format(hobvol)) + ' ml')
-    filewrite('Volume of DIPEA solution = ' + str("{:.1f}".format(dipvol)) + ' ml')
-    filewrite('Volume of Piperidine solution  = ' + str("{:.1f}".format(pipvol)) + ' ml')
+    print(' ')
+    filewrite('Volume of DMF = ' + str("{:.1f}".format(pl['dmfvol'])) + ' ml')
+    filewrite('Volume of DCM = ' + str("{:.1f}".format(pl['dcmvol'])) + ' ml')
+    filewrite('Volume of HBTU solution = ' + str("{:.1f}".format(pl['hbtvol'])) + ' ml')
+    filewrite('Volume of HOBt solution = ' + str("{:.1f}".format(pl['hobvol'])) + ' ml')
+    filewrite('Volume of DIPEA solution = ' + str("{:.1f}".format(pl['dipvol'])) + ' ml')
+    filewrite('Volume of Piperidine solution  = ' + str("{:.1f}".format(pl['pipvol'])) + ' ml')
+    filewrite('Estimated synthesis time = ' + str("{:.1f}".format(pl['time']/3600)) + ' h')
     print(' ')
     print('Check the positions, couplings, and deprotections are correct')
     print(' ')
@@ -189,84 +668,583 @@ def positions(p):
     print(' ')
     print('Check the levels of all the reagents, if any of them is not enough then add.')
     print(' ')
-    input('If you are ready, press ENTER to continue')
+    ask('If you are ready, press ENTER to continue')
+
+def simcopy(): # separate copy of this module, for simulations that must not touch the devices and the state of the current run
+    spec = importlib.util.spec_from_file_location('PepSysim', __file__)
+    m = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(m)
+    return m
+
+def stepkey(ss): # synthesis scale and device parameters that change the simulated step times
+    return (ss, heat) + tuple(globals()[x] for x in simparameters)
+
+def silent(*args, **kwargs): # print() of the simulations that are not shown
+    pass
+
+def steptimes(ss): # seconds of every coupling/deprotection type and of the steps before and after the synthesis, measured once by simulation
+    key = stepkey(ss)
+    if key not in steptimecache:
+        m = simcopy()
+        for x in simparameters:
+            setattr(m, x, globals()[x])
+        m.ss, m.heat, m.heatprofile = ss, heat, heatprofile
+        clock = m.simdevices()
+        m.aa = ['A', '#', '!', '$']
+        m.a = [8, 1, 9, 10]
+        times = {}
+        asks = {} # seconds from the start of every step at which the operator is asked
+        def ask(prompt=''):
+            asks[name].append(clock.time() - t)
+            return simanswer(prompt)
+        m.ask = ask
+        m.print = silent # not redirect_stdout(), it would silence every thread (see PepSy-fleet.py)
+        steps = [('single', lambda: m.coupling(0)), ('manual', lambda: m.coupling(1)), ('double', lambda: m.doublecoupling(0)),
+                 ('ivdde', lambda: m.ivddedeprotection(2)), ('endcapping', lambda: m.endcapping(3)), ('oxidation', m.onresinoxidation),
+                 ('pause', m.pause), ('fmoc', m.fmocdeprotection), ('initialization', m.initialization), ('priming', m.priming),
+                 ('swelling', m.swelling), ('finalwashing', m.finalwashing)]
+        for name, step in steps:
+            asks[name] = []
+            t = clock.time()
+            step()
+            times[name] = clock.time() - t
+        times['none'] = 0
+        steptimecache[key] = times
+        askcache[key] = asks
+    return steptimecache[key]
+
+def asktimes(ss): # seconds from the start of every step type at which the operator is asked, measured with the step times
+    steptimes(ss)
+    return askcache[stepkey(ss)]
+
+def plannedtimes(ss): # step times with the mean overheads of earlier runs
+    times = dict(steptimes(ss))
+    for kind in overheads: # measured in earlier runs
+        if kind in times:
+            times[kind] += overheads[kind]
+    return times
+
+def estimate(c, d, ss): # estimated seconds of a synthesis from its couplings and deprotections, with initialization, priming, swelling, initial deprotection, and final washing and drying
+    times = plannedtimes(ss)
+    t = times['initialization'] + times['priming'] + times['swelling'] + times['fmoc'] + times['finalwashing']
+    for n in range (1, len(c)+1):
+        t += times.get(c[n-1], 0) + times[d[n-1]]
+    return t
     
+def staffedhours(text): # staffed hours of the lab, e.g., 'mon-fri 08:00-18:00, sat 09:00-12:00', as [(weekdays, first minute, end minute)]
+    windows = []
+    for entry in text.split(','):
+        if entry.strip() == '':
+            continue
+        days, hours = entry.split()
+        days = days.lower().split('-')
+        weekdays = set(range(weekdaynames.index(days[0]), weekdaynames.index(days[-1]) + 1))
+        first, end = [int(x.split(':')[0])*60 + int(x.split(':')[1]) for x in hours.split('-')]
+        windows.append((weekdays, first, end))
+    return windows
+
+def isstaffed(when): # True when an operator is expected at a date and time, always without staffed hours
+    minute = when.hour*60 + when.minute
+    return not staffed or any(when.weekday() in weekdays and first <= minute < end for weekdays, first, end in staffed)
+
+def nextstaffed(when): # date and time from which an operator is expected, when itself if one is
+    if isstaffed(when):
+        return when
+    day = datetime(when.year, when.month, when.day)
+    for k in range(8):
+        opens = [day + timedelta(days=k, minutes=first) for weekdays, first, end in staffed if (day + timedelta(days=k)).weekday() in weekdays]
+        opens = [x for x in opens if x > when]
+        if opens:
+            return min(opens)
+    return when
+
+def runparts(p): # (aa, c, d) of every part of a sequence in synthesis order, as run() synthesizes it
+    if len(Counter(x for x in p if x not in ignore)) <= ports - 7:
+        parts = [p]
+    else:
+        parts = split(p)
+    return [(pl['aa'], pl['c'], pl['d']) for pl in (plan(x, ss) for x in parts)]
+
+def interventions(parts, ss): # operator interventions of a run as (seconds from the start, step, residue, seconds it can be put off), the operator answering at once
+    times = plannedtimes(ss)
+    asks = asktimes(ss)
+    events = [(0, 'start', '', None)]
+    t = times['initialization'] + times['priming'] + times['swelling'] + times['fmoc']
+    for k in range(len(parts)):
+        aa1, c1, d1 = parts[k]
+        if k > 0:
+            events.append((t, 'reloading', '', None)) # the lines of the previous part are cleaned and the next amino acids placed
+            t += sum(cleanvol([[x, len1+len2]]) for x in set(parts[k-1][0]) if x not in ignore)/piv*0.5 # lines wetted from aa to pump
+        for n in range(len(c1)):
+            for offset in asks.get(c1[n], []):
+                events.append((t + offset, c1[n], aa1[n], None))
+            t += times.get(c1[n], 0) + times[d1[n]]
+    events.append((t + times['finalwashing'] - 1800, 'cleaning', '', 1800)) # the lines are cleaned during drying, or after it
+    return events
+
+def schedule(events, start): # (due, answered, step, residue) of the interventions of a run started at start, and the seconds the synthesis waits for the operator
+    idle = 0
+    times = []
+    for offset, step, residue, later in events:
+        due = start + timedelta(seconds=offset + idle)
+        if later is not None and not isstaffed(due): # put off, it holds up nothing but the operator
+            due = due + timedelta(seconds=later)
+        answered = nextstaffed(due)
+        if later is None:
+            idle += (answered - due).total_seconds()
+        times.append((due, answered, step, residue))
+    return times, idle
+
+def beststart(events, start, days=7): # start time within the next days, every 15 min, with the least idle time, the earliest of equals, and its idle time
+    best = (start, schedule(events, start)[1])
+    first = start.replace(second=0, microsecond=0) + timedelta(minutes=15 - start.minute % 15)
+    for k in range(days*96):
+        when = first + timedelta(minutes=15*k)
+        idle = schedule(events, when)[1]
+        if idle < best[1]:
+            best = (when, idle)
+    return best
+
+def operatorplan(parts): # prints when the operator is needed if the run starts now, the expected idle time, and a start time with less
+    events = interventions(parts, ss)
+    start = datetime.now()
+    times, idle = schedule(events[1:], start) # the operator starting the run is there
+    filewrite('Operator interventions if the run starts now')
+    for due, answered, step, residue in times:
+        filewrite(due.strftime('%a %m-%d-%Y %I:%M %p') + '\t' + (step + ' ' + residue).strip() + ('' if answered == due else '\t' + 'no operator until ' + answered.strftime('%a %m-%d-%Y %I:%M %p')))
+    filewrite('Expected idle time waiting for the operator = ' + str("{:.1f}".format(idle/3600)) + ' h, the resin is held in DMF')
+    when, idle1 = beststart(events, start)
+    if idle1 < idle:
+        filewrite('Suggested start ' + when.strftime('%a %m-%d-%Y %I:%M %p') + ', expected idle time = ' + str("{:.1f}".format(idle1/3600)) + ' h')
+    print(' ')
+
+def residuenumbers(text): # amino acid numbers (as saa, 1 for the C-terminal one) of the sequence configuration file, e.g., '12, 15'
+    return set(int(x) for x in text.replace(',', ' ').split())
+
+def edit(sequence, double=None): # control API, from any thread: the sequence (N to C, as in the sequence configuration file) and the double couplings of the rest of the run, applied before the next amino acid, see replan()
+    global pendingedit
+    with editlock:
+        pendingedit = (sequence, set(double) if double is not None else doubles)
+
+def seqedit(): # (sequence, double couplings) of the sequence configuration file when it was saved since it was last read, None otherwise
+    global seqmtime
+    if seqfilename is None or not path.exists(seqfilename) or path.getmtime(seqfilename) == seqmtime:
+        return None
+    seqmtime = path.getmtime(seqfilename)
+    config = ConfigParser()
+    try:
+        config.read(seqfilename)
+        if config.getint('Parameters', 'saa') != saa:
+            filewrite('Sequence configuration file saved with another saa, the edit is not applied during the run')
+            return None
+        return config.get('Parameters', 'seq'), residuenumbers(config.get('Parameters', 'double', fallback=''))
+    except (Error, ValueError) as error:
+        filewrite('Sequence configuration file could not be read, the edit is not applied (' + str(error) + ')')
+        return None
+
+def solutionleft(p): # microliters left in position p, from what was placed for the part and what was pumped since
+    return loaded.get(p, 0) - (usedvol(p) - loadedat.get(p, 0))
+
+def solutionneeds(pl): # microliters of every position needed by the plan of the rest of a part, without the spare and the initial priming
+    needs = dict((assignment[x], v*1000) for x, v in zip(pl['paak'], pl['vol']))
+    for x, key, spare in ((2, 'dmfvol', 16.5), (4, 'pipvol', 2.5), (5, 'dipvol', 2.5), (6, 'hobvol', 2.5), (7, 'hbtvol', 2.5)):
+        needs[x] = (pl[key] - spare)*1000
+    return needs
+
+def resttime(n): # seconds from the n-th residue of the part to the end of the run, the later parts and the final washing included
+    times = plannedtimes(ss)
+    fixed = times['initialization'] + times['priming'] + times['swelling'] + times['fmoc'] + times['finalwashing']
+    return (sum(times.get(c[k], 0) + times[d[k]] for k in range(n-1, paan)) + sum(plan(x, ss)['time'] - fixed for x in later)
+            + times['finalwashing'])
+
+def replan(n): # applies an edit of the rest of the sequence before the n-th residue of the part, not when it changes the amino acids already coupled or needs more solution than is left
+    global seq, seqfull, doubles, paan, pendingedit
+    with editlock:
+        change, pendingedit = pendingedit, None
+    if change is None:
+        change = seqedit()
+    if change is None:
+        return
+    sequence, double = change
+    newseq = sequence[:-(saa-1)] if saa > 1 else sequence
+    done = seq[len(seq)-residuesdone:] # coupled and deprotected in this run
+    if not newseq.endswith(done):
+        filewrite('Sequence edit ' + sequence + ' not applied, it changes amino acids already coupled')
+        return
+    remaining = newseq[:len(newseq)-len(done)]
+    k = len(remaining)
+    while k > 0 and (remaining[k-1] in ignore or remaining[k-1] in assignment):
+        k -= 1 # the C-terminal residues on the loaded lines are synthesized in this part, the others in new parts
+    current = remaining[k:]
+    first = saa + residuesdone
+    twice = [k1 for k1 in range(len(current)) if first + k1 in double]
+    if current and n > 1 and residue(aa[n-2])['next'] == 'double':
+        twice.append(0) # after P or an N-methyl amino acid coupled in this part
+    pl = plan(current, ss, assignment, twice)
+    needs = solutionneeds(pl)
+    before = solutionneeds(plan(''.join(reversed(aa[n-1:])), ss, assignment, [k1 for k1 in range(paan-n+1) if c[n-1+k1] == 'double']))
+    short = [x for x in sorted(needs) if needs[x] > before.get(x, 0) and needs[x] > solutionleft(x)] # more than the plan it replaces and than is left
+    if short:
+        names = dict((assignment[x], x) for x in assignment)
+        names.update({2: 'DMF', 4: 'piperidine', 5: 'DIPEA', 6: 'HOBT', 7: 'HBTU'})
+        filewrite('Sequence edit ' + sequence + ' needs more solution: ' + ', '.join(names[x] + ' (position ' + str(x) + ', ' + str("{:.1f}".format((needs[x] - solutionleft(x))/1000)) + ' ml more)' for x in short))
+        if ask('Add the solutions and enter y to apply the edit, or n to go on without it (y or n)? ').upper() != 'Y':
+            print(' ')
+            filewrite('Sequence edit ' + sequence + ' not applied')
+            return
+        print(' ')
+        for x in short:
+            loaded[x] += needs[x] - solutionleft(x)
+    aa[n-1:] = pl['aa']
+    a[n-1:] = pl['a']
+    c[n-1:] = pl['c']
+    d[n-1:] = pl['d']
+    paan = len(aa)
+    later[:] = split(remaining[:k]) if k > 0 else []
+    seq = newseq
+    seqfull = sequence
+    doubles = double
+    print(' ')
+    filewrite('Sequence edited at ' + timestamp() + ', the rest of the run is ' + (remaining if remaining else 'the final washing'))
+    filewrite('-----------------------------------------------------------------------------')
+    filewrite('S. No.' + '\t' + 'Amino acid' + '\t' + 'Position' + '\t' + 'Coupling' + '\t\t' + 'Deprotection')
+    filewrite('-----------------------------------------------------------------------------')
+    for k1 in range(n, paan+1):
+        filewrite(str(k1 + saa - 1 if saa > 1 else k1) + '\t' + aa[k1-1] + '\t\t' + str(a[k1-1]) + '\t\t' + c[k1-1] + '\t\t\t' + d[k1-1])
+    filewrite('-----------------------------------------------------------------------------')
+    for k1 in range(1, len(later)+1):
+        filewrite('Then ' + later[k1-1] + ' as a new part, the amino acid/reagent lines are cleaned and loaded again')
+    filewrite('Estimated end of the synthesis: ' + (datetime.now() + timedelta(seconds=resttime(n))).strftime('%m-%d-%Y %I:%M %p'))
+    print(' ')
+
+def split(p): # splits a sequence in to parts that fit on the ports, each part starts where the previous one ended (C to N), returns the parts in synthesis order
+    parts = []
+    while len(Counter(x for x in p if x not in ignore)) > ports - 7:
+        i = 1
+        while len(Counter(x for x in p[i:] if x not in ignore)) > ports - 7:
+            i = i + 1
+        parts.append(p[i:])
+        p = p[0:i]
+    parts.append(p)
+    return parts
+
+def ordinal(k):
+    words = ['First', 'Second', 'Third', 'Fourth', 'Fifth', 'Sixth', 'Seventh', 'Eighth', 'Ninth', 'Tenth']
+    if k <= len(words):
+        return words[k-1]
+    return str(k) + 'th'
+
 def pspos(p): # p is stream selector position (integer)
+    global psposition
+    if p == psposition:
+        skipped['ps'] += 1
+        return
     if p == 1:
         position = 'HM\r'
     else:
         position = 'GO%d\r' % (p)
-    ps.open()
-    ps.write(position.encode())
-    ps.close()
+    with iolock:
+        if abort.is_set():
+            raise Stopped()
+        record('ps', position.strip())
+        ps.open()
+        ps.write(position.encode())
+        ps.close()
+    psposition = p
     
 def pumpon(v): # v is volume (integer) to be pumped in microliters
-    for p in range(0, v, piv): 
-        pump.write(1)
-        sleep(0.25)
-        pump.write(0)
-        sleep(0.25)
+    record('pump', v) # traced as a single command, the strokes below are not traced one by one
+    content = tubing.content(psposition)
+    pumped[(psposition, content)] = pumped.get((psposition, content), 0) + v
+    if prime.state == 1:
+        tubing.pump(psposition, v, 'waste')
+    elif reagent.state == 1:
+        tubing.pump(psposition, v, 'resin')
+    if psposition is not None and psposition >= 4:
+        used.add(psposition) # amino acid/reagent line to be cleaned
+    strokes = len(range(0, v, piv))
+    if daemon is not None: # timed by the device process, this process only waits for the end of the train
+        with iolock:
+            if abort.is_set():
+                raise Stopped()
+            request(daemon, ('pump', strokes))
+        sleep(strokes*0.5)
+        done, late = request(daemon, ('pumped',))
+        strokelate.extend(late)
+        return
+    start = now()
+    for k in range(strokes):
+        with iolock:
+            if abort.is_set(): # the pump train ends at the next stroke after a stop
+                raise Stopped()
+            strokelate.append(now() - start - k*0.5)
+            pump.pin.write(1)
+        sleep(max(0, start + k*0.5 + 0.25 - now())) # timed from the start of the train, a late edge does not delay the next ones
+        strokelate.append(now() - start - k*0.5 - 0.25)
+        pump.pin.write(0)
+        sleep(max(0, start + (k + 1)*0.5 - now()))
+
+def stroketiming(): # how late the edges of the pump strokes of the run were, as a line of the output file
+    late = sorted(strokelate)
+    return ('Pump stroke timing (' + ('device process' if daemon is not None else 'run process') + '): ' + str(len(late)//2) + ' strokes, edges late by '
+            + str("{:.1f}".format(1000*sum(late)/len(late))) + ' ms on average, ' + str("{:.1f}".format(1000*late[int(0.99*(len(late) - 1))]))
+            + ' ms at the 99th percentile and ' + str("{:.1f}".format(1000*late[-1])) + ' ms at most')
+
+class Tubing: # liquids in the amino acid/reagent lines (aa to ps), the tubing ps to pump and the tubing pump to resin, as plugs [content, microliters] from inlet to outlet
+    def __init__(self):
+        self.forget()
+
+    def forget(self): # contents not known, e.g., at the start or after the device was operated manually
+        self.lines = {}
+        self.ps2pump = [['?', len2]]
+        self.pump2resin = [['?', len3]]
+
+    def content(self, p): # liquid at a stream selector position
+        return lines.get(p, {1: 'air', 2: 'DMF', 3: 'DCM'}.get(p, str(p)))
+
+    def line(self, p): # plugs in the line of a position, the air, DMF and DCM lines always hold their own liquid
+        if p <= 3:
+            return [[self.content(p), len1]]
+        return self.lines.setdefault(p, [['?', len1]])
+
+    def pump(self, p, v, outlet): # v microliters from position p through the prime valve (outlet 'waste') or the reagent valve (outlet 'resin'), returns the plugs that left
+        incoming = [[self.content(p), v]]
+        if p > 3:
+            incoming = flow(self.line(p), incoming, len1)
+        out = flow(self.ps2pump, incoming, len2)
+        if outlet == 'resin':
+            out = flow(self.pump2resin, out, len3)
+        return out
+
+    def held(self, content): # microliters of a liquid between ps and resin
+        return sum(v for c, v in self.ps2pump + self.pump2resin if c == content)
+
+def flow(segment, incoming, size): # plug flow of incoming plugs (in order of entry) in to a tubing segment of size microliters, returns the plugs pushed out (in order of exit)
+    for content, v in incoming:
+        if segment and segment[0][0] == content:
+            segment[0][1] += v
+        else:
+            segment.insert(0, [content, v])
+    out = []
+    excess = sum(v for c, v in segment) - size
+    while excess > 0:
+        content, v = segment[-1]
+        if v <= excess:
+            segment.pop()
+        else:
+            segment[-1][1] = v - excess
+            v = excess
+        out.append([content, v])
+        excess -= v
+    return out
+
+def clearvol(plugs, keep): # microliters to pump so that only the liquids in keep are left in the plugs (from inlet to outlet)
+    need = 0
+    depth = 0
+    for content, v in reversed(plugs):
+        depth += v
+        if content not in keep:
+            need = depth
+    return need
+
+def saving(content, fixed, v): # counts the volume and pumping time saved against the fixed volume of the protocol
+    savedvol[content] = savedvol.get(content, 0) + fixed - v
+    savedvol['time'] = savedvol.get('time', 0) + (len(range(0, fixed, piv)) - len(range(0, v, piv)))*0.5
+    return v
+
+def primevol(p, fixed): # microliters to prime the line of position p and the tubing ps to pump with its liquid, fixed is the volume of the protocol
+    return saving(tubing.content(p), fixed, clearvol(tubing.line(p) + tubing.ps2pump, (tubing.content(p),)))
+
+def delivervol(v, fixed): # microliters to pump for v microliters of the liquid at the current position, less what is already between ps and resin (fixed in the protocol)
+    return saving(tubing.content(psposition), v - fixed, max(0, v - tubing.held(tubing.content(psposition))))
+
+def flush(): # removes the liquids that are not part of the coupling mixture from the tubing ps to pump through the prime valve, len2 in the protocol
+    v = saving(tubing.content(psposition), len2, clearvol(tubing.ps2pump, mixture))
+    if v > 0:
+        prime.write(1)
+        reagent.write(0)
+        pumpon(v)
+        prime.write(0)
+
+def chasevol(): # microliters of DMF to push the coupling mixture left between ps and resin to the resin, len3 in the protocol
+    return saving('DMF', len3, clearvol(tubing.ps2pump + tubing.pump2resin, ('DMF',)))
+
+def drain(timeout): # drains the reactor until the drain sensor reads empty plus drainmargin seconds, or for timeout seconds without a sensor
+    global drainsaved
+    if sensor is None:
+        sleep(timeout)
+        return
+    start = now()
+    while now() - start < timeout:
+        level = sensor.read() # None until the board has reported a value
+        if level is not None and level < drainlevel:
+            sleep(min(drainmargin, timeout - (now() - start)))
+            drainsaved += timeout - (now() - start)
+            return
+        sleep(0.5)
+    filewrite('Reactor not empty after ' + str(timeout) + ' s draining at ' + timestamp())
+
+def heatprofiles(text): # heat profile of a sequence configuration file, e.g., '75/10, C:50/10, H:50/10', as {residue: (degree C, seconds)}, '' is the default
+    profiles = {}
+    for entry in text.split(','):
+        entry = entry.strip()
+        if entry == '':
+            continue
+        residue, setting = entry.split(':') if ':' in entry else ('', entry)
+        temperature, minutes = setting.split('/')
+        profiles[residue.strip()] = (float(temperature), float(minutes)*60)
+    return profiles
+
+def agitations(text): # N2 pulsing of the device configuration file, e.g., 'coupling:10/60, deprotection:10/60', as {step type: (seconds on, period in seconds)}
+    pulses = {}
+    for entry in text.split(','):
+        entry = entry.strip()
+        if entry == '':
+            continue
+        kind, setting = entry.split(':')
+        on, period = setting.split('/')
+        pulses[kind.strip()] = (float(on), float(period))
+    return pulses
+
+def agitate(kind): # N2 bubbling of an incubation of the step type (swelling, coupling, deprotection, oxidation, endcapping or drying) pulsed as configured, continuous otherwise, agitate(None) when it ends
+    if agitator is not None:
+        agitator.set(agitation.get(kind))
+
+def preheat(residue): # starts heating the reactor to the coupling temperature of the residue while the reagents are added
+    if heater is not None and heatprofile:
+        profile = heatprofile.get(residue, heatprofile.get(''))
+        if profile is not None:
+            heater.set(profile[0])
+
+def heatedcoupling(residue, t): # coupling of t seconds at room temperature, or at the temperature and for the time of the heat profile of the residue from when the reactor has reached it
+    profile = heatprofile.get(residue, heatprofile.get('')) if heater is not None else None
+    if profile is None:
+        print(str("{:.0f}".format(t/60)) + ' min coupling')
+        sleep(t)
+        return
+    temperature, t = profile
+    heater.set(temperature)
+    print('Heating to ' + str("{:.0f}".format(temperature)) + ' C')
+    start = now()
+    while (heater.temperature() or 0) < temperature - 1:
+        if now() - start > 900:
+            filewrite('Reactor not at ' + str("{:.0f}".format(temperature)) + ' C after 15 min heating (' + str("{:.1f}".format(heater.temperature() or 0)) + ' C), coupling started at ' + timestamp())
+            break
+        sleep(1)
+    print(str("{:.0f}".format(t/60)) + ' min coupling at ' + str("{:.0f}".format(temperature)) + ' C')
+    sleep(t)
+    heater.set(None)
+
+def uvwrite(residue, r, curve): # adds a release curve to the UV file of the run
+    file = open(uvname, 'a')
+    for t, absorbance in curve:
+        file.write(residue + '\t' + str(r) + '\t' + str("{:.0f}".format(t)) + '\t' + str("{:.4f}".format(absorbance)) + '\n')
+    file.close()
+
+def plateau(curve): # True when the absorbance rose less than uvplateau in the last 3 min, averaged over 3 samples
+    n = 6 # samples in 3 min
+    if len(curve) < n + 3:
+        return False
+    recent = sum(x for t, x in curve[-3:])/3
+    earlier = sum(x for t, x in curve[-n-3:-n])/3
+    return recent - earlier < uvplateau
+
+def treatment(t, residue, r): # r-th round (1 or 2) of fmoc deprotection of t seconds, with a UV detector the second round ends on a plateau after uvmin seconds or goes on up to uvmax seconds
+    if uv is None:
+        sleep(t)
+        return
+    curve = []
+    start = now()
+    while True:
+        elapsed = now() - start
+        absorbance = uv.read() # None until the board has reported a value
+        if absorbance is not None:
+            curve.append((elapsed, absorbance))
+        if r == 1 and elapsed >= t:
+            break
+        if r == 2 and elapsed >= uvmin and plateau(curve):
+            filewrite('Second round deprotection of ' + residue + ' ended after ' + str("{:.1f}".format(elapsed/60)) + ' min, absorbance ' + str("{:.3f}".format(curve[-1][1])))
+            break
+        if r == 2 and elapsed >= uvmax:
+            filewrite('Fmoc release of ' + residue + ' did not plateau in ' + str("{:.0f}".format(uvmax/60)) + ' min, absorbance ' + str("{:.3f}".format(curve[-1][1] if curve else 0)))
+            break
+        sleep(min(30, t - elapsed) if r == 1 else 30)
+    uvwrite(residue, r, curve)
 
 def presyn():
+    global stepat
+    start = now()
     initialization()
+    logstep('initialization', '', start)
+    start = now()
     if pr.upper() == 'Y':
         priming()
     elif pr.upper() == 'N':
         filewrite('Priming skipped')
         print(' ')
     else:
-        pr1 = input('Input error in the sequence file. Do you want to perform priming (y or n)? ')
+        pr1 = ask('Input error in the sequence file. Do you want to perform priming (y or n)? ')
         print(' ')
         if pr1.upper() == 'Y':
             priming()
         else:
             filewrite('Priming skipped')
             print(' ')
+    logstep('priming', '', start)
+    finished.append('priming')
+    start = now()
     if sw.upper() == 'Y':
         swelling()
     elif sw.upper() == 'N':
         filewrite('Swelling skipped')
         print(' ')
     else:
-        sw1 = input('Input error in the sequence file. Do you want to perform swelling (y or n)? ')
+        sw1 = ask('Input error in the sequence file. Do you want to perform swelling (y or n)? ')
         print(' ')
         if sw1.upper() == 'Y':
             swelling()
         else:
             filewrite('Swelling skipped')
             print(' ')
+    logstep('swelling', '', start)
+    finished.append('swelling')
     filewrite('Peptide synthesis started at ' + timestamp())
     print(' ')
+    start = now()
+    stepat = (0, 'd') # the first coupling follows
     if dp.upper() == 'Y':
-        fmocdeprotection()
+        fmocdeprotection('resin')
     elif dp.upper() == 'N':
         print('Initial fmoc deprotection skipped')
         print(' ')
     else:
-        dp1 = input('Input error in the sequence file. Do you want to perform initial fmoc deprotection (y or n)? ')
+        dp1 = ask('Input error in the sequence file. Do you want to perform initial fmoc deprotection (y or n)? ')
         print(' ')
         if dp1.upper() == 'Y':
-            fmocdeprotection()
+            fmocdeprotection('resin')
         else:
             filewrite('Initial fmoc deprotection skipped')
             print(' ')
+    logstep('fmoc', 'resin', start)
+    finished.append('fmoc')
         
 def syn():
-    for n in range(1, paan+1):
+    global residuesdone, coupled, stepat
+    n = 1
+    while n <= paan:
+        replan(n) # edits of the rest of the sequence are applied between two amino acids
+        if n > paan:
+            break
         if saa > 1:
             n1 = n + saa - 1
         else:
             n1 = n
-        if aa[n-1] == '*':
-            filewrite('Pause')
-        elif aa[n-1] == '@':
-            filewrite('On-resin oxidation')
-        elif aa[n-1] == '!':
-            filewrite('ivDde deprotection')
-        elif aa[n-1] == '$':
-            filewrite('Endcapping')
-        else:
+        if residue(aa[n-1])['port'] == 'aa' or c[n-1] == 'manual':
             filewrite('Amino acid: ' + str(n1) + ' (' + aa[n-1] + ')')
+        else:
+            filewrite(residue(aa[n-1])['name']) # pause, on-resin oxidation, ivDde deprotection, endcapping
+        start = now()
+        stepat = (n, 'c')
         if c[n-1] == 'single' or c[n-1] == 'manual': 
             coupling(n-1)
         elif c[n-1] == 'double':
@@ -282,26 +1260,113 @@ def syn():
         else:
             filewrite('No coupling')
             print(' ')
+        logstep(c[n-1], aa[n-1], start)
+        coupled = True
         if d[n-1] == 'fmoc':
-            fmocdeprotection()
+            start = now()
+            stepat = (n, 'd')
+            fmocdeprotection(str(n1) + ' (' + aa[n-1] + ')')
+            logstep('fmoc', aa[n-1], start)
+        residuesdone += 1
+        coupled = False
+        stepat = None
+        n += 1
 
-def washing():
+fusions = { # boundary operations left out unless the run is strict, and the chemistry that allows it
+    'chase': 'DMF chase of the reagent left in the tubing before the washes of a deprotection, oxidation or end capping: the first wash pushes it '
+             'to the resin and the washes after it remove it (at least 2 washes)',
+    'preprime': '10 s drain of the DMF pushed to the resin by the line priming of a coupling, deprotection or end capping: the line is primed in the '
+                'last wash of the step before, and the DMF is drained with the wash',
+}
+primers = ('single', 'double', 'fmoc', 'ivdde', 'endcapping') # steps that start by priming their line to the resin, see preprime()
+
+def fuse(rule): # True when the boundary operation of a rule is left out, counts the time and DMF saved against the protocol
+    if strict.upper() == 'Y' or (rule == 'chase' and washes < 2):
+        return False
+    fused[rule] = fused.get(rule, 0) + 1
+    if rule == 'chase':
+        strokes = len(range(0, len2, piv)) + len(range(0, len3, piv)) # the pump delivers whole strokes
+        fused['DMF'] = fused.get('DMF', 0) + strokes*piv
+        fused['time'] = fused.get('time', 0) + strokes*0.5 + 10
+    else:
+        fused['time'] = fused.get('time', 0) + 10
+    return True
+
+def chase(): # DMF pushing the reagent left in the tubing to the resin before the washes, drained on its own
+    pspos(2)
+    prime.write(1)
+    pumpon(len2) # DMF to remove previous reagent from tubing between ps and pump
+    prime.write(0)
+    reagent.write(1)
+    pumpon(len3) # DMF to add previous reagent leftover in the tubing
+    pspos(1)
+    reagent.write(0)
+    waste.write(1)
+    vent.write(1)
+    n2.write(1)
+    drain(10)
+    n2.write(0)
+    vent.write(0)
+    waste.write(0)
+
+def following(): # (step id, step type, position) of the step after the current one in the part, None after the last one or outside the synthesis
+    if stepat is None:
+        return None
+    n, phase = stepat
+    if phase == 'c' and d[n-1] == 'fmoc':
+        return ((n, 'd'), 'fmoc', 4)
+    if n >= paan:
+        return None
+    return ((n+1, 'c'), c[n], a[n])
+
+def preprime(): # primes the line of the next step in the last wash of a step, the DMF it pushes to the resin is drained with the wash
+    global preprimed
+    step = following()
+    if step is None or step[1] not in primers or step[2] <= 1 or not fuse('preprime'):
+        return
+    step, kind, pos = step
+    print('Priming the line at position ' + str(pos) + ' for the next step')
+    pspos(pos)
+    if kind not in ('single', 'double'):
+        sleep(1)
+    prime.write(1)
+    if kind in ('single', 'double'):
+        pumpon(primevol(pos, len1+len2)) # amino acid line priming - aa to ps to pump, only what the amino acid does not fill yet
+    elif kind == 'fmoc':
+        pumpon(len2) # removing previous reagent from tubing between ps and pump
+    else:
+        pumpon(len1+len2) # removing previous reagent from tubing between aa to ps to pump
+    prime.write(0)
+    reagent.write(1)
+    pumpon(len3) # line priming - pump to resin
+    reagent.write(0)
+    preprimed = (step, pos)
+
+def primedahead(pos): # True when the line of the current step at position pos was primed in the last wash of the step before
+    return preprimed == (stepat, pos)
+
+def washing(last=False): # last is the last wash of a step, the line of the next step can be primed in it, see preprime()
     reagent.write(1)
     pspos(2)
-    pumpon(2000) # addition of 2 ml DMF
+    pumpon(washvol) # addition of 2 ml DMF by default
     pspos(1)
     sleep(1)
     reagent.write(0)
+    if last:
+        preprime()
     n2.write(1)
     waste.write(1)
     vent.write(1)
-    sleep(60) # draining
+    drain(washdrain) # draining, 60 s by default
     vent.write(0)
     waste.write(0)
     n2.write(0)
      
 def initialization():
     filewrite('Initialization started at ' + timestamp())
+    resync()
+    if portmapname is not None:
+        primedlines()
     pspos(1)
     n2.write(0)
     vent.write(0)
@@ -317,7 +1382,7 @@ def priming():
     prime.write(1)
     for p in range(4,8):
         pspos(p)
-        pumpon(len1+len2)
+        pumpon(primevol(p, len1+len2)) # a line still primed from the last run only needs the tubing ps to pump, see seedlines()
         pspos(1)
         sleep(1)
     for p in range(2,4):
@@ -348,11 +1413,13 @@ def swelling():
     reagent.write(0)
     n2.write(1)
     print('15 min swelling')
+    agitate('swelling')
     sleep(900) # 15 min swelling
+    agitate(None)
     print('Draining solvents')
     waste.write(1)
     vent.write(1)
-    sleep(30) # draining
+    drain(30) # draining
     n2.write(0)
     waste.write(0)
     vent.write(0)
@@ -362,193 +1429,185 @@ def swelling():
     print(' ')
     
 def coupling(n): # S. No. (integer) of the amino acid
+    global mixture
     filewrite('Coupling (single) started at ' + timestamp())
+    mixture = {tubing.content(a[n]), 'DIPEA', 'HOBT', 'HBTU'} # liquids that may be pushed to the resin ahead of each other
     if a[n] == 1:
-        input('Synthesis paused, add amino acid solution to the reactor manually, and press ENTER to continue')
+        hold()
+        ask('Synthesis paused, add amino acid solution to the reactor manually, and press ENTER to continue')
+        resync()
     else:
         aapos = a[n]
         pspos(aapos)
-        prime.write(1)
         filewrite('Amino acid position on PS is ' + str(aapos))
-        print('Priming amino acid ' + aa[n])
-        pumpon(len1+len2) # amino acid line priming - aa to ps to pump
-        prime.write(0)
-        reagent.write(1)
-        pumpon(len3) # amino acid line priming - pump to resin
-        reagent.write(0)
-        waste.write(1)
-        vent.write(1)
-        n2.write(1)
-        sleep(10)
-        n2.write(0)
-        vent.write(0)
-        waste.write(0)
+        if not primedahead(aapos): # primed in the last wash of the step before
+            prime.write(1)
+            print('Priming amino acid ' + aa[n])
+            pumpon(primevol(aapos, len1+len2)) # amino acid line priming - aa to ps to pump, only what the amino acid does not fill yet
+            prime.write(0)
+            reagent.write(1)
+            pumpon(len3) # amino acid line priming - pump to resin
+            reagent.write(0)
+            waste.write(1)
+            vent.write(1)
+            n2.write(1)
+            drain(10)
+            n2.write(0)
+            vent.write(0)
+            waste.write(0)
         reagent.write(1)
-        pumpon(ss*500-len3) # addition of 0.5 ml amino acid solution
+        pumpon(delivervol(ss*500, len3)) # addition of 0.5 ml amino acid solution, less the amino acid solution already in the tubing
         pspos(1)
         sleep(1)
+    preheat(aa[n])
     print('Adding reagents')
     pspos(5)
-    prime.write(1)
-    reagent.write(0)
-    pumpon(len2) # removing previous reagent from tubing between ps and pump
-    prime.write(0)
+    flush() # removing previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
     reagent.write(1)
     pumpon(ss*260) # addition of 0.26 ml DIPEA solution
     pspos(1)
     sleep(1)
     pspos(6)
-    prime.write(1)
-    reagent.write(0)
-    pumpon(len2) # removing previous reagent from tubing between ps and pump
-    prime.write(0)
+    flush() # removing previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
     reagent.write(1)
     pumpon(ss*260) # addition of 0.26 ml HOBT solution
     pspos(1)
     sleep(1)
     pspos(7)
-    prime.write(1)
-    reagent.write(0)
-    pumpon(len2) # removing previous reagent from tubing between ps and pump
-    prime.write(0)
+    flush() # removing previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
     reagent.write(1)
     pumpon(ss*500) # addition of 0.5 ml HBTU solution
     pspos(1)
     reagent.write(0)
     pspos(2)
-    prime.write(1)
-    reagent.write(0)
-    pumpon(len2) # DMF to remove previous reagent from tubing between ps and pump
-    prime.write(0)
+    flush() # DMF to remove previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
     reagent.write(1)
-    pumpon(len3) # DMF to add previous reagent leftover in the tubing pump to resin
+    pumpon(chasevol()) # DMF to add the coupling mixture left in the tubing ps to pump to resin
     pspos(1)
     reagent.write(0)
     n2.write(1)
-    print('60 min coupling')
-    sleep(3600) # 60 min coupling
+    agitate('coupling')
+    heatedcoupling(aa[n], couplingtime) # 60 min coupling at room temperature by default
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     n2.write(0)
     waste.write(0)
     vent.write(0)
-    for w in range(1,6): # 5 times washing
+    for w in range(1, washes+1): # 5 times washing by default
         print('Washing ' + str(w))
-        washing()
+        washing(w == washes)
     filewrite('Completed at ' + timestamp())
     print(' ')
 
 def doublecoupling(n): # S. No. (integer) of the amino acid
+    global mixture
     filewrite('Coupling (double) started at ' + timestamp())
+    mixture = {tubing.content(a[n]), 'DIPEA', 'HOBT', 'HBTU'} # liquids that may be pushed to the resin ahead of each other
     for d in range(1,3):
         aapos = a[n]
         pspos(aapos)
-        prime.write(1)
         if d == 1:
             filewrite('Amino acid position on PS is ' + str(aapos))
-            print('Priming amino acid ' + aa[n])
-            pumpon(len1+len2) # amino acid line priming - aa to ps to pump
-        if d == 2:
-            pumpon(len2) # amino acid line priming - ps to pump
-        prime.write(0)
-        reagent.write(1)
-        pumpon(len3) # amino acid line priming - pump to resin
-        reagent.write(0)
-        waste.write(1)
-        vent.write(1)
-        n2.write(1)
-        sleep(10)
-        n2.write(0)
-        vent.write(0)
-        waste.write(0)
+        if d == 2 or not primedahead(aapos): # the first round may have been primed in the last wash of the step before
+            prime.write(1)
+            if d == 1:
+                print('Priming amino acid ' + aa[n])
+                pumpon(primevol(aapos, len1+len2)) # amino acid line priming - aa to ps to pump, only what the amino acid does not fill yet
+            if d == 2:
+                pumpon(primevol(aapos, len2)) # amino acid line priming - ps to pump
+            prime.write(0)
+            reagent.write(1)
+            pumpon(len3) # amino acid line priming - pump to resin
+            reagent.write(0)
+            waste.write(1)
+            vent.write(1)
+            n2.write(1)
+            drain(10)
+            n2.write(0)
+            vent.write(0)
+            waste.write(0)
+        preheat(aa[n])
         print('Adding reagents')
         reagent.write(1)
-        pumpon(ss*500-len3) # addition of 0.5 ml amino acid solution
+        pumpon(delivervol(ss*500, len3)) # addition of 0.5 ml amino acid solution, less the amino acid solution already in the tubing
         pspos(1)
         sleep(1)
         pspos(5)
-        prime.write(1)
-        reagent.write(0)
-        pumpon(len2) # removing previous reagent from tubing between ps and pump
-        prime.write(0)
+        flush() # removing previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
         reagent.write(1)
         pumpon(ss*260) # addition of 0.26 ml DIPEA solution
         pspos(1)
         sleep(1)
         pspos(6)
-        prime.write(1)
-        reagent.write(0)
-        pumpon(len2) # removing previous reagent from tubing between ps and pump
-        prime.write(0)
+        flush() # removing previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
         reagent.write(1)
         pumpon(ss*260) # addition of 0.26 ml HOBT solution
         pspos(1)
         sleep(1)
         pspos(7)
-        prime.write(1)
-        reagent.write(0)
-        pumpon(len2) # removing previous reagent from tubing between ps and pump
-        prime.write(0)
+        flush() # removing previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
         reagent.write(1)
         pumpon(ss*500) # addition of 0.5 ml HBTU solution
         pspos(1)
         reagent.write(0)
         pspos(2)
-        prime.write(1)
-        reagent.write(0)
-        pumpon(len2) # DMF to remove previous reagent from tubing between ps and pump
-        prime.write(0)
+        flush() # DMF to remove previous reagent from tubing between ps and pump, only when it is not part of the coupling mixture
         reagent.write(1)
-        pumpon(len3) # DMF to add previous reagent leftover in the tubing
+        pumpon(chasevol()) # DMF to add the coupling mixture left in the tubing ps to pump to resin
         reagent.write(0)
         pspos(1)
         n2.write(1)
-        print('60 min coupling')
-        sleep(3600) # 60 min coupling
+        agitate('coupling')
+        heatedcoupling(aa[n], couplingtime) # 60 min coupling at room temperature by default
+        agitate(None)
         waste.write(1)
         vent.write(1)
         print('Draining reagents')
-        sleep(30)# draining
+        drain(30) # draining
         n2.write(0)
         waste.write(0)
         vent.write(0)
-    for w in range(1,6): # 5 times washing
+    for w in range(1, washes+1): # 5 times washing by default
         print('Washing ' + str(w))
-        washing()
+        washing(w == washes)
     filewrite('Completed at ' + timestamp())
     print(' ')
 
-def fmocdeprotection():
+def fmocdeprotection(residue=''): # residue labels the UV release curves
     filewrite('fmoc deprotection started at ' + timestamp())
     print('Adding reagents')
     pspos(4)
-    sleep(1)
-    prime.write(1)
-    pumpon(len2) # removing previous reagent from tubing between ps and pump
-    prime.write(0)
-    reagent.write(1)
-    pumpon(len3) # removing DMF leftover in the tubing
-    reagent.write(0)
-    waste.write(1)
-    vent.write(1)
-    n2.write(1)
-    sleep(10)
-    n2.write(0)
-    vent.write(0)
-    waste.write(0)
+    if not primedahead(4): # primed in the last wash of the step before
+        sleep(1)
+        prime.write(1)
+        pumpon(len2) # removing previous reagent from tubing between ps and pump
+        prime.write(0)
+        reagent.write(1)
+        pumpon(len3) # removing DMF leftover in the tubing
+        reagent.write(0)
+        waste.write(1)
+        vent.write(1)
+        n2.write(1)
+        drain(10)
+        n2.write(0)
+        vent.write(0)
+        waste.write(0)
     reagent.write(1)
     pumpon(ss*1000) # addition of 1 ml piperidine solution
     pspos(1)
     n2.write(1)
     reagent.write(0)
-    print('10 min first round deprotection')
-    sleep(600) # 10 min first round deprotection
+    print(str("{:.0f}".format(deprotectiontime[0]/60)) + ' min first round deprotection')
+    agitate('deprotection')
+    treatment(deprotectiontime[0], residue, 1) # 10 min first round deprotection by default
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     waste.write(0)
     vent.write(0)
     n2.write(0)
@@ -559,37 +1618,26 @@ def fmocdeprotection():
     pspos(1)
     n2.write(1)
     reagent.write(0)
-    print('20 min second round deprotection')
-    sleep(1200) # 20 min second round deprotection
+    print(str("{:.0f}".format(deprotectiontime[1]/60)) + ' min second round deprotection')
+    agitate('deprotection')
+    treatment(deprotectiontime[1], residue, 2) # 20 min second round deprotection by default
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     vent.write(0)
     waste.write(0)
     n2.write(0)
-    pspos(2)
-    prime.write(1)
-    pumpon(len2) # DMF to remove previous reagent from tubing between ps and pump
-    prime.write(0)
-    reagent.write(1)
-    pumpon(len3) # DMF to add previous reagent leftover in the tubing
-    pspos(1)
-    reagent.write(0)
-    waste.write(1)
-    vent.write(1)
-    n2.write(1)
-    sleep(10)
-    n2.write(0)
-    vent.write(0)
-    waste.write(0)
-    for w in range(1,6): # 5 times washing
+    if not fuse('chase'): # the first wash pushes the reagent left in the tubing to the resin
+        chase()
+    for w in range(1, washes+1): # 5 times washing by default
         print('Washing ' + str(w))
-        washing()
+        washing(w == washes)
     filewrite('Completed at ' + timestamp())
     print(' ')
     
-def finalwashing():
+def finalwashing(cleaning=[]): # cleaning is the line cleaning plan, carried out while drying
     filewrite('Final washing tarted at ' + timestamp())
     for w in range(1,6): # 5 times washing
         print('Washing ' + str(w))
@@ -602,57 +1650,195 @@ def finalwashing():
         n2.write(1)
         waste.write(1)
         vent.write(1)
-        sleep(60) # draining
+        drain(60) # draining
         vent.write(0)
         waste.write(0)
         n2.write(0)
     filewrite('Completed at ' + timestamp())
     print(' ')
     filewrite('Drying started at ' + timestamp())
-    drying()
+    drying(cleaning)
     filewrite('Completed at ' + timestamp())
     print(' ')
 
+def hold(): # outside the staffed hours the resin waits for the operator in DMF instead of drained, the DMF is drained when the operator is there
+    if isstaffed(datetime.now()):
+        return
+    filewrite('No operator expected at ' + timestamp() + ', the resin is held in DMF')
+    reagent.write(1)
+    pspos(2)
+    pumpon(1000) # addition of 1 ml DMF
+    pspos(1)
+    reagent.write(0)
+    release()
+    ask('Resin held in DMF, press ENTER to drain it and continue')
+    print(' ')
+    acquire()
+    resync() # the device may have been operated manually while waiting
+    n2.write(1)
+    waste.write(1)
+    vent.write(1)
+    drain(15) # draining
+    vent.write(0)
+    waste.write(0)
+    n2.write(0)
+
 def pause():
     reagent.write(1)
     pspos(2)
     pumpon(1000) # addition of 1 ml DMF
     pspos(1)
     reagent.write(0)
-    input('Synthesis paused, Press ENTER to continue')
+    release()
+    ask('Synthesis paused, Press ENTER to continue')
     print(' ')
+    acquire()
+    resync() # the device may have been operated manually during the pause
     n2.write(1)
     waste.write(1)
     vent.write(1)
-    sleep(15) # draining
+    drain(15) # draining
     vent.write(0)
     waste.write(0)
     n2.write(0)
     
-def aalinecleaning():
-    m = int(input('Enter the starting position on ps '))
-    n = int(input('Enter the ending position on ps '))
-    print(' ')
-    input('Insert all amino acid/reagent lines in DMF and then press ENTER to continue')
+def portmapfile(configname): # port map of the instrument of a device configuration file, see saveportmap()
+    return path.join(path.dirname(path.abspath(__file__)), 'output', path.splitext(path.basename(configname))[0] + '-portmap.txt')
+
+def loadportmap(name): # {position: (bottle, line, since)} of a port map file, bottle 'none' for an empty port, line primed, DMF or unknown, {} without a file
+    config = ConfigParser(interpolation=None)
+    portmap = {}
+    try:
+        config.read(name)
+        if config.has_section('Ports'):
+            for pos, value in config.items('Ports'):
+                bottle, line, since = [x.strip() for x in value.split(',')]
+                portmap[int(pos)] = (bottle, line, datetime.strptime(since, '%Y-%m-%d %H:%M:%S'))
+    except (Error, ValueError) as error:
+        print('The port map ' + name + ' could not be read (' + str(error) + '), all bottles are placed and all lines primed')
+        return {}
+    return portmap
+
+def seedlines(): # bottles left on the ports by the last run on the instrument, they stay where they are, see placement()
+    global portmap
+    portmap = loadportmap(portmapname)
+    for pos, (bottle, line, since) in sorted(portmap.items()):
+        if 8 <= pos <= ports and bottle != 'none':
+            bottles[pos] = bottle
+            lines[pos] = bottle
+
+def primedlines(): # lines left by the last run, a line primed with the bottle now on its port less than primedhours ago is not primed again
+    valid = []
+    for pos, (bottle, line, since) in sorted(portmap.items()):
+        if pos > ports:
+            continue
+        if line == 'primed' and bottle == lines.get(pos) and datetime.now() - since < timedelta(hours=primedhours):
+            tubing.lines[pos] = [[bottle, len1]]
+            if pos < 8 or pos in assignment.values():
+                valid.append(str(pos) + ' (' + bottle + ')')
+        elif line == 'DMF':
+            tubing.lines[pos] = [['DMF', len1]]
+    if valid:
+        filewrite('Lines still primed from the last run, not primed again: ' + ', '.join(valid))
+        print(' ')
+
+def linestate(pos, bottle): # primed when the line of a position is full of the solution of its bottle, DMF when it was cleaned, unknown otherwise
+    plugs = tubing.line(pos)
+    if all(content == bottle for content, v in plugs):
+        return 'primed'
+    if all(content == 'DMF' for content, v in plugs):
+        return 'DMF'
+    return 'unknown'
+
+def writeportmap(name, entries): # writes a port map file, {position: (bottle, line, since)}
+    config = ConfigParser(interpolation=None)
+    config.add_section('Ports')
+    for pos in sorted(entries):
+        bottle, line, since = entries[pos]
+        config.set('Ports', str(pos), bottle + ', ' + line + ', ' + since.strftime('%Y-%m-%d %H:%M:%S'))
+    if not path.exists(path.dirname(name)):
+        mkdir(path.dirname(name))
+    with open(name, 'w') as file:
+        file.write('# PepSy port map, written at the end of every run: position = bottle, line (primed, DMF or unknown), since\n')
+        config.write(file)
+
+def marklines(name, positions, line): # sets the state of lines in a port map file, e.g., after PepSy-manual.py cleaned or pumped from them, a cleaned line is out of its bottle
+    entries = loadportmap(name)
+    for pos in positions:
+        bottle = entries.get(pos, ('none',))[0]
+        if pos >= 8 and line == 'DMF':
+            bottle = 'none'
+        if pos >= 4:
+            entries[pos] = (bottle, line, datetime.now())
+    writeportmap(name, entries)
+
+def saveportmap(): # writes the bottle on every port and the state of its line for the next run, see seedlines()
+    stamp = datetime.now()
+    entries = {}
+    for pos in range(4, ports+1):
+        if pos not in lines and pos not in bottles:
+            continue
+        bottle = lines[pos] if pos < 8 else bottles.get(pos, 'none')
+        line = linestate(pos, bottle)
+        if bottle == 'none' and line == 'unknown':
+            continue
+        since = stamp
+        if pos in portmap and portmap[pos][:2] == (bottle, line) and usedvol(pos) == 0: # not pumped from in this run
+            since = portmap[pos][2]
+        entries[pos] = (bottle, line, since)
+    writeportmap(portmapname, entries)
+
+cleanfilm = 0.05 # fraction of a solution left as a film on the tubing it wetted once it is pushed out with DMF
+cleantarget = 0.01 # fraction of it left in a cleaned line
+# A line wetted from aa to pump (len1 + len2) then takes 1.6 line volumes of DMF after the one that pushes the solution out, as the 500 ul of the
+# fixed cleaning did for the tubing of the protocol (len1 + len2 + 500 ul).
+
+def cleanvol(plugs): # DMF in microliters to clean a line from aa to ps to pump holding plugs (from inlet to outlet): the solutions are pushed out past the pump, then the film they left on the tubing is diluted to cleantarget
+    wetted = sum(v for content, v in plugs if content not in ('DMF', 'DCM')) # unknown contents ('?') are cleaned as solutions
+    if wetted == 0:
+        return 0
+    return clearvol(plugs, ('DMF', 'DCM')) + int(wetted*log(cleanfilm/cleantarget))
+
+def cleaningplan(p): # line cleaning plan (position, content) for the positions p, the DMF volumes follow the tubing when the lines are cleaned
+    return [(pos, lines.get(pos, '')) for pos in sorted(p)]
+
+def aalinecleaning(plan): # cleans the lines in the cleaning plan, only the lines used in the run are cleaned
+    ask('Insert amino acid/reagent lines at positions ' + ', '.join(str(pos) for pos, content in plan) + ' in DMF and then press ENTER to continue')
     print(' ')
-    for o in range(m,n+1):
-        print('Cleaning line ', o)
-        pspos(o)
+    total = 0
+    for pos, content in plan:
+        vol = cleanvol(tubing.line(pos) + tubing.ps2pump)
+        total += vol
+        filewrite('Cleaning line ' + str(pos) + ' (' + content + ') with ' + str(vol) + ' ul DMF')
+        pspos(pos)
         prime.write(1)
-        pumpon(500+len1+len2)
+        lines[pos], content = 'DMF', lines.get(pos, '') # the line is in DMF while it is cleaned
+        pumpon(vol)
+        lines[pos] = content
         prime.write(0)
+        used.discard(pos)
+        bottles.pop(pos, None) # the line was taken out of its bottle
     pspos(1)
+    fixed = len(plan)*(500+len1+len2) # the fixed cleaning of every line
+    filewrite('Lines cleaned with ' + str("{:.1f}".format(total/1000)) + ' ml DMF, ' + str("{:.1f}".format((fixed - total)/1000)) + ' ml less than the fixed ' + str(500+len1+len2) + ' ul per line')
     print(' ')
     print('Remove amino acid/reagent lines from DMF and clean the exterior with acetone or isopropyl alcohol wipe')
     print(' ')
     print('Amino acid/reagent lines cleaning completed')
     print(' ')
     
-def drying():
+def drying(cleaning=[]): # the lines in the cleaning plan are cleaned during drying, the pump is not used for drying
     n2.write(1)
     vent.write(1)
     waste.write(1)
-    sleep(1800) # 30 min drying
+    agitate('drying')
+    start = now()
+    if cleaning:
+        filewrite('Amino acid/reagent lines cleaning started at ' + timestamp())
+        aalinecleaning(cleaning)
+        filewrite('Completed at ' + timestamp())
+    sleep(max(0, 1800 - (now() - start))) # 30 min drying
+    agitate(None)
     n2.write(0)
     vent.write(0)
     waste.write(0)
@@ -663,31 +1849,34 @@ def ivddedeprotection(n): # S. No. (integer) of the reagent
     aapos = a[n]
     pspos(aapos)
     filewrite('ivDde position on PS is ' + str(aapos))
-    sleep(1)
-    prime.write(1)
-    pumpon(len1+len2) # removing previous reagent from tubing between aa to ps to pump
-    prime.write(0)
-    reagent.write(1)
-    pumpon(len3) # removing DMF leftover in the tubing
-    reagent.write(0)
-    waste.write(1)
-    vent.write(1)
-    n2.write(1)
-    sleep(10)
-    n2.write(0)
-    vent.write(0)
-    waste.write(0)
+    if not primedahead(aapos): # primed in the last wash of the step before
+        sleep(1)
+        prime.write(1)
+        pumpon(len1+len2) # removing previous reagent from tubing between aa to ps to pump
+        prime.write(0)
+        reagent.write(1)
+        pumpon(len3) # removing DMF leftover in the tubing
+        reagent.write(0)
+        waste.write(1)
+        vent.write(1)
+        n2.write(1)
+        drain(10)
+        n2.write(0)
+        vent.write(0)
+        waste.write(0)
     reagent.write(1)
     pumpon(ss*1000) # addition of 1 ml hydrazine solution
     pspos(1)
     n2.write(1)
     reagent.write(0)
     print('10 min first round deprotection')
+    agitate('deprotection')
     sleep(600) # 10 min first round deprotection
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     waste.write(0)
     vent.write(0)
     n2.write(0)
@@ -699,77 +1888,59 @@ def ivddedeprotection(n): # S. No. (integer) of the reagent
     n2.write(1)
     reagent.write(0)
     print('20 min second round deprotection')
+    agitate('deprotection')
     sleep(1200) # 20 min second round deprotection
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     vent.write(0)
     waste.write(0)
     n2.write(0)
-    pspos(2)
-    prime.write(1)
-    pumpon(len2) # DMF to remove previous reagent from tubing between ps and pump
-    prime.write(0)
-    reagent.write(1)
-    pumpon(len3) # DMF to add previous reagent leftover in the tubing
-    pspos(1)
-    reagent.write(0)
-    waste.write(1)
-    vent.write(1)
-    n2.write(1)
-    sleep(10)
-    n2.write(0)
-    vent.write(0)
-    waste.write(0)
-    for w in range(1,6): # 5 times washing
+    if not fuse('chase'): # the first wash pushes the reagent left in the tubing to the resin
+        chase()
+    for w in range(1, washes+1): # 5 times washing by default
         print('Washing ' + str(w))
-        washing()
+        washing(w == washes)
     filewrite('Completed at ' + timestamp())
     print(' ')
 
 def onresinoxidation():
     filewrite('Onresin oxidation started at ' + timestamp())
-    input('Synthesis paused, add Tl(CF3COO)3 solution to the reactor manually, and press ENTER to continue')
+    hold()
+    ask('Synthesis paused, add Tl(CF3COO)3 solution to the reactor manually, and press ENTER to continue')
     n2.write(1)
     print('60 min first round oxidation')
+    agitate('oxidation')
     sleep(3600) # 60 min first round oxidation
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     waste.write(0)
     vent.write(0)
     n2.write(0)
-    input('Synthesis paused, add Tl(CF3COO)3 solution to the reactor manually, and press ENTER to continue')
+    hold()
+    ask('Synthesis paused, add Tl(CF3COO)3 solution to the reactor manually, and press ENTER to continue')
     n2.write(1)
     print('60 min second round oxidation')
+    agitate('oxidation')
     sleep(3600) # 60 min second round oxidation
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     vent.write(0)
     waste.write(0)
     n2.write(0)
-    pspos(2)
-    prime.write(1)
-    pumpon(len2) # DMF to remove previous reagent from tubing between ps and pump
-    prime.write(0)
-    reagent.write(1)
-    pumpon(len2) # DMF to add previous reagent leftover in the tubing
-    pspos(1)
-    reagent.write(0)
-    waste.write(1)
-    vent.write(1)
-    n2.write(1)
-    sleep(10)
-    n2.write(0)
-    vent.write(0)
-    waste.write(0)
-    for w in range(1,6): # 5 times washing
+    if not fuse('chase'): # the first wash pushes the reagent left in the tubing to the resin
+        chase()
+    for w in range(1, washes+1): # 5 times washing by default
         print('Washing ' + str(w))
-        washing()
+        washing(w == washes)
     filewrite('Completed at ' + timestamp())
     print(' ')
 
@@ -779,204 +1950,692 @@ def endcapping(n): # S. No. (integer) of the reagent
     aapos = a[n]
     pspos(aapos)
     filewrite('Acetic anhydride position on PS is ' + str(aapos))
-    sleep(1)
-    prime.write(1)
-    pumpon(len1+len2) # removing previous reagent from tubing between aa to ps to pump
-    prime.write(0)
-    reagent.write(1)
-    pumpon(len3) # removing DMF leftover in the tubing
-    reagent.write(0)
-    waste.write(1)
-    vent.write(1)
-    n2.write(1)
-    sleep(10)
-    n2.write(0)
-    vent.write(0)
-    waste.write(0)
+    if not primedahead(aapos): # primed in the last wash of the step before
+        sleep(1)
+        prime.write(1)
+        pumpon(len1+len2) # removing previous reagent from tubing between aa to ps to pump
+        prime.write(0)
+        reagent.write(1)
+        pumpon(len3) # removing DMF leftover in the tubing
+        reagent.write(0)
+        waste.write(1)
+        vent.write(1)
+        n2.write(1)
+        drain(10)
+        n2.write(0)
+        vent.write(0)
+        waste.write(0)
     reagent.write(1)
     pumpon(ss*1000) # addition of 1 ml acetic anhydride solution
     pspos(1)
     n2.write(1)
     reagent.write(0)
     print('30 min end capping')
+    agitate('endcapping')
     sleep(1800) # 30 min end capping
+    agitate(None)
     waste.write(1)
     vent.write(1)
     print('Draining reagents')
-    sleep(30)# draining
+    drain(30) # draining
     waste.write(0)
     vent.write(0)
     n2.write(0)
-    pspos(2)
-    prime.write(1)
-    pumpon(len2) # DMF to remove previous reagent from tubing between ps and pump
-    prime.write(0)
-    reagent.write(1)
-    pumpon(len3) # DMF to add previous reagent leftover in the tubing
-    pspos(1)
-    reagent.write(0)
-    waste.write(1)
-    vent.write(1)
-    n2.write(1)
-    sleep(10)
-    n2.write(0)
-    vent.write(0)
-    waste.write(0)
-    for w in range(1,6): # 5 times washing
+    if not fuse('chase'): # the first wash pushes the reagent left in the tubing to the resin
+        chase()
+    for w in range(1, washes+1): # 5 times washing by default
         print('Washing ' + str(w))
-        washing()
+        washing(w == washes)
     filewrite('Completed at ' + timestamp())
     print(' ')
 # -------------------------------------------------------------------------------------------------------------------------------------------
 
-# Main
-devconfig = ConfigParser()
-devconfig.readfp(open('config.txt'))
-pscom = devconfig.get('Parameters', 'pscom')
-arduinocom = devconfig.get('Parameters', 'arduinocom')
-ports = devconfig.getint('Parameters', 'ports')
-tubevol = devconfig.getfloat('Parameters', 'tubevol')
-length1 = devconfig.getfloat('Parameters', 'length1')
-length2 = devconfig.getfloat('Parameters', 'length2')
-length3 = devconfig.getfloat('Parameters', 'length3')
-piv = devconfig.getint('Parameters', 'piv')
-
-len1 = int(tubevol*length1) 
-len2 = int(tubevol*length2) 
-len3 = int(tubevol*length3)
-
-ps = serial.Serial(port=pscom, baudrate=9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS) # VICI port selector
-board = Arduino(arduinocom) # Arduino Uno
-n2 = board.get_pin('d:2:o') # Solenoid valve normally closed, connected to digital pin 2
-vent = board.get_pin('d:3:o') # Solenoid valve normally open, connected to digital pin 3
-reagent = board.get_pin('d:4:o') # Solenoid valve normally closed, connected to digital pin 4
-waste = board.get_pin('d:5:o') # Solenoid valve normally closed, connected to digital pin 5
-prime = board.get_pin('d:6:o') # Solenoid valve normally closed, connected to digital pin 6
-pump = board.get_pin('d:7:o') # Solenoid micro pump with an internal volume of 20 microliter and rated for a maximum pumping rate of 2.4 ml/min or 40 microliter/sec, connected to digital pin 7
-
-print(' ')
-print('--------------------------------------------------------------------------------------------------')
-print('                                           PepSy                                                  ')
-print('--------------------------------------------------------------------------------------------------')
-print(' ')
-
-seqfile = input('Enter the sequence configuration file name ')
-print(' ')
-if seqfile == '':
-    q1 = input('Do you want to terminate the run (y or n)? ')
-    print(' ')
-    if q1.upper() == 'Y':
-        ps.close()
-        exit()
+# Setup and run
+def loaddevice(configname='config.txt'): # reads the device configuration file
+    global pscom, arduinocom, ports, tubevol, length1, length2, length3, piv, len1, len2, len3, daemonport, daemonkey, drainpin, drainlevel, drainmargin
+    global uvpin, uvplateau, uvmin, uvmax, heaterpin, probepin, probescale, pidgains, staffed, agitation, n2flow, deviceprocess, devconfigname, primedhours, portmapname
+    devconfig = ConfigParser()
+    devconfig.readfp(open(configname))
+    pscom = devconfig.get('Parameters', 'pscom')
+    arduinocom = devconfig.get('Parameters', 'arduinocom')
+    ports = devconfig.getint('Parameters', 'ports')
+    tubevol = devconfig.getfloat('Parameters', 'tubevol')
+    length1 = devconfig.getfloat('Parameters', 'length1')
+    length2 = devconfig.getfloat('Parameters', 'length2')
+    length3 = devconfig.getfloat('Parameters', 'length3')
+    piv = devconfig.getint('Parameters', 'piv')
+    daemonport = devconfig.getint('Parameters', 'daemonport', fallback=6001)
+    daemonkey = devconfig.get('Parameters', 'daemonkey', fallback='daemon.key')
+    drainpin = devconfig.getint('Parameters', 'drainpin', fallback=None)
+    drainlevel = devconfig.getfloat('Parameters', 'drainlevel', fallback=0.05)
+    drainmargin = devconfig.getfloat('Parameters', 'drainmargin', fallback=3)
+    uvpin = devconfig.getint('Parameters', 'uvpin', fallback=None)
+    uvplateau = devconfig.getfloat('Parameters', 'uvplateau', fallback=0.01)
+    uvmin = devconfig.getfloat('Parameters', 'uvmin', fallback=300)
+    uvmax = devconfig.getfloat('Parameters', 'uvmax', fallback=2400)
+    heaterpin = devconfig.getint('Parameters', 'heaterpin', fallback=None)
+    probepin = devconfig.getint('Parameters', 'probepin', fallback=None)
+    probescale = devconfig.getfloat('Parameters', 'probescale', fallback=500)
+    pidgains = tuple(float(x) for x in devconfig.get('Parameters', 'pidgains', fallback='0.1, 0.002, 0').split(','))
+    staffed = staffedhours(devconfig.get('Parameters', 'staffed', fallback=''))
+    agitation = agitations(devconfig.get('Parameters', 'agitation', fallback=''))
+    n2flow = devconfig.getfloat('Parameters', 'n2flow', fallback=None)
+    deviceprocess = devconfig.get('Parameters', 'deviceprocess', fallback='y')
+    devconfigname = path.abspath(configname)
+    primedhours = devconfig.getfloat('Parameters', 'primedhours', fallback=24)
+    portmapname = portmapfile(configname)
+    len1 = int(tubevol*length1) 
+    len2 = int(tubevol*length2) 
+    len3 = int(tubevol*length3)
+
+def startdaemon(): # starts PepSy-daemon.py as the device process of the run, returns the connection to it, None when it did not start
+    global devicechild
+    folder = path.dirname(path.abspath(__file__))
+    try: # in its own process group, Ctrl-C stops the run and not the device process
+        devicechild = subprocess.Popen([sys.executable, path.join(folder, 'PepSy-daemon.py'), devconfigname], cwd=folder, start_new_session=(sys.platform != 'win32'),
+                                       creationflags=getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0))
+    except OSError:
+        return None
+    end = monotonic() + 20 # the board resets when it is opened
+    while monotonic() < end and devicechild.poll() is None:
+        conn = opendaemon(daemonport, daemonkey)
+        if conn is not None:
+            return conn
+        wait(0.5)
+    if devicechild.poll() is None:
+        devicechild.terminate()
+    devicechild = None
+    return None
+
+def disconnect(): # lets other clients use the device and ends the device process started for the run
+    global devicechild
+    release()
+    if devicechild is not None:
+        devicechild.terminate()
+        devicechild.wait()
+        devicechild = None
+
+def connect(): # opens the stream selector and the Arduino, through PepSy-daemon.py when it is running or can be started for the run, pyserial and pyfirmata are only needed without it
+    global ps, board, n2, vent, reagent, waste, prime, pump, sensor, uv, heater, daemon, agitator
+    daemon = opendaemon(daemonport, daemonkey)
+    if daemon is None and deviceprocess.upper() == 'Y':
+        daemon = startdaemon()
+        if daemon is None:
+            print('PepSy-daemon.py could not be started, the devices are opened and the pump strokes timed by this process')
+    if daemon is not None:
+        acquire()
+        ps = RemoteSelector(daemon)
+        board = None
+        n2 = Pin(RemotePin(daemon, 'n2'), 'n2')
+        vent = Pin(RemotePin(daemon, 'vent'), 'vent')
+        reagent = Pin(RemotePin(daemon, 'reagent'), 'reagent')
+        waste = Pin(RemotePin(daemon, 'waste'), 'waste')
+        prime = Pin(RemotePin(daemon, 'prime'), 'prime')
+        pump = Pin(RemotePin(daemon, 'pump'), 'pump')
+        if drainpin is not None:
+            sensor = RemoteSensor(daemon, 'drain')
+        if uvpin is not None:
+            uv = RemoteSensor(daemon, 'uv')
+        if heaterpin is not None and probepin is not None:
+            heater = Heater(RemotePin(daemon, 'heater'), RemoteSensor(daemon, 'probe'))
+            heater.start()
+        agitator = Agitator(n2)
+        if agitation:
+            agitator.start()
+        return
+    import serial
+    from pyfirmata import Arduino, util
+    ps = serial.Serial(port=pscom, baudrate=9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS) # VICI port selector
+    board = Arduino(arduinocom) # Arduino Uno
+    n2 = Pin(board.get_pin('d:2:o'), 'n2') # Solenoid valve normally closed, connected to digital pin 2
+    vent = Pin(board.get_pin('d:3:o'), 'vent') # Solenoid valve normally open, connected to digital pin 3
+    reagent = Pin(board.get_pin('d:4:o'), 'reagent') # Solenoid valve normally closed, connected to digital pin 4
+    waste = Pin(board.get_pin('d:5:o'), 'waste') # Solenoid valve normally closed, connected to digital pin 5
+    prime = Pin(board.get_pin('d:6:o'), 'prime') # Solenoid valve normally closed, connected to digital pin 6
+    pump = Pin(board.get_pin('d:7:o'), 'pump') # Solenoid micro pump with an internal volume of 20 microliter and rated for a maximum pumping rate of 2.4 ml/min or 40 microliter/sec, connected to digital pin 7
+    if drainpin is not None or uvpin is not None or probepin is not None:
+        util.Iterator(board).start() # reads the analog values reported by the board
+    if drainpin is not None:
+        sensor = board.get_pin('a:%d:i' % (drainpin)) # Pressure or liquid sensor below the reactor frit, connected to an analog pin
+        sensor.enable_reporting()
+    if uvpin is not None:
+        uv = board.get_pin('a:%d:i' % (uvpin)) # UV detector (about 300 nm) in the waste line below the reactor frit, connected to an analog pin
+        uv.enable_reporting()
+    if heaterpin is not None and probepin is not None:
+        probe = board.get_pin('a:%d:i' % (probepin)) # Temperature probe of the reactor (e.g., LM35), connected to an analog pin
+        probe.enable_reporting()
+        heater = Heater(board.get_pin('d:%d:p' % (heaterpin)), probe) # Reactor heater through a MOSFET, connected to a PWM digital pin
+        heater.start()
+    agitator = Agitator(n2)
+    if agitation:
+        agitator.start()
+
+def loadsequence(seqfile): # reads the sequence configuration file
+    global synconfig, seqname, seqfilename, seqmtime, ss, seq, seqfull, pa, saa, pr, sw, dp, fw, heat, heatprofile, washes, washvol, washdrain, couplingtime, deprotectiontime, doubles, strict
+    seqname = path.splitext(path.basename(seqfile))[0]
+    seqfilename = path.abspath(seqfile) # for the resume file and the edits during the run, see checkpoint() and replan()
+    seqmtime = path.getmtime(seqfile)
+    synconfig = ConfigParser()
+    synconfig.readfp(open(seqfile))
+    ss = synconfig.getint('Parameters', 'ss')
+    seq = synconfig.get('Parameters', 'seq')
+    pa = synconfig.get('Parameters', 'pa')
+    saa = synconfig.getint('Parameters', 'saa')
+    pr = synconfig.get('Parameters', 'pr')
+    sw = synconfig.get('Parameters', 'sw')
+    dp = synconfig.get('Parameters', 'dp')
+    fw = synconfig.get('Parameters', 'fw')
+    heat = synconfig.get('Parameters', 'heat', fallback='')
+    heatprofile = heatprofiles(heat)
+    washes = synconfig.getint('Parameters', 'washes', fallback=5)
+    washvol = synconfig.getint('Parameters', 'washvol', fallback=2000)
+    washdrain = synconfig.getfloat('Parameters', 'washdrain', fallback=60)
+    couplingtime = synconfig.getfloat('Parameters', 'couplingtime', fallback=60)*60
+    deprotectiontime = tuple(float(x)*60 for x in synconfig.get('Parameters', 'deprotectiontime', fallback='10/20').split('/'))
+    doubles = residuenumbers(synconfig.get('Parameters', 'double', fallback=''))
+    strict = synconfig.get('Parameters', 'strict', fallback='n')
+    seqfull = seq
+    if saa > 1:
+        seq=seq[:-(saa-1)] # removing the amino acids present before the amino acid from where the synthesis starts
+
+def run(): # synthesis of the loaded sequence from the first step to the line cleaning
+    global t0, aan, aan1, aa, a, c, d, paan, lines, used, drainsaved, pumped, waits, runid, tubing, savedvol, finished, residuesdone, coupled, later, strokelate, bottles, fused, stepat, preprimed
+    t0 = now()
+    fused = {}
+    stepat = None
+    preprimed = None
+    strokelate = []
+    finished = []
+    residuesdone = 0
+    coupled = False
+    skipped['pin'] = 0
+    skipped['ps'] = 0
+    drainsaved = 0
+    pumped = {}
+    waits = []
+    tubing = Tubing()
+    savedvol = {}
+    if agitator is not None:
+        agitator.saved = 0.0
+    if heatprofile and heater is None:
+        filewrite('No heater in the device configuration file, the couplings are not heated')
+    if history is not None:
+        try:
+            runid = history.execute('insert into runs (name, sequence, ss, started) values (?, ?, ?, ?)', (seqname, seq, ss, started(t0))).lastrowid
+            history.commit()
+        except sqlite3.Error as error:
+            runid = None
+            historyfailed(error)
+    lines = {4: 'piperidine', 5: 'DIPEA', 6: 'HOBT', 7: 'HBTU'} # contents of the amino acid/reagent lines, amino acid positions are added by positions()
+    used = set() # positions pumped from since their last cleaning
+    filewrite(datetime.now().strftime('%m-%d-%Y %I:%M:%S %p'))
+    filewrite('The peptides sequence not including any amino acid already present on the resin is ' + seq + '\n')
+    bottles = {}
+    if portmapname is not None:
+        seedlines()
+    print(' ')
+    aan = len(seq)
+    seq1 = Counter(x for x in seq if x not in ignore) # aa sorting
+    aan1 = len(seq1) # number of different amino acids and reagents
+    aa = [] # seq reversed for synthesis
+    a = [] # position
+    c = [] # coupling
+    d = [] # deprotection
+    ps.close()
+    if staffed:
+        operatorplan(runparts(seq))
+        clean = ask('Do you want to clean the amino acid/reagent lines at the end of the run (y or n)? ') # asked now, the final washing and drying need no operator
+        print(' ')
+        
+    if aan1 <= ports - 7: # checking whether reqired number of ports are available to accommodate all the amino acids and reagents, if not the peptide sequence will be split in to parts
+        later = [seq]
     else:
-        seqfile = input('Enter the sequence configuration file name ')
+        later = split(seq)
+        for k in range(1, len(later)+1):
+            filewrite(ordinal(k) + ' part of the sequence to be synthesized is ' + later[k-1])
         print(' ')
-filename = seqfile + datetime.now().strftime('-%Y-%m-%d-') +  'out.txt'
-seqfile = 'sequence/' + seqfile + '.txt'
-
-synconfig = ConfigParser()
-synconfig.readfp(open(seqfile))
-ss = synconfig.getint('Parameters', 'ss')
-seq = synconfig.get('Parameters', 'seq')
-pa = synconfig.get('Parameters', 'pa')
-saa = synconfig.getint('Parameters', 'saa')
-pr = synconfig.get('Parameters', 'pr')
-sw = synconfig.get('Parameters', 'sw')
-dp = synconfig.get('Parameters', 'dp')
-fw = synconfig.get('Parameters', 'fw')
-if saa > 1:
-    seq=seq[:-(saa-1)] # removing the amino acids present before the amino acid from where the synthesis starts
-
-dir = 'output/'
-if not path.exists(dir):
-    mkdir(dir)
-chdir(dir) # changing current working directory to output folder
-file = open(filename, 'w') # creating a new output file
-file.close()
-filewrite(datetime.now().strftime('%m-%d-%Y %I:%M:%S %p'))
-filewrite('The peptides sequence not including any amino acid already present on the resin is ' + seq + '\n')
-print(' ')
-aan = len(seq)
-ignore = ['*', '@', '#']
-seq1 = Counter(x for x in seq if x not in ignore) # aa sorting
-aan1 = len(seq1) # number of different amino acids and reagents
-aa = [] # seq reversed for synthesis
-a = [] # position
-c = [] # coupling
-d = [] # deprotection
-ps.close()
-    
-if aan1 <= ports - 7: # checking whether reqired number of ports are available to accommodate all the amino acids and reagents, if not the peptide sequence will be split in to two parts
-    paan = aan
-    for n in range (1, paan+1):
-        aa.append(seq[paan-n])
-    positions(seq)
-    presyn()
-    syn()
-else:
-    i = 1
-    while True:
-        seqtemp = seq[i:aan+1]
-        seqtemp1 = Counter(x for x in seqtemp if x not in ignore) # aa sorting
-        aantemp = len(seqtemp1) # number of different amino acids and reagents    
-        if aantemp <= ports - 7:
-            seqp1 = seq[i:aan+1]
-            seqp2 = seq[0:i]
-            break
-        i = i + 1
-    filewrite('First part of the sequence to be synthesized is ' + seqp1)
-    filewrite('Second part of the sequence to be synthesized is ' + seqp2)
-    print(' ')
-    paan = len(seqp1)
-    for n in range (1, paan+1):
-        aa.append(seqp1[paan-n])
-    positions(seqp1)
-    filewrite('First part of the sequence synthesis started')
-    presyn()
-    syn()
-    filewrite('First part of the peptide synthesis done, amino acid/reagent lines will be cleaned')
-    print(' ')
-    aalinecleaning()
-    a = None
-    c = None
-    d = None
-    aa = None
-    a = []
-    c = [] 
-    d = [] 
-    aa = []
-    paan = len(seqp2)
-    for n in range (1, paan+1):
-        aa.append(seqp2[paan-n])
-    positions(seqp2)
-    filewrite('Second part of the sequence synthesis started')
-    syn()
-    filewrite('Second part of the peptide synthesis done')
-    print(' ')        
-       
-if fw.upper() == 'Y':
-    finalwashing()
-elif fw.upper() == 'N':
-    filewrite('Final washing skipped')
-    print(' ')
-else:
-    fw1 = input('Input error in the sequence file. Do you want to perform final washing (y or n)? ')
-    print(' ')
-    if fw1.upper() == 'Y':
-        finalwashing()
+    k = 0
+    while later: # parts not synthesized yet, an edit of the sequence during the run can change them, see replan()
+        part = later.pop(0)
+        k += 1
+        a = []
+        c = [] 
+        d = [] 
+        aa = []
+        paan = len(part)
+        for n in range (1, paan+1):
+            aa.append(part[paan-n])
+        positions(part)
+        if k > 1 or later:
+            filewrite(ordinal(k) + ' part of the sequence synthesis started')
+        if k == 1:
+            presyn()
+        syn()
+        if later:
+            filewrite(ordinal(k) + ' part of the peptide synthesis done, amino acid/reagent lines will be cleaned')
+            print(' ')
+            aalinecleaning(cleaningplan(pos for pos in used if pos > 7)) # the piperidine, DIPEA, HOBT and HBTU lines stay in use
+        elif k > 1:
+            filewrite(ordinal(k) + ' part of the peptide synthesis done')
+            print(' ')        
+           
+    start = now()
+    if not staffed:
+        clean = ask('Do you want to clean the amino acid/reagent lines (y or n)? ')
+        print(' ')
+    if clean.upper() == 'Y':
+        cleaning = cleaningplan(used) # only the lines used in the run
     else:
+        cleaning = []
+    if fw.upper() == 'Y':
+        if cleaning and not isstaffed(datetime.now() + timedelta(seconds=plannedtimes(ss)['finalwashing'] - 1800)):
+            filewrite('No operator expected during drying, the amino acid/reagent lines will be cleaned after drying')
+            print(' ')
+            finalwashing()
+        else:
+            finalwashing(cleaning)
+            cleaning = [] # cleaned while drying
+    elif fw.upper() == 'N':
         filewrite('Final washing skipped')
         print(' ')
-      
-clean = input('Do you want to clean the amino acid/reagent lines (y or n)? ')
-print(' ')
-if clean.upper() == 'Y':
-    filewrite('Amino acid/reagent lines cleaning started at ' + timestamp())
-    aalinecleaning()
-    filewrite('Completed at ' + timestamp())
+    else:
+        fw1 = ask('Input error in the sequence file. Do you want to perform final washing (y or n)? ')
+        print(' ')
+        if fw1.upper() == 'Y':
+            finalwashing(cleaning)
+            cleaning = []
+        else:
+            filewrite('Final washing skipped')
+            print(' ')
+    logstep('finalwashing', '', start)
+          
+    if cleaning:
+        start = now()
+        filewrite('Amino acid/reagent lines cleaning started at ' + timestamp())
+        aalinecleaning(cleaning)
+        filewrite('Completed at ' + timestamp())
+        logstep('cleaning', '', start)
+    
+    print(' ')
+    filewrite('Redundant device commands skipped: ' + str(skipped['pin']) + ' pin writes and ' + str(skipped['ps']) + ' stream selector commands')
+    couplings = len([x for x in c if x in ('single', 'manual', 'double')]) + len([x for x in c if x == 'double']) # every round of a double coupling
+    if couplings:
+        saved = {}
+        for x in savedvol:
+            if x != 'time':
+                name = x if x in ('DMF', 'DCM', 'piperidine', 'DIPEA', 'HOBT', 'HBTU') else 'amino acid'
+                saved[name] = saved.get(name, 0) + savedvol[x]
+        filewrite('Line flushes saved per coupling: ' + ', '.join(x + ' ' + str("{:.0f}".format(saved[x]/couplings)) + ' ul' for x in sorted(saved) if saved[x] != 0) + ', and ' + str("{:.0f}".format(savedvol.get('time', 0)/couplings)) + ' s pumping')
+    if agitation and agitator is not None:
+        filewrite('N2 bubbling saved by pulsed agitation: ' + str("{:.0f}".format(agitator.saved/60)) + ' min' + (', ' + str("{:.1f}".format(agitator.saved/60*n2flow/1000)) + ' l N2' if n2flow else ''))
+    if sensor is not None:
+        filewrite('Draining time saved by the drain sensor: ' + str("{:.1f}".format(drainsaved/60)) + ' min')
+    if strict.upper() == 'Y':
+        filewrite('Strict protocol, no boundary operations fused')
+    elif fused:
+        filewrite('Boundary operations fused: ' + str(fused.get('chase', 0)) + ' DMF chases and ' + str(fused.get('preprime', 0)) + ' line primings in the last wash, '
+                  + str("{:.1f}".format(fused.get('time', 0)/60)) + ' min and ' + str("{:.1f}".format(fused.get('DMF', 0)/1000)) + ' ml DMF saved')
+    if strokelate:
+        filewrite(stroketiming())
+    filewrite('Peptide synthesis completed at ' + timestamp())
+    if history is not None:
+        try:
+            history.execute('update runs set ended = ?, actual = ?, planned = (select sum(planned) from steps where run = ?) where id = ?', (started(now()), now() - t0, runid, runid))
+            history.executemany('insert into volumes (run, position, content, ul) values (?, ?, ?, ?)', [(runid, p, content, v) for (p, content), v in sorted(pumped.items())])
+            history.commit()
+        except sqlite3.Error as error:
+            historyfailed(error)
+    if portmapname is not None:
+        saveportmap()
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Simulation
+# A run can be simulated without the stream selector and the Arduino. The pins and the selector are replaced by the classes below, sleep()
+# advances a virtual clock instead of waiting, and the questions asked during a run are answered by simanswer(). A full run takes seconds.
+class SimPin: # stands in for a pyfirmata output pin, counts the writes sent to the board
+    def __init__(self):
+        self.value = 0
+        self.writes = 0
+
+    def write(self, value):
+        self.value = value
+        self.writes += 1
+
+class SimPump(SimPin): # micro pump pin, adds one pump internal volume to the selected position on every stroke
+    def __init__(self, selector, reactor=None):
+        SimPin.__init__(self)
+        self.selector = selector
+        self.reactor = reactor
+        self.volumes = {} # pumped volume in microliters per stream selector position
+
+    def write(self, value):
+        SimPin.write(self, value)
+        if value == 1:
+            p = self.selector.position
+            self.volumes[p] = self.volumes.get(p, 0) + piv
+            if self.reactor is not None:
+                self.reactor.add(piv, p)
+
+class SimReactor(SimPin): # waste valve pin of a simulated reactor, the reactor fills with what is pumped through the reagent valve and empties while the waste valve is open
+    rate = 250.0 # microliters per second through the frit, 2 ml drain in 8 s
+    full = 4000.0 # microliters in the reactor for a sensor reading of 1
+
+    def __init__(self, clock, reagent):
+        SimPin.__init__(self)
+        self.clock = clock
+        self.reagent = reagent
+        self.volume = 0.0
+        self.t = clock.time()
+        self.random = random.Random(2020)
+        self.base = 0.0 # microliters of piperidine solution in the reactor
+        self.released = 0.0 # dibenzofulvene adduct in the reactor, in fractions of the fmoc groups on the resin
+        self.couple()
+
+    def couple(self): # a new fmoc amino acid on the resin, most residues deprotect with a half-life of 1 to 3 min, some (aggregating) of 7 to 15 min
+        self.fmoc = 1.0
+        if self.random.random() < 0.15:
+            self.halflife = self.random.uniform(420, 900)
+        else:
+            self.halflife = self.random.uniform(60, 180)
+
+    def update(self):
+        dt = self.clock.time() - self.t
+        if self.volume > 0 and self.base > 0:
+            released = self.fmoc*(1 - 0.5**(dt*self.base/self.volume/self.halflife))
+            self.fmoc -= released
+            self.released += released
+        if self.value == 1 and self.volume > 0:
+            left = max(0.0, self.volume - self.rate*dt)/self.volume
+            self.volume *= left
+            self.base *= left
+            self.released *= left
+        self.t = self.clock.time()
+
+    def write(self, value):
+        self.update()
+        SimPin.write(self, value)
+
+    def add(self, v, p):
+        self.update()
+        if self.reagent.value == 1:
+            self.volume += v
+            if p == 4:
+                self.base += v
+            if p == 7 and self.fmoc < 1: # HBTU, the amino acid is coupled
+                self.couple()
+
+    def read(self): # simulated drain sensor
+        self.update()
+        return min(1.0, self.volume/self.full)
 
-print(' ')
-filewrite('Peptide synthesis completed at ' + timestamp())
+    def absorbance(self):
+        self.update()
+        if self.volume == 0:
+            return 0.0
+        return min(1.0, max(0.0, 0.8*self.released*1000/self.volume + self.random.gauss(0, 0.003)))
+
+class SimUV: # synthetic signal of the UV detector below the simulated reactor
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def read(self):
+        return self.reactor.absorbance()
+
+class SimSelector: # stands in for the serial port of the VICI stream selector, counts the commands sent to it
+    def __init__(self):
+        self.position = 1
+        self.writes = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        command = data.decode().strip()
+        self.position = 1 if command == 'HM' else int(command[2:])
+        self.writes += 1
+
+class SimThermal: # heater pin and temperature probe of a simulated reactor block, a 25 W heater against the heat lost to the room
+    room = 22.0 # degree C
+    power = 25.0 # W
+    capacity = 40.0 # J/K, reactor, block and 2 ml solvent
+    loss = 0.3 # W/K
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.temperature = self.room
+        self.duty = 0.0
+        self.t = clock.time()
+
+    def update(self): # exact for a constant duty between two writes
+        dt = self.clock.time() - self.t
+        steady = self.room + self.duty*self.power/self.loss
+        self.temperature = steady + (self.temperature - steady)*exp(-dt*self.loss/self.capacity)
+        self.t = self.clock.time()
+
+    def write(self, duty):
+        self.update()
+        self.duty = duty
+
+    def read(self): # simulated probe
+        self.update()
+        return self.temperature/probescale
+
+class VirtualClock:
+    def __init__(self):
+        self.t = 0.0
+        self.ticks = [] # called every second of virtual time, e.g., the heater control loop
+
+    def sleep(self, s):
+        if not self.ticks:
+            self.t += s
+            return
+        end = self.t + s
+        while self.t < end:
+            dt = min(1.0, end - self.t)
+            self.t += dt
+            for tick in self.ticks:
+                tick(dt)
+
+    def time(self):
+        return self.t
+
+def simanswer(prompt=''): # answers the questions asked during a run, the lines are always cleaned
+    if '(y or n)' in prompt:
+        return 'y'
+    return ''
+
+def simdevices(): # replaces the devices, the clock, the questions and the output file for a simulation, returns the virtual clock
+    global ps, board, n2, vent, reagent, waste, prime, pump, sensor, uv, heater, sleep, now, input, filename, uvname, tubing, staffed, agitator, portmapname
+    clock = VirtualClock()
+    ps = SimSelector()
+    board = None
+    n2 = Pin(SimPin(), 'n2')
+    vent = Pin(SimPin(), 'vent')
+    reagent = Pin(SimPin(), 'reagent')
+    waste = Pin(SimReactor(clock, reagent.pin), 'waste')
+    prime = Pin(SimPin(), 'prime')
+    pump = Pin(SimPump(ps, waste.pin), 'pump')
+    sensor = waste.pin if drainpin is not None else None # the simulated reactor has a drain sensor when one is configured
+    uv = SimUV(waste.pin) if uvpin is not None else None # and a UV detector
+    heater = None
+    if heaterpin is not None and probepin is not None: # and a heater, its control loop is stepped by the virtual clock
+        thermal = SimThermal(clock)
+        heater = Heater(thermal, thermal)
+        clock.ticks.append(heater.control)
+    agitator = Agitator(n2) # and pulsed N2, stepped by the virtual clock
+    if agitation:
+        clock.ticks.append(agitator.control)
+    sleep = clock.sleep
+    now = clock.time
+    input = simanswer
+    filename = devnull
+    uvname = devnull
+    tubing = Tubing()
+    staffed = [] # the simulated operator is always there
+    portmapname = None # nor placed bottles or primed lines
+    return clock
+
+def simulate(seqfile, tracename=None, drainsensor=None, uvdetector=None, heating=None, pulsing=None, protocol=None): # simulated run of a sequence configuration file, returns the run time in seconds, drainsensor and uvdetector True or False override the device configuration, heating (a heat profile, e.g., '75/10') the sequence configuration file with a heater, pulsing (e.g., 'coupling:10/60') the N2 agitation, protocol ({'washes': 4, ...}) its protocol parameters
+    global tracefile, input, drainpin, uvpin, heaterpin, probepin, heat, heatprofile, agitation
+    loaddevice()
+    if drainsensor is not None:
+        drainpin = 0 if drainsensor else None
+    if uvdetector is not None:
+        uvpin = 1 if uvdetector else None
+    loadsequence(seqfile)
+    if heating is not None:
+        heaterpin, probepin, heat = 9, 2, heating
+        heatprofile = heatprofiles(heat)
+    if pulsing is not None:
+        agitation = agitations(pulsing)
+    for x in (protocol or {}):
+        globals()[x] = protocol[x]
+    clock = simdevices()
+    if tracename is not None:
+        tracefile = open(tracename, 'w')
+        tracefile.write('# PepSy trace of ' + seqfile + '\n')
+    try:
+        with open(devnull, 'w') as out, redirect_stdout(out):
+            run()
+    finally:
+        if tracefile is not None:
+            tracefile.close()
+            tracefile = None
+        del input
+    return clock.time()
+# -------------------------------------------------------------------------------------------------------------------------------------------
+
+# Main
+residues = loadresidues(path.join(path.dirname(path.abspath(__file__)), 'residues.txt')) # amino acid/reagent table, see residue()
+unknown = {'mw': 0, 'coupling': 'single', 'deprotection': 'fmoc', 'port': 'aa', 'next': '-', 'ml': 0.5, 'name': 'Amino acid'} # a symbol not in the table
+ignore = [x for x in residues if residues[x]['port'] == '-'] # symbols without a port (pause, on-resin oxidation and manual coupling)
+lines = {} # contents of the amino acid/reagent lines, see run()
+used = set() # positions pumped from since their last cleaning
+daemon = None # connection to PepSy-daemon.py, None when the device is opened directly
+devicechild = None # PepSy-daemon.py started for the run, see startdaemon()
+deviceprocess = 'y' # PepSy-daemon.py is started for the run when it is not running
+devconfigname = 'config.txt'
+strokelate = [] # seconds late of every edge of the pump strokes of the run, see stroketiming()
+portmapname = None # port map of the instrument, None when it is not kept (e.g., simulations), see saveportmap()
+portmap = {} # port map read at the start of the run, see loadportmap()
+bottles = {} # amino acid/reagent bottle on every port from 8
+primedhours = 24 # hours a primed line stays valid
+iolock = threading.RLock() # device commands of the run and of the heater thread
+stopped = threading.Event() # stops the heater thread
+heater = None # reactor heater, None when the couplings are not heated
+heat = '' # heat profile of the sequence configuration file, see heatprofiles()
+heatprofile = {}
+agitator = None # N2 pulsing of the incubations, see Agitator
+agitation = {} # N2 pulses by step type, see agitations()
+n2flow = None # N2 flow rate in ml/min, for the gas saved by pulsing
+washes = 5 # DMF washes after every step, see loadsequence()
+washvol = 2000 # microliters of DMF per wash
+washdrain = 60 # seconds of draining after a wash
+couplingtime = 3600 # seconds of a coupling at room temperature
+deprotectiontime = (600, 1200) # seconds of the first and the second round of fmoc deprotection
+strict = 'n' # y leaves no boundary operation out, see fusions
+fused = {} # boundary operations left out in this run by rule, and the seconds ('time') and microliters of DMF ('DMF') saved
+stepat = None # (amino acid number in the part, 'c' coupling or 'd' deprotection) of the step running, see following()
+preprimed = None # (step, position) primed in the last wash of the step before, see preprime()
+simparameters = ('ports', 'piv', 'len1', 'len2', 'len3', 'drainpin', 'drainlevel', 'drainmargin', 'uvpin', 'uvplateau', 'uvmin', 'uvmax',
+                 'heaterpin', 'probepin', 'probescale', 'pidgains', 'washes', 'washvol', 'washdrain', 'couplingtime',
+                 'deprotectiontime', 'strict') # device and protocol parameters that change the simulated step times, see steptimes()
+sensor = None # drain sensor, None when the drains are timed
+uv = None # UV detector, None when the deprotection is timed
+uvname = devnull # fmoc release curves of the run, see uvwrite()
+history = None # run history database, None when the run is not recorded (e.g., simulations)
+historyname = path.join(path.dirname(path.abspath(__file__)), 'output', 'history.db')
+runid = None # id of the run in the run history
+overheads = {} # mean seconds by which every step type overran its simulated time in earlier runs, see stepoverheads()
+waits = [] # operator questions of the current step, (prompt, date and time, seconds waited)
+pumped = {} # microliters pumped in this run by (position, content)
+tubing = None # liquids in the tubing, see Tubing
+mixture = set() # liquids of the coupling mixture, they may be pushed to the resin ahead of each other without a flush
+savedvol = {} # microliters saved by the tubing content model by liquid, and pumping seconds saved ('time')
+drainsaved = 0 # seconds of draining saved by the drain sensor in this run
+steptimecache = {} # step times by synthesis scale and device parameters, see steptimes()
+askcache = {} # operator questions of the steps, see asktimes()
+staffed = [] # staffed hours of the lab, an operator is always expected without them, see staffedhours()
+weekdaynames = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+tracefile = None # device command trace, see record()
+abort = threading.Event() # set by stop(), ends the waits of the run
+stopinfo = ('', 0.0) # reason of the last stop and seconds taken to set the device safe, None until unwound() after a signal
+stopat = 0.0 # monotonic() of the last signal, see interrupted()
+asking = False # True while the run waits for the answer of the operator, see ask()
+seqfilename = None # sequence configuration file of the run, see checkpoint()
+seqmtime = None # when it was saved, see seqedit()
+seqfull = '' # sequence of the sequence configuration file, the amino acids before saa included
+doubles = set() # amino acid numbers (as saa) double coupled, set in the sequence configuration file (double)
+pendingedit = None # (sequence, double couplings) from edit(), applied before the next amino acid
+editlock = threading.Lock()
+later = [] # parts of the sequence not synthesized yet, see run()
+assignment = {} # amino acid/reagent: position of the part being synthesized, see positions()
+loaded = {} # microliters placed in every position for the part
+loadedat = {} # microliters pumped from every position before it was loaded
+finished = [] # steps before the synthesis finished in this run (priming, swelling, fmoc)
+residuesdone = 0 # amino acids/reagents coupled and deprotected in this run
+coupled = False # True while the amino acid being synthesized is coupled but not deprotected yet
+sleep = wait # waits of the run, they end on a stop, replaced by a virtual clock when simulating
+psposition = None # shadow of the stream selector position, None when it is not known
+skipped = {'pin': 0, 'ps': 0} # commands skipped in this run because they would not change the pin or the stream selector
+now = monotonic # clock used for the trace, replaced by a virtual clock when simulating
+t0 = 0
+
+if __name__ == '__main__':
+    loaddevice()
+    connect()
+    
+    print(' ')
+    print('--------------------------------------------------------------------------------------------------')
+    print('                                           PepSy                                                  ')
+    print('--------------------------------------------------------------------------------------------------')
+    print(' ')
+    
+    seqfile = input('Enter the sequence configuration file name ')
+    print(' ')
+    if seqfile == '':
+        q1 = input('Do you want to terminate the run (y or n)? ')
+        print(' ')
+        if q1.upper() == 'Y':
+            ps.close()
+            exit()
+        else:
+            seqfile = input('Enter the sequence configuration file name ')
+            print(' ')
+    filename = seqfile + datetime.now().strftime('-%Y-%m-%d-') +  'out.txt'
+    loadsequence('sequence/' + seqfile + '.txt')
+    
+    dir = 'output/'
+    if not path.exists(dir):
+        mkdir(dir)
+    chdir(dir) # changing current working directory to output folder
+    history = openhistory(historyname)
+    overheads = stepoverheads(history)
+    file = open(filename, 'w') # creating a new output file
+    file.close()
+    tracefile = open(filename.replace('out.txt', 'trace.txt'), 'w') # every device command of the run, can be compared with a golden trace using PepSy-trace.py
+    tracefile.write('# PepSy trace of ' + seqfile + '\n')
+    uvname = filename.replace('out.txt', 'uv.txt') # fmoc release curves, written only with a UV detector
+    signal.signal(signal.SIGINT, interrupted) # Ctrl-C stops the run, see stop()
+    signal.signal(signal.SIGTERM, interrupted)
+    try:
+        run()
+    except Stopped:
+        aborted()
+    finally: # also after an error, the pump, the valves and the heater are not left in their last state
+        try:
+            safe()
+        except Exception as error: # e.g., the serial link or PepSy-daemon.py failed, the error of the run is shown below
+            filewrite('Device could not be set to a safe state: ' + repr(error))
+        if heater is not None:
+            heater.set(None)
+            stopped.set()
+        tracefile.close()
+        history.close()
+        disconnect()
 # -------------------------------------------------------------------------------------------------------------------------------------------
 # END
 # -------------------------------------------------------------------------------------------------------------------------------------------
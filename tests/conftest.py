@@ -0,0 +1,29 @@
+# Fixtures of the tests, the runs are simulated on copies of PepSy.py (see simcopy() and simulate())
+import sys
+from os import path
+import pytest
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+import PepSy
+
+@pytest.fixture
+def pepsy(monkeypatch, tmp_path): # copy of PepSy.py whose simulated runs write the output file and the UV file in tmp_path, the functions in pepsy.rigs are called with the virtual clock once the devices are simulated
+    monkeypatch.chdir(root)
+    m = PepSy.simcopy()
+    m.rigs = []
+    simdevices = m.simdevices
+    def rigged():
+        clock = simdevices()
+        m.filename = str(tmp_path / 'out.txt')
+        m.uvname = str(tmp_path / 'uv.txt')
+        open(m.filename, 'w').close()
+        open(m.uvname, 'w').close()
+        for rig in m.rigs:
+            rig(clock)
+        return clock
+    m.simdevices = rigged
+    return m
+
+def output(m): # lines of the output file of the last simulated run
+    return open(m.filename).read().splitlines()
@@ -0,0 +1,33 @@
+# Drain sensor on the simulated reactor, see drain() and SimReactor in PepSy.py
+from conftest import output
+
+def timed(m, drains): # records (timeout, seconds drained) of every drain of the run
+    def rig(clock):
+        drain = m.drain
+        def timeddrain(timeout):
+            start = m.now()
+            drain(timeout)
+            drains.append((timeout, m.now() - start))
+        m.drain = timeddrain
+    m.rigs.append(rig)
+
+def test_drains_end_on_the_sensor(pepsy):
+    drains = []
+    timed(pepsy, drains)
+    runtime = pepsy.simulate('templete.txt', drainsensor=True)
+    assert drains
+    assert all(t < timeout for timeout, t in drains if timeout > pepsy.drainmargin) # the reactor empties before every timeout
+    assert pepsy.drainsaved > 0
+    assert not [line for line in output(pepsy) if line.startswith('Reactor not empty')]
+    assert runtime < pepsy.simcopy().simulate('templete.txt', drainsensor=False)
+
+def test_reactor_not_empty(pepsy):
+    drains = []
+    timed(pepsy, drains)
+    def clogged(clock): # nothing flows through the frit
+        pepsy.waste.pin.rate = 0.0
+    pepsy.rigs.append(clogged)
+    pepsy.simulate('templete.txt', drainsensor=True)
+    assert all(t == timeout for timeout, t in drains) # every drain runs for its timeout
+    assert pepsy.drainsaved == 0
+    assert len([line for line in output(pepsy) if line.startswith('Reactor not empty after')]) == len(drains)
@@ -0,0 +1,88 @@
+# Several simulated instruments driven in one process by PepSy-fleet.py, see instrument() there
+import sqlite3
+import threading
+import importlib.util
+from os import path
+from queue import Queue
+from datetime import datetime
+from conftest import root, output
+import PepSy
+
+def fleetmodule(monkeypatch, tmp_path, units, seqfiles): # PepSy-fleet.py with the state its main sets up, the log and the output files in tmp_path
+    spec = importlib.util.spec_from_file_location('PepSyfleet', path.join(root, 'PepSy-fleet.py'))
+    fleet = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fleet)
+    monkeypatch.chdir(root)
+    fleet.units = units
+    fleet.outdir = str(tmp_path)
+    fleet.logfile = open(str(tmp_path / 'fleet.txt'), 'a')
+    fleet.loglock = threading.Lock()
+    fleet.status = {unit: {'state': 'idle', 'sequence': '', 'started': datetime.now(), 'last': ''} for unit in units}
+    fleet.jobs = Queue()
+    for seqfile in seqfiles:
+        fleet.jobs.put(seqfile)
+    fleet.questions = Queue()
+    fleet.results = []
+    fleet.copies = {}
+    return fleet
+
+def test_failed_instrument_leaves_the_others_running(monkeypatch, tmp_path):
+    seqfiles = []
+    for k in range(5):
+        name = str(tmp_path / ('run' + str(k+1) + '.txt'))
+        with open(path.join(root, 'templete.txt')) as template, open(name, 'w') as file:
+            for line in template:
+                file.write('seq = AGK\n' if line.startswith('seq =') else line)
+        seqfiles.append(name)
+    units = ['sim1', 'sim2', 'sim3']
+    fleet = fleetmodule(monkeypatch, tmp_path, units, seqfiles)
+    simcopy = PepSy.simcopy
+    ready = threading.Barrier(len(units)) # every instrument takes its first sequence before any of them finishes one
+    def rigged():
+        m = simcopy()
+        if threading.current_thread().name == 'sim2':
+            def disconnected(n):
+                raise RuntimeError('Arduino disconnected')
+            m.coupling = disconnected
+        ready.wait(10)
+        return m
+    monkeypatch.setattr(PepSy, 'simcopy', rigged)
+    threads = [threading.Thread(target=fleet.instrument, args=(unit, 'config.txt', True), name=unit, daemon=True) for unit in units]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    fleet.logfile.close()
+    assert not any(thread.is_alive() for thread in threads)
+    assert sorted(seqfile for unit, seqfile, result in fleet.results) == seqfiles # every sequence started once
+    failed = [result for unit, seqfile, result in fleet.results if unit == 'sim2']
+    assert failed == ['failed'] # no more sequences after the failure
+    assert all(result == 'done' for unit, seqfile, result in fleet.results if unit != 'sim2')
+    assert fleet.status['sim2']['state'] == 'failed'
+    assert fleet.status['sim1']['state'] == fleet.status['sim3']['state'] == 'finished'
+    assert {unit for unit, seqfile, result in fleet.results} == set(units) # the queue was shared between the instruments
+    log = open(str(tmp_path / 'fleet.txt')).read().splitlines()
+    assert [line for line in log if line.split('\t')[1] == 'sim2' and line.split('\t')[2].startswith('Failed: RuntimeError')]
+    assert [line for line in log if line.split('\t')[1] == 'sim2' and line.split('\t')[2] == 'Device set to a safe state']
+    for unit, seqfile, result in fleet.results: # every run has its own output file
+        outname = path.join(str(tmp_path), unit + '-' + path.splitext(path.basename(seqfile))[0] + datetime.now().strftime('-%Y-%m-%d-') + 'out.txt')
+        lines = open(outname).read().splitlines()
+        assert lines[-1].startswith('Peptide synthesis completed') == (result == 'done')
+
+def test_locked_history_does_not_stop_the_run(pepsy, tmp_path):
+    name = str(tmp_path / 'history.db')
+    other = sqlite3.connect(name, isolation_level=None) # another instrument holding the database
+    def locked(clock):
+        pepsy.history = pepsy.openhistory(name)
+        pepsy.history.execute('pragma busy_timeout = 50')
+        other.execute('begin exclusive')
+    pepsy.rigs.append(locked)
+    pepsy.simulate('templete.txt')
+    lines = output(pepsy)
+    assert [line for line in lines if line.startswith('Peptide synthesis completed')]
+    assert [line for line in lines if line.startswith('Warning: the run history could not be written (database is locked)')]
+    other.execute('rollback')
+    assert pepsy.history.execute('pragma journal_mode').fetchone()[0] == 'wal'
+    assert pepsy.history.execute('select count(*) from runs').fetchone()[0] == 0
+    pepsy.history.close()
+    other.close()
@@ -0,0 +1,52 @@
+# Heated couplings on the simulated reactor block, see PID, Heater, heatedcoupling() and SimThermal in PepSy.py
+from conftest import output
+
+profile = '75/10, C:50/10, H:50/10'
+
+def watched(m, starts, overshoot): # records the setpoint and the temperature when every coupling is timed, and the highest temperature above the setpoint
+    def rig(clock):
+        def tick(dt):
+            if m.heater.setpoint is not None:
+                overshoot[0] = max(overshoot[0], m.heater.temperature() - m.heater.setpoint)
+        clock.ticks.append(tick)
+        def sleep(s): # the coupling is the only wait of a minute or more with the heater on
+            if s >= 60 and m.heater.setpoint is not None:
+                starts.append((m.heater.setpoint, m.heater.temperature()))
+            clock.sleep(s)
+        m.sleep = sleep
+    m.rigs.append(rig)
+
+def heatevents(tracename): # setpoints of the trace, 'off' when the heater was switched off
+    return [line.rstrip('\n').split('\t')[2] for line in open(tracename) if line.split('\t')[1:2] == ['heat']]
+
+def test_heated_couplings(pepsy, tmp_path):
+    starts = []
+    overshoot = [0.0]
+    watched(pepsy, starts, overshoot)
+    tracename = str(tmp_path / 'trace.txt')
+    runtime = pepsy.simulate('templete.txt', tracename, heating=profile)
+    couplings = [x for x in reversed(pepsy.seq) if pepsy.residue(x)['coupling'] == 'single']
+    expected = [50.0 if x.upper() in ('C', 'H') else 75.0 for x in couplings] # per residue profiles
+    events = heatevents(tracename)
+    assert events[0::2] == [str(t) for t in expected]
+    assert events[1::2] == ['off']*len(expected) # the heater is switched off after every coupling
+    assert [setpoint for setpoint, temperature in starts] == expected
+    assert all(temperature >= setpoint - 1 for setpoint, temperature in starts) # timed from within 1 degree C of the setpoint
+    assert overshoot[0] < 2
+    assert not [line for line in output(pepsy) if line.startswith('Reactor not at')]
+    assert runtime < pepsy.simcopy().simulate('templete.txt') # 10 min heated couplings instead of 60 min
+
+def test_setpoint_not_reached(pepsy):
+    starts = []
+    watched(pepsy, starts, [0.0])
+    pepsy.simulate('templete.txt', heating='150/10') # above what the simulated heater can reach
+    warnings = [line for line in output(pepsy) if line.startswith('Reactor not at 150 C after 15 min heating')]
+    assert len(warnings) == len(starts) == len([x for x in pepsy.seq if pepsy.residue(x)['coupling'] == 'single']) # every coupling started anyway
+
+def test_pid_anti_windup(pepsy):
+    pepsy.loaddevice()
+    pid = pepsy.PID(*pepsy.pidgains)
+    for k in range(900): # 15 min far below the setpoint, the heater saturated
+        assert pid.update(50.0, 1.0) == 1.0
+    assert pid.integral == 0.0
+    assert pid.update(0.0, 1.0) == 0.0 # at the setpoint the heater is not held on by a wound up integral
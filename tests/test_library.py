@@ -0,0 +1,30 @@
+# Shared schedules of PepSy-library.py tree, see tree() there
+import importlib.util
+from os import path
+from conftest import root
+import PepSy
+
+library = ['FSCDEQ', 'ICDT', 'DKDTCEK', 'SCKC', 'MTFEM', 'EIQED', 'IYTN', 'VQMKHKD', 'YNVMDE', 'HNFYTCD', 'NQYVDD', 'YDCMVM', 'QAVQHEY', 'IMFK'] # prefixes of a library sharing the C-terminal GKLWAAR
+
+def librarymodule(monkeypatch): # PepSy-library.py with the devices of its main loaded
+    spec = importlib.util.spec_from_file_location('PepSylibrary', path.join(root, 'PepSy-library.py'))
+    lib = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lib)
+    monkeypatch.chdir(root)
+    PepSy.loaddevice()
+    return lib
+
+def test_shared_schedule_never_costs_more_than_flat_plan(monkeypatch):
+    lib = librarymodule(monkeypatch)
+    group = [('p' + str(n+1), (prefix + 'GKLWAAR')[::-1]) for n, prefix in enumerate(library)]
+    flat = lib.separate(group, 0, 1, None, [])
+    for maxss in [2, 4]:
+        for minshared in [1, 3]:
+            for runcost in [0, 2, 14]:
+                schedule = lib.tree(group, 0, 1, maxss, minshared, runcost)
+                assert sorted(name for stage in schedule for name in stage['done']) == sorted(name for name, rev in group)
+                assert all(stage['ss'] <= maxss for stage in schedule)
+                assert lib.price(schedule, runcost) <= lib.price(flat, runcost)
+    # the chunks of 2 peptides each synthesize GKLWAAR again, with runs weighed more than the 7 cycles saved by a chunk one run per peptide is kept
+    assert len(lib.tree(group, 0, 1, 2, 3, 0)) == 21
+    assert sorted(stage['seq'] for stage in lib.tree(group, 0, 1, 2, 3, 14)) == sorted(stage['seq'] for stage in flat)
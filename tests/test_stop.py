@@ -0,0 +1,34 @@
+# Stops of a simulated run, see stop(), interrupted() and unwound() in PepSy.py
+import signal
+import pytest
+
+def test_signal_during_a_device_command(pepsy):
+    commands = []
+    def rig(clock):
+        write = pepsy.ps.write
+        def interruptedwrite(data): # Ctrl-C arrives while the stream selector command is sent
+            commands.append(data)
+            if len(commands) == 10:
+                pepsy.interrupted(signal.SIGINT, None) # returns, the command is finished
+            write(data)
+        pepsy.ps.write = interruptedwrite
+    pepsy.rigs.append(rig)
+    with pytest.raises(pepsy.Stopped):
+        pepsy.simulate('templete.txt')
+    assert pepsy.stopinfo == ('Ctrl-C', None) # nothing sent from the handler
+    assert commands[-1] != b'HM\r'
+    pepsy.unwound()
+    reason, latency = pepsy.stopinfo
+    assert reason == 'Ctrl-C' and latency >= 0
+    assert commands[-1] == b'HM\r'
+    assert all(p.state == 0 for p in (pepsy.pump, pepsy.prime, pepsy.reagent, pepsy.n2, pepsy.waste, pepsy.vent))
+
+def test_switching_off_after_a_stop(pepsy):
+    pepsy.loaddevice()
+    pepsy.simdevices()
+    pepsy.n2.write(1)
+    pepsy.abort.set()
+    pepsy.n2.write(0) # e.g., the N2 pulsing of the agitator thread
+    assert pepsy.n2.state == 0
+    with pytest.raises(pepsy.Stopped):
+        pepsy.n2.write(1)
@@ -0,0 +1,32 @@
+# Second round of fmoc deprotection ended on the plateau of the synthetic UV signal, see treatment() and SimUV in PepSy.py
+from conftest import output
+
+def rounds(m): # {(residue, round): [(seconds, absorbance)]} of the UV file of the last simulated run
+    curves = {}
+    for line in open(m.uvname):
+        residue, r, t, absorbance = line.rstrip('\n').split('\t')
+        curves.setdefault((residue, int(r)), []).append((float(t), float(absorbance)))
+    return curves
+
+def test_second_round_ends_on_plateau(pepsy):
+    pepsy.simulate('templete.txt', uvdetector=True)
+    curves = rounds(pepsy)
+    residues = [residue for residue, r in curves if r == 1]
+    assert 'resin' in residues and len(residues) == len([x for x in pepsy.seq if pepsy.residue(x)['deprotection'] == 'fmoc']) + 1
+    assert all((residue, 2) in curves for residue in residues) # both rounds of every deprotection are in the UV file
+    assert all(curves[(residue, 1)][-1][0] == pepsy.deprotectiontime[0] for residue in residues) # the first round is not shortened
+    ends = {residue: curves[(residue, 2)][-1][0] for residue in residues}
+    assert all(pepsy.uvmin <= t <= pepsy.uvmax for t in ends.values())
+    assert [t for t in ends.values() if t < pepsy.deprotectiontime[1]] # ended early on a plateau
+    assert [t for t in ends.values() if t > pepsy.deprotectiontime[1]] # extended for a slowly deprotecting residue (W of templete.txt)
+    ended = [line for line in output(pepsy) if line.startswith('Second round deprotection of')]
+    assert len(ended) == len(residues)
+
+def test_second_round_stops_at_uvmax(pepsy):
+    def short(clock):
+        pepsy.uvmax = 900
+    pepsy.rigs.append(short)
+    pepsy.simulate('templete.txt', uvdetector=True)
+    curves = rounds(pepsy)
+    assert max(curve[-1][0] for (residue, r), curve in curves.items() if r == 2) == 900
+    assert [line for line in output(pepsy) if line.startswith('Fmoc release of') and 'did not plateau in 15 min' in line]